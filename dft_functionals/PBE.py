@@ -222,7 +222,10 @@ def PBE_X(rs, z, xt, xs0, xs1, c_arr, enhancement=None):
     return res_PBE_X
 
 
-def F_PBE(rho, sigmas, c_arr, device, enhancement=None):
+def F_PBE_reference(rho, sigmas, c_arr, device, enhancement=None):
+    """
+    Composition of the PBE X and C terms above, kept as the reference for F_PBE
+    """
     rs, z = rs_z_calc(rho)
     xs0, xs1, xt = xs_xt_calc(rho, sigmas)
     if enhancement is not None:
@@ -234,6 +237,332 @@ def F_PBE(rho, sigmas, c_arr, device, enhancement=None):
     return res_energy
 
 
+PBE_VARYING = [0, 1, 22, 23, 24, 25]  # columns of c_arr predicted by the NN models
+
+
+def constant_columns(c_arr, varying=None):
+    """
+    Columns of c_arr as (N,) or (1,) views which broadcast against the grid.
+    varying : optional (N, 6) tensor replacing the PBE_VARYING columns,
+    c_arr may then be the global (1, 26) constants
+    """
+    c = list(c_arr.T)
+    if varying is not None:
+        for i, column in enumerate(PBE_VARYING):
+            c[column] = varying[:, i]
+    return c
+
+
+def pw_g(k, rs, sqrt_rs, c):
+    """
+    g(k, rs, c_arr) with sqrt(rs) computed once by the caller,
+    c : the columns of c_arr (see constant_columns)
+    """
+    g_aux_ = (
+        c[3 + k] * sqrt_rs
+        + c[6 + k] * rs
+        + c[9 + k] * rs * sqrt_rs
+        + c[12 + k] * rs * rs
+    )
+    log = torch.log1p(1 / (2 * c[15 + k] * g_aux_))
+    return -2 * c[15 + k] * (1 + c[18 + k] * rs) * log
+
+
+def F_PBE(rho, sigmas, c_arr, device, enhancement=None, varying=None, restricted=False):
+    """
+    Fused PBE XC energy per particle, equal to F_PBE_reference.
+    Every shared intermediate (g(k), f_zeta, mphi, f_pw, the (1 +- z)**(4/3) powers)
+    is computed once and the constants are only read as column views of c_arr
+    enhancement : optional (N, 3) tensor scaling the spin-up/down exchange and correlation
+    varying : optional (N, 6) tensor of the PBE_VARYING columns predicted by the NN models,
+    the other columns are broadcast from c_arr, so an (N, 26) tensor is never built
+    restricted : see F_PBE_restricted
+    """
+    if restricted:
+        return F_PBE_restricted(rho, sigmas, c_arr, enhancement, varying)
+
+    c = constant_columns(c_arr, varying)
+    rs, z = rs_z_calc(rho)
+    xs0, xs1, xt = xs_xt_calc(rho, sigmas)
+    sqrt_rs = torch.sqrt(rs)
+    opz43 = (1 + z) ** (4 / 3)
+    omz43 = (1 - z) ** (4 / 3)
+
+    # PW92 correlation
+    g0 = pw_g(0, rs, sqrt_rs, c)
+    g1 = pw_g(1, rs, sqrt_rs, c)
+    g2_fz20 = pw_g(2, rs, sqrt_rs, c) / c[2]
+    f_zeta_ = (opz43 + omz43 - 2) / (2 ** (4 / 3) - 2)
+    f_pw_ = g0 + z**4 * f_zeta_ * (g1 - g0 + g2_fz20) - f_zeta_ * g2_fz20
+
+    # PBE gradient correction H
+    mphi_ = ((1 + z) ** (2 / 3) + (1 - z) ** (2 / 3)) / 2
+    gamma_mphi3 = c[1] * mphi_**3
+    ratio = -f_pw_ / gamma_mphi3
+    expm1 = torch.expm1(torch.where(ratio < 87, ratio, ratio - ratio + 87))
+    A_ = c[0] / (c[1] * expm1)
+    t2 = (xt / (4 * 2 ** (1 / 3) * mphi_ * sqrt_rs)) ** 2
+    f1_ = t2 + A_ * t2**2
+    f2_ = c[0] * f1_ / (c[1] * (A_ * f1_ + 1))
+    log = torch.where(f2_ <= -1, torch.log1p(f2_ + 10e-8), torch.log1p(f2_))
+    correlation = f_pw_ + gamma_mphi3 * log
+
+    # spin-resolved PBE exchange
+    lda_factor = c[21] * 2 ** (-4 / 3) * (3 / (4 * np.pi)) ** (1 / 3) / rs
+    X2S = 1 / (2 * (6 * np.pi**2) ** (1 / 3))
+    fx_up = 1 + c[22] * (
+        1 - c[22] / (c[22] + c[23] * (X2S * xs0) ** 2)
+    )
+    fx_down = 1 + c[24] * (
+        1 - c[24] / (c[24] + c[25] * (X2S * xs1) ** 2)
+    )
+    exchange_up = lda_factor * opz43 * fx_up
+    exchange_down = lda_factor * omz43 * fx_down
+
+    if enhancement is not None:
+        return (
+            enhancement[:, 0] * exchange_up
+            + enhancement[:, 1] * exchange_down
+            + enhancement[:, 2] * correlation
+        )
+    return exchange_up + exchange_down + correlation
+
+
+def F_PBE_restricted(rho, sigmas, c_arr, enhancement=None, varying=None):
+    """
+    F_PBE for spin-restricted grids (rho_a == rho_b, sigma_aa == sigma_bb).
+    At z = 0 f_zeta vanishes, mphi and the (1 +- z) powers equal 1, so only g(0)
+    of PW92 is evaluated, and the spin-down exchange equals the spin-up one
+    (the spin-down constants c_arr[:, 24:26] are not read)
+    """
+    eps_add = 1e-7
+    eps_add_rho = 1e-10
+    eps_add_sigma = eps_add_rho ** (8 / 3)
+
+    c = constant_columns(c_arr, varying)
+    n = rho[:, 0] + rho[:, 1]
+    rs = (3 / ((n + eps_add) * (4 * np.pi))) ** (1 / 3)
+    xs0 = torch.sqrt(sigmas[:, 0] + eps_add_sigma) / (rho[:, 0] + eps_add_rho) ** (
+        1 + 1 / 3
+    )
+    xt = torch.sqrt(
+        sigmas[:, 0] + 2 * sigmas[:, 1] + sigmas[:, 2] + eps_add_sigma
+    ) / (n + eps_add_rho) ** (1 + 1 / 3)
+    sqrt_rs = torch.sqrt(rs)
+
+    # PW92 correlation
+    f_pw_ = pw_g(0, rs, sqrt_rs, c)
+
+    # PBE gradient correction H, mphi = 1
+    ratio = -f_pw_ / c[1]
+    expm1 = torch.expm1(torch.where(ratio < 87, ratio, ratio - ratio + 87))
+    A_ = c[0] / (c[1] * expm1)
+    t2 = (xt / (4 * 2 ** (1 / 3) * sqrt_rs)) ** 2
+    f1_ = t2 + A_ * t2**2
+    f2_ = c[0] * f1_ / (c[1] * (A_ * f1_ + 1))
+    log = torch.where(f2_ <= -1, torch.log1p(f2_ + 10e-8), torch.log1p(f2_))
+    correlation = f_pw_ + c[1] * log
+
+    # PBE exchange of one spin channel
+    X2S = 1 / (2 * (6 * np.pi**2) ** (1 / 3))
+    fx = 1 + c[22] * (1 - c[22] / (c[22] + c[23] * (X2S * xs0) ** 2))
+    exchange = c[21] * 2 ** (-4 / 3) * (3 / (4 * np.pi)) ** (1 / 3) / rs * fx
+
+    if enhancement is not None:
+        return (
+            enhancement[:, 0] * exchange
+            + enhancement[:, 1] * exchange
+            + enhancement[:, 2] * correlation
+        )
+    return exchange + exchange + correlation
+
+
+def pw_g_derivative(k, rs, sqrt_rs, c):
+    """
+    pw_g and its derivative with respect to rs
+    """
+    g_aux_ = (
+        c[3 + k] * sqrt_rs
+        + c[6 + k] * rs
+        + c[9 + k] * rs * sqrt_rs
+        + c[12 + k] * rs * rs
+    )
+    dg_aux = (
+        c[3 + k] / (2 * sqrt_rs)
+        + c[6 + k]
+        + 1.5 * c[9 + k] * sqrt_rs
+        + 2 * c[12 + k] * rs
+    )
+    u = 1 / (2 * c[15 + k] * g_aux_)
+    log = torch.log1p(u)
+    g_ = -2 * c[15 + k] * (1 + c[18 + k] * rs) * log
+    dg = -2 * c[15 + k] * c[18 + k] * log + 2 * c[15 + k] * (
+        1 + c[18 + k] * rs
+    ) * u * dg_aux / (g_aux_ * (1 + u))
+    return g_, dg
+
+
+def F_PBE_derivatives(rho, sigmas, c_arr, enhancement=None, varying=None):
+    """
+    Closed-form first derivatives of the PBE XC energy density e = (rho_a + rho_b) * F_PBE
+    Returns:
+        F_PBE (N,)
+        de/drho (N, 2)
+        de/dsigma (N, 3) for (sigma_aa, sigma_ab, sigma_bb)
+        de/dc_arr[:, PBE_VARYING] (N, 6), or de/denhancement (N, 3) if enhancement is given,
+        the other columns of c_arr are fixed in all models
+    varying : as in F_PBE
+    """
+    c = constant_columns(c_arr, varying)
+    eps_add = 1e-7
+    eps_add_rho = 1e-10
+    eps_add_sigma = eps_add_rho ** (8 / 3)
+    eps = 1e-29
+
+    rs, z = rs_z_calc(rho)
+    xs0, xs1, xt = xs_xt_calc(rho, sigmas)
+    n = rho[:, 0] + rho[:, 1]
+    sqrt_rs = torch.sqrt(rs)
+    opz13 = (1 + z) ** (1 / 3)
+    omz13 = (1 - z) ** (1 / 3)
+    opz43 = (1 + z) ** (4 / 3)
+    omz43 = (1 - z) ** (4 / 3)
+
+    # PW92 correlation
+    g0, dg0 = pw_g_derivative(0, rs, sqrt_rs, c)
+    g1, dg1 = pw_g_derivative(1, rs, sqrt_rs, c)
+    g2, dg2 = pw_g_derivative(2, rs, sqrt_rs, c)
+    g2_fz20, dg2_fz20 = g2 / c[2], dg2 / c[2]
+    f_zeta_ = (opz43 + omz43 - 2) / (2 ** (4 / 3) - 2)
+    df_zeta = 4 / 3 * (opz13 - omz13) / (2 ** (4 / 3) - 2)
+    bracket = g1 - g0 + g2_fz20
+    f_pw_ = g0 + z**4 * f_zeta_ * bracket - f_zeta_ * g2_fz20
+    df_pw_drs = dg0 + z**4 * f_zeta_ * (dg1 - dg0 + dg2_fz20) - f_zeta_ * dg2_fz20
+    df_pw_dz = (4 * z**3 * f_zeta_ + z**4 * df_zeta) * bracket - df_zeta * g2_fz20
+
+    # PBE gradient correction H
+    beta, gamma = c[0], c[1]
+    mphi_ = ((1 + z) ** (2 / 3) + (1 - z) ** (2 / 3)) / 2
+    dmphi = ((1 + z) ** (-1 / 3) - (1 - z) ** (-1 / 3)) / 3
+    gamma_mphi3 = gamma * mphi_**3
+    ratio = -f_pw_ / gamma_mphi3
+    below = ratio < 87
+    expm1 = torch.expm1(torch.where(below, ratio, ratio - ratio + 87))
+    A_ = beta / (gamma * expm1)
+    t_denominator = 4 * 2 ** (1 / 3) * mphi_ * sqrt_rs
+    t = xt / t_denominator
+    t2 = t**2
+    f1_ = t2 + A_ * t2**2
+    P = A_ * f1_ + 1
+    f2_ = beta * f1_ / (gamma * P)
+    shifted = f2_ <= -1
+    log = torch.where(shifted, torch.log1p(f2_ + 10e-8), torch.log1p(f2_))
+    dlog = torch.where(shifted, 1 / (1 + f2_ + 10e-8), 1 / (1 + f2_))
+    correlation = f_pw_ + gamma_mphi3 * log
+
+    # derivatives of H, accumulated backwards through f2 -> A -> ratio
+    bar_f2 = gamma_mphi3 * dlog
+    df2_common = beta / (gamma * P**2)
+    bar_A = bar_f2 * df2_common * (t2**2 - f1_**2)
+    bar_t2 = bar_f2 * df2_common * (1 + 2 * A_ * t2)
+    bar_ratio = torch.where(
+        below, -bar_A * A_ * (expm1 + 1) / expm1, torch.zeros_like(ratio)
+    )
+    dEc_dfpw = 1 - bar_ratio / gamma_mphi3
+    dEc_dmphi = (
+        3 * gamma * mphi_**2 * log
+        - 2 * t2 * bar_t2 / mphi_
+        - 3 * ratio * bar_ratio / mphi_
+    )
+    dEc_drs = dEc_dfpw * df_pw_drs - t2 * bar_t2 / rs
+    dEc_dz = dEc_dfpw * df_pw_dz + dEc_dmphi * dmphi
+    dEc_dxt = bar_t2 * 2 * t / t_denominator
+    dEc_dbeta = bar_f2 * f1_ / (gamma * P) + bar_A / (gamma * expm1)
+    dEc_dgamma = (
+        mphi_**3 * log
+        - bar_f2 * f2_ / gamma
+        - bar_A * A_ / gamma
+        - bar_ratio * ratio / gamma
+    )
+
+    # spin-resolved PBE exchange
+    lda_factor = c[21] * 2 ** (-4 / 3) * (3 / (4 * np.pi)) ** (1 / 3) / rs
+    X2S = 1 / (2 * (6 * np.pi**2) ** (1 / 3))
+    s2_up = (X2S * xs0) ** 2
+    s2_down = (X2S * xs1) ** 2
+    ratio_up = c[22] / (c[22] + c[23] * s2_up)
+    ratio_down = c[24] / (c[24] + c[25] * s2_down)
+    fx_up = 1 + c[22] * (1 - ratio_up)
+    fx_down = 1 + c[24] * (1 - ratio_down)
+    exchange_up = lda_factor * opz43 * fx_up
+    exchange_down = lda_factor * omz43 * fx_down
+
+    if enhancement is None:
+        w_up, w_down, w_c = 1.0, 1.0, 1.0
+    else:
+        w_up, w_down, w_c = enhancement[:, 0], enhancement[:, 1], enhancement[:, 2]
+    res_energy = w_up * exchange_up + w_down * exchange_down + w_c * correlation
+
+    up = w_up * lda_factor * opz43  # d F / d fx_up
+    down = w_down * lda_factor * omz43
+    dF_drs = -(w_up * exchange_up + w_down * exchange_down) / rs + w_c * dEc_drs
+    dF_dz = (
+        4 / 3 * lda_factor * (w_up * opz13 * fx_up - w_down * omz13 * fx_down)
+        + w_c * dEc_dz
+    )
+    dF_dxs0 = up * c[23] * ratio_up**2 * 2 * X2S**2 * xs0
+    dF_dxs1 = down * c[25] * ratio_down**2 * 2 * X2S**2 * xs1
+    dF_dxt = w_c * dEc_dxt
+
+    # chain rule to the densities and contracted gradients
+    same_spin = (sigmas[:, 2] < eps) & (rho[:, 1] < eps)  # xs1 is taken from alpha
+    zero = torch.zeros_like(xs1)
+    xs1_alpha = torch.where(same_spin, dF_dxs1 * xs1, zero)
+    xs1_beta = torch.where(same_spin, zero, dF_dxs1 * xs1)
+    sigma_tot = sigmas[:, 0] + 2 * sigmas[:, 1] + sigmas[:, 2] + eps_add_sigma
+    drs_dn = -rs / (3 * (n + eps_add))
+    dF_dxt_dn = -4 / 3 * dF_dxt * xt / (n + eps_add_rho)
+
+    dF_dra = (
+        dF_drs * drs_dn
+        + dF_dz * (1 - z) / (n + eps_add)
+        - 4 / 3 * (dF_dxs0 * xs0 + xs1_alpha) / (rho[:, 0] + eps_add_rho)
+        + dF_dxt_dn
+    )
+    dF_drb = (
+        dF_drs * drs_dn
+        - dF_dz * (1 + z) / (n + eps_add)
+        - 4 / 3 * xs1_beta / (rho[:, 1] + eps_add_rho)
+        + dF_dxt_dn
+    )
+    dF_dsaa = (dF_dxs0 * xs0 + xs1_alpha) / (
+        2 * (sigmas[:, 0] + eps_add_sigma)
+    ) + dF_dxt * xt / (2 * sigma_tot)
+    dF_dsab = dF_dxt * xt / sigma_tot
+    dF_dsbb = xs1_beta / (2 * (sigmas[:, 2] + eps_add_sigma)) + dF_dxt * xt / (
+        2 * sigma_tot
+    )
+
+    vrho = torch.stack([res_energy + n * dF_dra, res_energy + n * dF_drb], dim=1)
+    vsigma = n.view(-1, 1) * torch.stack([dF_dsaa, dF_dsab, dF_dsbb], dim=1)
+    if enhancement is None:
+        dF_dc = [
+            dEc_dbeta,
+            dEc_dgamma,
+            up * (1 - ratio_up) ** 2,
+            up * s2_up * ratio_up**2,
+            down * (1 - ratio_down) ** 2,
+            down * s2_down * ratio_down**2,
+        ]
+    else:
+        dF_dc = [exchange_up, exchange_down, correlation]
+    vconstants = n.view(-1, 1) * torch.stack(
+        [torch.broadcast_to(d, n.shape) for d in dF_dc], dim=1
+    )
+
+    return res_energy, vrho, vsigma, vconstants
+
+
 def pw_test(rho, c_arr):
     rs, z = rs_z_calc(rho)
     pw_energy = f_pw(rs, z, c_arr)
@@ -99,7 +99,10 @@ def f_zeta(z):  # - power threshold
     return x
 
 
-def f_vwn(rs, z, c_arr):
+def f_vwn_reference(rs, z, c_arr):
+    """
+    f_vwn with every f_aux evaluated separately, kept as the reference for f_vwn
+    """
     aux1 = f_aux(
         c_arr[:, 0:2][:, 0],
         c_arr[:, 2:4][:, 0],
@@ -125,6 +128,57 @@ def f_vwn(rs, z, c_arr):
     return x
 
 
+VWN_AUX_COLUMNS = {  # columns of c_arr with the (A, b, c, x0) of every f_aux in f_vwn
+    "para": (0, 2, 4, 6),
+    "ferro": (1, 3, 5, 7),
+    "rpa_para": (8, 11, 14, 17),
+    "rpa_ferro": (9, 12, 15, 18),
+    "rpa_alpha": (10, 13, 16, 19),
+}
+# columns of A, b, c and x0 over the five f_aux branches
+VWN_AUX_INDEX = [list(columns) for columns in zip(*VWN_AUX_COLUMNS.values())]
+
+
+def vwn_aux_parameters(c_arr):
+    """
+    (A, b, c, x0) of the five f_aux branches as (P, 5) tensors,
+    P = 1 for global constants and P = N for per-point constants
+    """
+    return tuple(c_arr[:, columns] for columns in VWN_AUX_INDEX)
+
+
+def f_aux_stacked(A, b, c, x0, rs):
+    """
+    f_aux of the five branches as one (N, 5) tensor, rs.shape = (N, 1).
+    The parameter-only terms are evaluated on the (P, 5) constants
+    before they are broadcast over the grid points
+    """
+    Q = Q_vwn(b, c)
+    f2 = f2_vwn(b, c, x0)
+    f_vwn_ = 2 * (b - f2 * (2 * x0 + b)) / Q
+
+    x = torch.sqrt(rs)
+    X = rs + b * x + c
+    return A * (
+        torch.log(rs / X)
+        + f_vwn_ * torch.arctan(Q / (2 * x + b))
+        - f2 * torch.log((x - x0) ** 2 / X)
+    )
+
+
+def f_vwn(rs, z, c_arr):
+    aux = f_aux_stacked(*vwn_aux_parameters(c_arr), rs.view(-1, 1))
+    dmc = aux[:, 1] - aux[:, 0]
+    drpa = aux[:, 3] - aux[:, 2]
+    zeta = f_zeta(z)
+    x = (
+        aux[:, 0]
+        + torch.nan_to_num(dmc / drpa) * aux[:, 4] * zeta * (1 - z**4) / fpp_vwn
+        + dmc * zeta * z**4
+    )
+    return x
+
+
 def rs_z_calc(rho):
     eps = 1e-29
     rs = (3 / ((rho[:, 0] + rho[:, 1] + eps) * (4 * np.pi))) ** (1 / 3)
@@ -169,6 +223,14 @@ def f_svwn3(rho, c_arr):
     return f_lda_x(rs, z, c_arr) + f_vwn(rs, z, c_arr)
 
 
+def f_svwn3_reference(rho, c_arr):
+    """
+    f_svwn3 with f_vwn_reference, kept as the reference for f_svwn3
+    """
+    rs, z = rs_z_calc(rho)
+    return f_lda_x(rs, z, c_arr) + f_vwn_reference(rs, z, c_arr)
+
+
 def F_XALPHA(rho, constant):
     eps = 1e-29
 
@@ -179,6 +241,149 @@ def F_XALPHA(rho, constant):
     return res_energy
 
 
+def F_XALPHA_derivatives(rho, constant):
+    """
+    Closed-form first derivatives of the energy density e = (rho_a + rho_b) * F_XALPHA
+    Returns F_XALPHA (N,), de/drho (N, 2) and de/dconstant (N, 1)
+    """
+    eps = 1e-29
+
+    n = rho[:, 0] + rho[:, 1]
+    cube_root = (n + eps) ** (1 / 3)
+    res_energy = constant[:, 0] * XALPHA_PARAM * cube_root
+    vrho_total = res_energy + n * res_energy / (3 * (n + eps))
+    vrho = torch.stack([vrho_total, vrho_total], dim=1)
+    vconstant = (n * XALPHA_PARAM * cube_root).view(-1, 1)
+
+    return res_energy, vrho, vconstant
+
+
+def f_aux_derivatives(A, b, c, x0, rs):
+    """
+    f_aux and its derivatives with respect to rs, A, b, c and x0,
+    called with the stacked (P, 5) constants and rs.shape = (N, 1) like f_aux_stacked
+    """
+    x = torch.sqrt(rs)
+    X = fx_vwn(b, c, rs)
+    dX = 1 + b / (2 * x)
+    Q = Q_vwn(b, c)
+    Xx0 = x0**2 + b * x0 + c
+    f1 = f1_vwn(b, c)
+    f2 = f2_vwn(b, c, x0)
+    f3 = f3_vwn(b, c, x0)
+    f_vwn_ = f1 - f2 * f3
+    arc = torch.arctan(Q / (2 * x + b))
+    log2 = torch.log((x - x0) ** 2 / X)
+    bracket = torch.log(rs / X) + f_vwn_ * arc - f2 * log2
+
+    d_rs = A * (
+        1 / rs
+        - dX / X
+        - f_vwn_ * Q / (4 * x * X)
+        - f2 * (1 / (x * (x - x0)) - dX / X)
+    )
+
+    df2_db = x0 / Xx0 - b * x0**2 / Xx0**2
+    df_vwn_db = (
+        2 / Q
+        + 2 * b**2 / Q**3
+        - df2_db * f3
+        - f2 * (2 / Q + 2 * (2 * x0 + b) * b / Q**3)
+    )
+    darc_db = (-b / Q * (2 * x + b) - Q) / (4 * X)
+    d_b = A * (
+        -x / X + df_vwn_db * arc + f_vwn_ * darc_db - df2_db * log2 + f2 * x / X
+    )
+
+    df2_dc = -b * x0 / Xx0**2
+    df_vwn_dc = -4 * b / Q**3 - df2_dc * f3 + f2 * 4 * (2 * x0 + b) / Q**3
+    darc_dc = (2 * x + b) / (2 * Q * X)
+    d_c = A * (
+        -1 / X + df_vwn_dc * arc + f_vwn_ * darc_dc - df2_dc * log2 + f2 / X
+    )
+
+    df2_dx0 = b / Xx0 - b * x0 * (2 * x0 + b) / Xx0**2
+    d_x0 = A * (
+        -(df2_dx0 * f3 + f2 * 4 / Q) * arc - df2_dx0 * log2 + 2 * f2 / (x - x0)
+    )
+
+    return A * bracket, d_rs, bracket, d_b, d_c, d_x0
+
+
+def f_svwn3_derivatives(rho, c_arr):
+    """
+    Closed-form first derivatives of the energy density e = (rho_a + rho_b) * f_svwn3
+    Returns f_svwn3 (N,), de/drho (N, 2) and de/dc_arr (N, 21)
+    """
+    eps = 1e-29
+
+    rs, z = rs_z_calc(rho)
+    n = rho[:, 0] + rho[:, 1]
+
+    # (N, 5) values and derivatives of the branches in VWN_AUX_COLUMNS order
+    aux = f_aux_derivatives(*vwn_aux_parameters(c_arr), rs.view(-1, 1))
+    dmc = aux[0][:, 1] - aux[0][:, 0]
+    drpa = aux[0][:, 3] - aux[0][:, 2]
+    aux2 = aux[0][:, 4]
+
+    zeta = f_zeta(z)
+    dzeta = 4 / 3 * ((1 + z) ** (1 / 3) - (1 - z) ** (1 / 3)) / (2 ** (4 / 3) - 2)
+    spin_rpa = zeta * (1 - z**4) / fpp_vwn
+    spin_mc = zeta * z**4
+    quotient = dmc / drpa
+    finite = torch.isfinite(quotient)
+    quotient_ = torch.nan_to_num(quotient)
+
+    # weights of every f_aux in f_vwn
+    w_dmc = torch.where(finite, aux2 * spin_rpa / drpa, torch.zeros_like(quotient))
+    w_dmc = w_dmc + spin_mc
+    w_drpa = torch.where(
+        finite, -quotient * aux2 * spin_rpa / drpa, torch.zeros_like(quotient)
+    )
+    weights = torch.stack(
+        [1 - w_dmc, w_dmc, -w_drpa, w_drpa, quotient_ * spin_rpa], dim=1
+    )
+
+    f_lda_x_ = f_lda_x(rs, z, c_arr)
+    lda_x_sum = lda_x_spin(rs, z) + lda_x_spin(rs, -z)
+    res_energy = (
+        f_lda_x_
+        + aux[0][:, 0]
+        + quotient_ * aux2 * spin_rpa
+        + dmc * spin_mc
+    )
+
+    df_drs = -f_lda_x_ / rs + torch.sum(weights * aux[1], dim=1)
+    df_dz = (
+        c_arr[:, 20]
+        * LDA_X_FACTOR
+        * 2 ** (-1 - 1 / DIMENSIONS)
+        * (RS_FACTOR / rs)
+        * 4
+        / 3
+        * ((1 + z) ** (1 / 3) - (1 - z) ** (1 / 3))
+        + quotient_ * aux2 * (dzeta * (1 - z**4) - 4 * z**3 * zeta) / fpp_vwn
+        + dmc * (dzeta * z**4 + 4 * z**3 * zeta)
+    )
+
+    drs_dn = -rs / (3 * (n + eps))
+    vrho = torch.stack(
+        [
+            res_energy + n * (df_drs * drs_dn + df_dz * (1 - z) / (n + eps)),
+            res_energy + n * (df_drs * drs_dn - df_dz * (1 + z) / (n + eps)),
+        ],
+        dim=1,
+    )
+
+    vconstants = torch.zeros(len(rs), c_arr.shape[1], dtype=rs.dtype, device=rs.device)
+    for columns, derivative in zip(VWN_AUX_INDEX, aux[2:]):
+        vconstants[:, columns] = weights * derivative
+    vconstants[:, 20] = lda_x_sum
+    vconstants = n.view(-1, 1) * vconstants
+
+    return res_energy, vrho, vconstants
+
+
 if __name__ == "__main__":
     constants_10 = torch.tile(
         torch.Tensor(
@@ -2,7 +2,18 @@
 Unified DFT functional implementations (PBE, SVWN3, etc.)
 """
 
-from . import PBE, SVWN3
-from .constants import true_constants_PBE, true_constants_SVWN3
+from . import PBE, SVWN3, screening
+from .constants import (
+    true_constants_PBE,
+    true_constants_SVWN3,
+    true_varying_constants_PBE,
+)
 
-__all__ = ["PBE", "SVWN3", "true_constants_PBE", "true_constants_SVWN3"]
+__all__ = [
+    "PBE",
+    "SVWN3",
+    "screening",
+    "true_constants_PBE",
+    "true_constants_SVWN3",
+    "true_varying_constants_PBE",
+]
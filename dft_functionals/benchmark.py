@@ -0,0 +1,292 @@
+import sys
+import time
+from optparse import OptionParser
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from dft_functionals.constants import true_constants_PBE, true_constants_SVWN3
+from dft_functionals.PBE import PBE_VARYING, F_PBE, F_PBE_derivatives, F_PBE_reference
+from dft_functionals.SVWN3 import (
+    F_XALPHA,
+    F_XALPHA_derivatives,
+    f_svwn3,
+    f_svwn3_derivatives,
+    f_svwn3_reference,
+)
+
+
+def random_grid(n_points, dtype, device, seed=42):
+    """
+    Spin-polarized densities over 10 orders of magnitude and
+    reduced gradients s in [0, 3], in the F_PBE input layout
+    """
+    generator = torch.Generator().manual_seed(seed)
+    rho = 10 ** (torch.rand(n_points, 2, generator=generator, dtype=torch.float64) * 10 - 8)
+    s = torch.rand(n_points, 2, generator=generator, dtype=torch.float64) * 3
+    sigma_spin = (s * 2 * (6 * np.pi**2) ** (1 / 3) * rho ** (4 / 3)) ** 2
+    cos = torch.rand(n_points, generator=generator, dtype=torch.float64) * 2 - 1
+    sigmas = torch.stack(
+        [
+            sigma_spin[:, 0],
+            cos * torch.sqrt(sigma_spin[:, 0] * sigma_spin[:, 1]),
+            sigma_spin[:, 1],
+        ],
+        dim=1,
+    )
+    return rho.to(device, dtype), sigmas.to(device, dtype)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timed(function, repeat, device):
+    timings = []
+    for _ in range(repeat):
+        synchronize(device)
+        start = time.perf_counter()
+        function()
+        synchronize(device)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def peak_memory(function, device):
+    """
+    Peak memory allocated by function on top of the already allocated tensors:
+    the CUDA allocator statistics, on CPU the memory events of the torch profiler
+    """
+    if device.type == "cuda":
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        function()
+        synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        function()
+    current, peak = 0, 0
+    memory_events = [event for event in prof.events() if event.name == "[memory]"]
+    for event in sorted(memory_events, key=lambda event: event.time_range.start):
+        current += event.cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark_F_PBE(n_points, repeat, device, dtype, backward=False):
+    """
+    Compares F_PBE_reference and the fused F_PBE on a random grid with
+    per-point constants (as predicted by the NN models), either as a dense
+    (N, 26) tensor or as the (N, 6) varying columns
+    """
+    rho, sigmas = random_grid(n_points, dtype, device)
+    c_global = true_constants_PBE.to(device, dtype)
+    c_arr = c_global.repeat(n_points, 1)
+    c_arr.requires_grad_(backward)
+    varying = c_global[:, PBE_VARYING].repeat(n_points, 1)
+    varying.requires_grad_(backward)
+
+    kernels = (
+        ("F_PBE_reference", lambda: F_PBE_reference(rho, sigmas, c_arr, device)),
+        ("F_PBE", lambda: F_PBE(rho, sigmas, c_arr, device)),
+        ("F_PBE varying", lambda: F_PBE(rho, sigmas, c_global, device, varying=varying)),
+    )
+    reference = kernels[0][1]()
+    for name, functional in kernels[1:]:
+        max_error = torch.max(torch.abs(functional() - reference)).item()
+        print(f"Max |{name} - F_PBE_reference| = {max_error:.3e}")
+        if dtype == torch.float64:
+            assert max_error < 1e-12
+
+    print(
+        f"NN -> functional handoff, MB: (N, 26) {c_arr.nbytes / 2**20:.1f}, "
+        f"(N, 6) {varying.nbytes / 2**20:.1f}"
+    )
+    print(f"{'Kernel':>18} {'points/s':>12} {'peak memory, MB':>16}")
+    for name, functional in kernels:
+
+        def run():
+            energy = functional()
+            if backward:
+                energy.sum().backward()
+
+        run()  # warm-up
+        seconds = timed(run, repeat, device)
+        memory = peak_memory(run, device)
+        print(f"{name:>18} {n_points / seconds:>12.4g} {memory / 2**20:>16.1f}")
+
+
+def benchmark_restricted(n_points, repeat, device, dtype):
+    """
+    Compares F_PBE and F_PBE(restricted=True) on a spin-restricted random grid
+    """
+    rho, sigmas = random_grid(n_points, dtype, device)
+    rho, sigmas = rho[:, [0, 0]], sigmas[:, [0, 0, 0]]  # equal spin densities and gradients
+    c_global = true_constants_PBE.to(device, dtype)
+    varying = c_global[:, PBE_VARYING].repeat(n_points, 1)
+    varying[:, 4:] = varying[:, 2:4]  # spin-up and spin-down exchange constants are equal
+
+    kernels = (
+        ("F_PBE", lambda: F_PBE(rho, sigmas, c_global, device, varying=varying)),
+        (
+            "F_PBE restricted",
+            lambda: F_PBE(rho, sigmas, c_global, device, varying=varying, restricted=True),
+        ),
+    )
+    max_error = torch.max(torch.abs(kernels[0][1]() - kernels[1][1]())).item()
+    print(f"Max |F_PBE restricted - F_PBE| = {max_error:.3e}")
+    if dtype == torch.float64:
+        assert max_error < 1e-12
+
+    for name, functional in kernels:
+        functional()  # warm-up
+        seconds = timed(functional, repeat, device)
+        print(f"{name:>18} {n_points / seconds:>12.4g}")
+
+
+def benchmark_svwn3(n_points, repeat, device, dtype):
+    """
+    Compares f_svwn3_reference and the stacked f_svwn3 with global (1, 21)
+    and per-point (N, 21) constants
+    """
+    rho, _ = random_grid(n_points, dtype, device)
+    c_global = torch.tensor([true_constants_SVWN3], dtype=dtype, device=device)
+    c_arr = c_global.repeat(n_points, 1)
+
+    kernels = (
+        ("f_svwn3_reference", lambda: f_svwn3_reference(rho, c_arr)),
+        ("f_svwn3", lambda: f_svwn3(rho, c_arr)),
+        ("f_svwn3 global", lambda: f_svwn3(rho, c_global)),
+    )
+    reference = kernels[0][1]()
+    for name, functional in kernels[1:]:
+        max_error = relative_error(functional(), reference)
+        print(f"Max relative |{name} - f_svwn3_reference| = {max_error:.3e}")
+        if dtype == torch.float64:
+            assert max_error < 1e-12
+
+    for name, functional in kernels:
+        functional()  # warm-up
+        seconds = timed(functional, repeat, device)
+        print(f"{name:>18} {n_points / seconds:>12.4g}")
+
+
+def relative_error(analytic, reference):
+    return (
+        torch.max(torch.abs(analytic - reference))
+        / torch.max(torch.abs(reference))
+    ).item()
+
+
+def check_derivatives(n_points, device):
+    """
+    Compares the closed-form derivatives of the energy density (rho_a + rho_b) * F
+    with autograd for PBE (NN constants and enhancement factors), Xalpha and SVWN3
+    """
+    rho, sigmas = random_grid(n_points, torch.float64, device)
+    rho.requires_grad_(True)
+    sigmas.requires_grad_(True)
+    n = rho[:, 0] + rho[:, 1]
+    generator = torch.Generator().manual_seed(0)
+
+    def scaled(constants, columns):
+        # per-point constants around the true values, as predicted by the NN models
+        constants = constants.to(device, torch.float64).repeat(n_points, 1)
+        noise = 1 + 0.2 * (torch.rand(n_points, len(columns), generator=generator) - 0.5)
+        constants[:, columns] = constants[:, columns] * noise.to(device, torch.float64)
+        return constants.requires_grad_(True)
+
+    c_pbe = scaled(true_constants_PBE, PBE_VARYING)
+    enhancement = scaled(torch.ones(1, 3), [0, 1, 2])
+    c_xalpha = scaled(torch.tensor([[1.05]]), [0])
+    c_svwn3 = scaled(torch.tensor([true_constants_SVWN3]), list(range(21)))
+
+    cases = (
+        (
+            "PBE",
+            lambda: F_PBE(rho, sigmas, c_pbe, device),
+            lambda: F_PBE_derivatives(rho, sigmas, c_pbe),
+            (rho, sigmas, c_pbe),
+            PBE_VARYING,
+        ),
+        (
+            "PBE enhancement",
+            lambda: F_PBE(rho, sigmas, true_constants_PBE, device, enhancement),
+            lambda: F_PBE_derivatives(rho, sigmas, true_constants_PBE, enhancement),
+            (rho, sigmas, enhancement),
+            None,
+        ),
+        (
+            "XALPHA",
+            lambda: F_XALPHA(rho, c_xalpha),
+            lambda: F_XALPHA_derivatives(rho, c_xalpha),
+            (rho, c_xalpha),
+            None,
+        ),
+        (
+            "SVWN3",
+            lambda: f_svwn3(rho, c_svwn3),
+            lambda: f_svwn3_derivatives(rho, c_svwn3),
+            (rho, c_svwn3),
+            None,
+        ),
+    )
+
+    for name, functional, derivatives, inputs, columns in cases:
+        energy = functional()
+        reference = torch.autograd.grad(torch.sum(n * energy), inputs)
+        if columns is not None:
+            reference = reference[:-1] + (reference[-1][:, columns],)
+        with torch.no_grad():
+            exc, *analytic = derivatives()
+        errors = [relative_error(exc, energy.detach())] + [
+            relative_error(a, r) for a, r in zip(analytic, reference)
+        ]
+        print(f"{name:>16}: " + ", ".join(f"{error:.2e}" for error in errors))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--Points", type=int, default=1_000_000, help="Number of grid points")
+    parser.add_option("--Repeat", type=int, default=5, help="Number of timing repetitions")
+    parser.add_option("--Device", type=str, default="cpu", help="cpu or cuda")
+    parser.add_option(
+        "--Dtype", type=str, default="float64", help="float64 or float32"
+    )
+    parser.add_option(
+        "--Backward",
+        action="store_true",
+        default=False,
+        help="Time the gradient with respect to the constants as well",
+    )
+    parser.add_option(
+        "--Check_derivatives",
+        action="store_true",
+        default=False,
+        help="Compare the closed-form derivatives with autograd",
+    )
+    (Opts, args) = parser.parse_args()
+
+    if Opts.Check_derivatives:
+        print("Max relative errors of F, de/drho, (de/dsigma), de/dconstants:")
+        check_derivatives(Opts.Points, torch.device(Opts.Device))
+    benchmark_F_PBE(
+        Opts.Points,
+        Opts.Repeat,
+        torch.device(Opts.Device),
+        getattr(torch, Opts.Dtype),
+        Opts.Backward,
+    )
+    benchmark_restricted(
+        Opts.Points, Opts.Repeat, torch.device(Opts.Device), getattr(torch, Opts.Dtype)
+    )
+    benchmark_svwn3(
+        Opts.Points, Opts.Repeat, torch.device(Opts.Device), getattr(torch, Opts.Dtype)
+    )
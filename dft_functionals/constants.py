@@ -8,6 +8,8 @@ the piNN-DFT project
 import numpy as np
 import torch
 
+from .PBE import PBE_VARYING
+
 true_constants_PBE = torch.Tensor(
     [
         [
@@ -42,6 +44,9 @@ true_constants_PBE = torch.Tensor(
     ]
 )
 
+# the (1, 6) columns of true_constants_PBE predicted by the NN models
+true_varying_constants_PBE = true_constants_PBE[:, PBE_VARYING]
+
 true_constants_SVWN3 = [
     0.0310907,
     0.01554535,
@@ -0,0 +1,25 @@
+"""
+Screening of the grid points with negligible density. The screened points
+skip the NN and the functional kernels and get zero energy and potential.
+Shared by the training (reaction_energy_calculation) and the SCF (NN_FUNCTIONAL.eval_xc)
+"""
+
+# suggested threshold, the screening is off (threshold 0) unless requested
+DENSITY_THRESHOLD = 1e-10
+
+
+def screen_mask(densities, threshold=DENSITY_THRESHOLD):
+    """
+    densities : (N, 2) spin densities
+    Returns the (N,) boolean mask of the evaluated points, rho_a + rho_b > threshold
+    """
+    return densities[:, 0] + densities[:, 1] > threshold
+
+
+def scatter_screened(values, mask):
+    """
+    Values of the evaluated points placed back on the full grid,
+    zeros at the screened points
+    """
+    full = values.new_zeros(tuple(mask.shape) + tuple(values.shape[1:]))
+    return full.index_put((mask,), values)
@@ -1 +1,7 @@
-from .functional import NN_FUNCTIONAL
+# functional imports torch, numpy_backend and paths are importable without it
+def __getattr__(name):
+    if name in ("NN_FUNCTIONAL", "NN_FUNCTIONAL_FAMILY"):
+        from . import functional
+
+        return getattr(functional, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,3 +1,4 @@
+import copy
 import os
 import sys
 from pathlib import Path
@@ -5,62 +6,29 @@ from pathlib import Path
 import numpy as np
 import torch
 
+from . import numpy_backend
+from .paths import dir_path, omega_str_list, relative_path_to_model_state_dict
 from .NN_models import (
     NN_PBE_model,
     NN_PBE_star_model,
     NN_PBE_star_star_model,
     NN_XALPHA_model,
+    points_per_chunk,
 )
 
 # Import from shared dft_functionals at project root
 root_path = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(root_path))
 from dft_functionals import PBE, SVWN3, true_constants_PBE
+from dft_functionals.screening import screen_mask
 
 F_PBE = PBE.F_PBE
+F_PBE_derivatives = PBE.F_PBE_derivatives
 F_XALPHA = SVWN3.F_XALPHA
+F_XALPHA_derivatives = SVWN3.F_XALPHA_derivatives
 
 torch.set_default_tensor_type(torch.DoubleTensor)
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
-relative_path_to_model_state_dict = {
-    "NN_PBE": "checkpoints/NN_PBE/state_dict.pth",
-    "NN_XALPHA": "checkpoints/NN_XALPHA/state_dict.pth",
-}
-
-omega_str_list = ["0", "0076", "067", "18", "33", "50", "67", "82", "93", "99"]
-
-relative_path_to_model_state_dict.update(
-    {
-        f"NN_XALPHA_{omega}": f"checkpoints/NN_XALPHA/state_dict_0.{omega}.pth"
-        for omega in omega_str_list
-    }
-)
-relative_path_to_model_state_dict.update(
-    {
-        f"NN_PBE_{omega}": f"checkpoints/NN_PBE/state_dict_0.{omega}.pth"
-        for omega in omega_str_list
-    }
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_XALPHA_100": f"checkpoints/NN_XALPHA/state_dict_1.pth"}
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_PBE_100": f"checkpoints/NN_PBE/state_dict_1.pth"}
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_PBE_star": f"checkpoints/NN_PBE/state_dict_star_0.067.pth"}
-)
-relative_path_to_model_state_dict.update(
-    {
-        f"NN_PBE_star_star_{omega}": f"checkpoints/NN_PBE/state_dict_star_star_0.{omega}.pth"
-        for omega in omega_str_list
-    }
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_PBE_star_star_100": f"checkpoints/NN_PBE/state_dict_star_star_1.pth"}
-)
-
 nn_model = {
     "NN_PBE": NN_PBE_model,
     "NN_XALPHA": NN_XALPHA_model,
@@ -68,8 +36,6 @@ nn_model = {
     "NN_PBE_star_star": NN_PBE_star_star_model,
 }
 
-omega_str_list.append("100")
-
 nn_model.update({f"NN_XALPHA_{omega}": NN_XALPHA_model for omega in omega_str_list})
 nn_model.update({f"NN_PBE_{omega}": NN_PBE_model for omega in omega_str_list})
 nn_model.update(
@@ -79,18 +45,75 @@ nn_model.update(
 
 class NN_FUNCTIONAL:
 
-    def __init__(self, name):
+    def __init__(
+        self,
+        name,
+        chunk_size=None,
+        memory_budget=None,
+        density_threshold=0,
+        graph=False,
+        exchange_tolerance=None,
+        backend="torch",
+    ):
+        """
+        chunk_size : evaluate eval_xc over chunks of at most chunk_size grid points
+        memory_budget : bytes for the NN graph of one chunk, sets chunk_size
+        density_threshold : grid points with a smaller total density skip the NN
+        and get zero exc, vxc and fxc (e.g. DENSITY_THRESHOLD), 0 disables the
+        screening, the screened points are counted in screened_points
+        graph : evaluate exc and vxc with the frozen TorchScript graph saved next to
+        the checkpoint (see export_graph), it is exported on the first use
+        exchange_tolerance : evaluate the exchange subnetwork of the PBE models by
+        interpolation of a table validated to this tolerance (see tabulate_exchange)
+        backend : "torch" or "numpy", the numpy backend evaluates exc and vxc
+        with NumPy only (see numpy_backend.NumpyFunctional), its weights are
+        exported next to the checkpoint if missing or stale, memory_budget is
+        ignored since the NN is not evaluated by torch
+        """
         path_to_model_state_dict = (
             dir_path + "/" + relative_path_to_model_state_dict[name]
         )
-        model = nn_model[name]()
-        print(path_to_model_state_dict)
+        self.name = name
+        self.path_to_model_state_dict = path_to_model_state_dict
+        self.model = None
+        self.numpy_functional = None
+        if backend == "numpy":
+            if graph:
+                raise ValueError("The TorchScript graph is not available with the numpy backend")
+            self.numpy_functional = numpy_backend.NumpyFunctional(name)
+        else:
+            self.model = self.load_model()
+            if exchange_tolerance and hasattr(self.model, "tabulate_exchange"):
+                error = self.model.tabulate_exchange(exchange_tolerance)
+                print(f"{name}: exchange table error {error:.2e}")
+        self.chunk_size = None
+        self.density_threshold = density_threshold
+        self.screened_points = 0
+        self.graph = None
+        if graph:
+            self.graph = load_graph(self, graph_path(path_to_model_state_dict, exchange_tolerance))
+        if memory_budget and self.numpy_functional is None:
+            chunk_size = points_per_chunk(
+                memory_budget,
+                lambda n_points: self.eval_xc("", self.probe_rho(n_points), spin=1),
+            )
+        self.chunk_size = chunk_size
+
+    def load_model(self):
+        model = nn_model[self.name]()
+        print(self.path_to_model_state_dict)
         model.load_state_dict(
-            torch.load(path_to_model_state_dict, map_location=torch.device("cpu"))
+            torch.load(self.path_to_model_state_dict, map_location=torch.device("cpu"))
         )
         model.eval()
-        self.name = name
-        self.model = model
+        return model
+
+    @staticmethod
+    def probe_rho(n_points):
+        """
+        Unrestricted eval_xc input (rho, dx, dy, dz, tau) of random grid points
+        """
+        return np.random.default_rng(0).uniform(0.01, 1.0, size=(2, 5, n_points))
 
     def create_features_from_rhos(self, features, device):
         rho_only_a, grad_a_x, grad_a_y, grad_a_z, _, tau_a = torch.unsqueeze(
@@ -208,6 +231,7 @@ class NN_FUNCTIONAL:
             grad_inp,
             tau_a_inp,
             tau_b_inp,
+            restricted=bool(mode),  # libxc features have rho_a == rho_b
         )
 
         functional_densities = torch.cat(
@@ -231,10 +255,16 @@ class NN_FUNCTIONAL:
                     true_constants_PBE,
                     "cpu",
                     torch.stack(constants, dim=1),
+                    restricted=bool(mode),
                 )
             else:
                 vxc = F_PBE(
-                    functional_densities, functional_gradients, constants, "cpu"
+                    functional_densities,
+                    functional_gradients,
+                    true_constants_PBE,
+                    "cpu",
+                    varying=constants,
+                    restricted=bool(mode),
                 )
         elif "NN_XALPHA" in self.name:
             vxc = F_XALPHA(functional_densities, constants)
@@ -245,19 +275,56 @@ class NN_FUNCTIONAL:
 
         return local_xc, vxc, feature_dict
 
-    def torch_grad(self, outputs, inputs):
-        grads = torch.autograd.grad(
-            outputs,
-            inputs,
-            create_graph=True,
-            only_inputs=True,
-        )
-        return grads
-
     def eval_xc(
         self, xc_code, rho, spin, relativity=0, deriv=1, omega=None, verbose=None
     ):
 
+        mask = self.screen(rho, spin)
+        if mask is not None and not mask.all():
+            return self.eval_xc_screened(
+                xc_code, rho, spin, mask, relativity, deriv, omega, verbose
+            )
+
+        if self.chunk_size and np.shape(rho)[-1] > self.chunk_size:
+            return self.eval_xc_chunked(
+                xc_code, rho, spin, relativity, deriv, omega, verbose
+            )
+
+        if self.graph is not None:
+            return self.eval_xc_graph(rho, spin, deriv)
+        if self.numpy_functional is not None:
+            return self.eval_xc_numpy(rho, spin, deriv)
+
+        feature_dict = self.eval_xc_leaves(rho, spin)
+        constants, functional_densities, functional_gradients = self.nn_constants(
+            self.model, feature_dict, spin
+        )
+        exc, vrho, vsigma, grad_outputs = self.functional_derivatives(
+            functional_densities, functional_gradients, constants
+        )
+
+        # A single backward pass through the network into its inputs
+        leaves = list(feature_dict.values())
+        nn_grads = torch.autograd.grad(
+            constants, leaves, grad_outputs=grad_outputs, allow_unused=True
+        )
+        nn_grads = {
+            key: (torch.zeros_like(leaf) if grad is None else grad)[0, :]
+            for key, leaf, grad in zip(feature_dict, leaves, nn_grads)
+        }
+
+        vxc = self.libxc_vxc(vrho, vsigma, nn_grads, spin)
+        fxc = self.eval_fxc(rho, spin) if deriv > 1 else None
+        kxc = None  # Third derivative not implemented
+        exc = exc.detach().cpu().numpy().astype(np.float64)
+        return exc, vxc, fxc, kxc
+
+    @staticmethod
+    def eval_xc_leaves(rho, spin):
+        """
+        (1, N) leaf tensors of the pyscf MGGA rho (rho, dx, dy, dz, tau):
+        rho_a, rho_b, norm_grad_a, norm_grad, norm_grad_b, tau_a, tau_b
+        """
         if spin == 0:
             rho_only_a, grad_a_x, grad_a_y, grad_a_z, tau_a = torch.unsqueeze(
                 torch.tensor(rho / 2, dtype=torch.float64), dim=1
@@ -302,6 +369,14 @@ class NN_FUNCTIONAL:
         for key in feature_dict:
             feature_dict[key].requires_grad = True
 
+        return feature_dict
+
+    def nn_constants(self, model, feature_dict, spin):
+        """
+        Constants predicted by model from the eval_xc_leaves
+        and the densities and gradients of F_PBE / F_XALPHA
+        """
+        feature_dict = dict(feature_dict)
         feature_dict["norm_grad_ab"] = (
             feature_dict["norm_grad"]
             - feature_dict["norm_grad_a"]
@@ -333,7 +408,7 @@ class NN_FUNCTIONAL:
         tau_a_inp = feature_dict["tau_a"]
         tau_b_inp = feature_dict["tau_b"]
 
-        constants = self.model(
+        constants = model(
             nn_inputs,
             rho_a_inp,
             rho_b_inp,
@@ -342,6 +417,7 @@ class NN_FUNCTIONAL:
             grad_inp,
             tau_a_inp,
             tau_b_inp,
+            restricted=spin == 0,
         )
 
         functional_densities = torch.cat(
@@ -355,94 +431,547 @@ class NN_FUNCTIONAL:
             ],
             dim=0,
         ).T
+        return constants, functional_densities, functional_gradients
+
+    def functional_derivatives(self, functional_densities, functional_gradients, constants):
+        """
+        Closed-form derivatives of the functional, the NN constants are inputs here.
+        Returns exc, vrho, vsigma and the grad_outputs of the NN backward pass
+        """
+        with torch.no_grad():
+            if "PBE" in self.name:
+                if "star_star" in self.name:
+                    exc, vrho, vsigma, vconstants = F_PBE_derivatives(
+                        functional_densities,
+                        functional_gradients,
+                        true_constants_PBE,
+                        enhancement=torch.stack(constants, dim=1),
+                    )
+                    grad_outputs = vconstants.unbind(dim=1)
+                else:
+                    exc, vrho, vsigma, vconstants = F_PBE_derivatives(
+                        functional_densities,
+                        functional_gradients,
+                        true_constants_PBE,
+                        varying=constants,
+                    )
+                    grad_outputs = vconstants
+            else:
+                exc, vrho, vconstants = F_XALPHA_derivatives(
+                    functional_densities, constants
+                )
+                vsigma = torch.zeros_like(functional_gradients)
+                grad_outputs = vconstants
+        return exc, vrho, vsigma, grad_outputs
+
+    @staticmethod
+    def libxc_vxc(vrho, vsigma, nn_grads, spin):
+        """
+        pyscf MGGA vxc (vrho, vsigma, vlapl, vtau) from the functional derivatives
+        and the NN gradients, any leading dimensions before the grid points are kept
+        """
+        # Derivatives with respect to the inputs of eval_xc,
+        # sigma_ab = (norm_grad - norm_grad_a - norm_grad_b) / 2
+        vrho_a = vrho[..., 0] + nn_grads["rho_a"]
+        vrho_b = vrho[..., 1] + nn_grads["rho_b"]
+        vsigma_a = vsigma[..., 0] - vsigma[..., 1] / 2 + nn_grads["norm_grad_a"]
+        vsigma_b = vsigma[..., 2] - vsigma[..., 1] / 2 + nn_grads["norm_grad_b"]
+        vsigma_tot = vsigma[..., 1] / 2 + nn_grads["norm_grad"]
+        vtau_a, vtau_b = nn_grads["tau_a"], nn_grads["tau_b"]
+        vrho_a, vrho_b, vsigma_a, vsigma_b, vsigma_tot, vtau_a, vtau_b = (
+            v.detach().cpu().numpy()
+            for v in (vrho_a, vrho_b, vsigma_a, vsigma_b, vsigma_tot, vtau_a, vtau_b)
+        )
+
+        if spin == 0:
+            vxc_0 = (vrho_a + vrho_b) / 2.0
+            vxc_1 = vsigma_a / 4.0 + vsigma_b / 4.0 + vsigma_tot
+            vxc_3 = (vtau_a + vtau_b) / 2.0
+            vxc_2 = np.zeros_like(vxc_3)
+
+        else:
+            vxc_0 = np.stack([vrho_a, vrho_b], axis=-1)
+            vxc_1 = np.stack(
+                [
+                    vsigma_a + vsigma_tot,
+                    2.0 * vsigma_tot,
+                    vsigma_b + vsigma_tot,
+                ],
+                axis=-1,
+            )
+            vxc_3 = np.stack([vtau_a, vtau_b], axis=-1)
+            vxc_2 = np.zeros_like(vxc_3)
+
+        return (
+            vxc_0.astype(np.float64),
+            vxc_1.astype(np.float64),
+            vxc_2.astype(np.float64),
+            vxc_3.astype(np.float64),
+        )
+
+    def eval_xc_chunked(self, xc_code, rho, spin, *args):
+        """
+        eval_xc over chunks of at most self.chunk_size grid points,
+        the NN graph of a chunk is freed before the next one is built
+        """
+        rho = np.asarray(rho)
+        results = [
+            self.eval_xc(xc_code, rho[..., start : start + self.chunk_size], spin, *args)
+            for start in range(0, rho.shape[-1], self.chunk_size)
+        ]
+        exc = np.concatenate([result[0] for result in results])
+        vxc = tuple(
+            np.concatenate([result[1][i] for result in results], axis=0)
+            for i in range(4)
+        )
+        fxc = None
+        if results[0][2] is not None:
+            fxc = tuple(
+                np.concatenate([result[2][i] for result in results], axis=0)
+                for i in range(len(results[0][2]))
+            )
+        return exc, vxc, fxc, None
+
+    def eval_xc_graph(self, rho, spin, deriv=1):
+        """
+        eval_xc with the frozen graph of energy_density,
+        vxc is its gradient with respect to the libxc variables
+        """
+        variables = torch.stack(self.libxc_variables(rho, spin)).detach()
+        variables.requires_grad_(True)
+        energy = self.graph(variables, spin)
+        (derivatives,) = torch.autograd.grad(energy.sum(), variables)
+
+        n = variables[0] + variables[1] if spin else variables[0]
+        exc = torch.where(n > 0, energy / n, 0.0).detach().numpy()
+        derivatives = derivatives.numpy()
+        if spin == 0:
+            vrho, vsigma, vtau = derivatives
+        else:
+            vrho = np.ascontiguousarray(derivatives[:2].T)
+            vsigma = np.ascontiguousarray(derivatives[2:5].T)
+            vtau = np.ascontiguousarray(derivatives[5:].T)
+        vxc = (vrho, vsigma, np.zeros_like(vtau), vtau)
+
+        fxc = self.eval_fxc(rho, spin) if deriv > 1 else None
+        return exc, vxc, fxc, None
+
+    def eval_xc_numpy(self, rho, spin, deriv=1):
+        """
+        eval_xc with exc and vxc of the numpy backend, fxc of the torch model
+        """
+        exc, vxc = self.numpy_functional.exc_vxc(rho, spin)
+        if deriv > 1 and self.model is None:
+            self.model = self.load_model()
+        fxc = self.eval_fxc(rho, spin) if deriv > 1 else None
+        return exc, vxc, fxc, None
+
+    def screen(self, rho, spin):
+        """
+        screen_mask of the eval_xc grid, None if the screening is disabled
+        """
+        if not self.density_threshold:
+            return None
+        rho = np.asarray(rho)
+        if spin == 0:
+            densities = np.stack([rho[0] / 2, rho[0] / 2], axis=1)
+        else:
+            densities = np.stack([rho[0][0], rho[1][0]], axis=1)
+        return screen_mask(densities, self.density_threshold)
+
+    def eval_xc_screened(self, xc_code, rho, spin, mask, *args):
+        """
+        eval_xc of the points kept by mask, the screened points get zeros
+        """
+        self.screened_points += int(np.sum(~mask))
+        exc, vxc, fxc, kxc = self.eval_xc(xc_code, np.asarray(rho)[..., mask], spin, *args)
+
+        def scatter(values):
+            full = np.zeros((len(mask),) + np.shape(values)[1:])
+            full[mask] = values
+            return full
+
+        vxc = tuple(scatter(v) for v in vxc)
+        if fxc is not None:
+            fxc = tuple(scatter(f) for f in fxc)
+        return scatter(exc), vxc, fxc, kxc
+
+    @staticmethod
+    def libxc_variables(rho, spin):
+        """
+        Variables of the libxc derivatives from the pyscf MGGA rho (rho, dx, dy, dz, tau):
+        spin == 0 : rho, sigma, tau
+        spin == 1 : rho_a, rho_b, sigma_aa, sigma_ab, sigma_bb, tau_a, tau_b
+        """
+        rho = np.asarray(rho, dtype=np.float64)
+        if spin == 0:
+            variables = [rho[0], np.einsum("xg,xg->g", rho[1:4], rho[1:4]), rho[4]]
+        else:
+            rho_a, rho_b = rho
+            variables = [
+                rho_a[0],
+                rho_b[0],
+                np.einsum("xg,xg->g", rho_a[1:4], rho_a[1:4]),
+                np.einsum("xg,xg->g", rho_a[1:4], rho_b[1:4]),
+                np.einsum("xg,xg->g", rho_b[1:4], rho_b[1:4]),
+                rho_a[4],
+                rho_b[4],
+            ]
+        return [torch.tensor(v, dtype=torch.float64, requires_grad=True) for v in variables]
+
+    def energy_density(self, variables, spin):
+        """
+        XC energy per volume (rho_a + rho_b) * F at every grid point
+        as a differentiable function of libxc_variables(rho, spin)
+        """
+        if spin == 0:
+            rho, sigma, tau = variables
+            rho_a = rho_b = rho / 2
+            sigma_aa = sigma_ab = sigma_bb = sigma / 4
+            tau_a = tau_b = tau / 2
+        else:
+            rho_a, rho_b, sigma_aa, sigma_ab, sigma_bb, tau_a, tau_b = variables
+        sigma_tot = sigma_aa + 2 * sigma_ab + sigma_bb
+
+        eps_rho = 1e-10
+        constants = self.model(
+            torch.stack(
+                [rho_a, rho_b, sigma_aa, sigma_tot, sigma_bb, tau_a, tau_b], dim=1
+            ),
+            rho_a + eps_rho,
+            rho_b + eps_rho,
+            sigma_aa,
+            sigma_bb,
+            sigma_tot,
+            tau_a,
+            tau_b,
+            restricted=spin == 0,
+        )
 
+        densities = torch.stack([rho_a, rho_b], dim=1)
+        gradients = torch.stack([sigma_aa, sigma_ab, sigma_bb], dim=1)
         if "PBE" in self.name:
             if "star_star" in self.name:
-                vxc = F_PBE(
-                    functional_densities,
-                    functional_gradients,
+                F = F_PBE(
+                    densities,
+                    gradients,
                     true_constants_PBE,
                     "cpu",
                     torch.stack(constants, dim=1),
+                    restricted=spin == 0,
                 )
             else:
-                vxc = F_PBE(
-                    functional_densities, functional_gradients, constants, "cpu"
+                F = F_PBE(
+                    densities,
+                    gradients,
+                    true_constants_PBE,
+                    "cpu",
+                    varying=constants,
+                    restricted=spin == 0,
                 )
         else:
-            vxc = F_XALPHA(functional_densities, constants)
-
-        local_xc = vxc * (feature_dict["rho_a"] + feature_dict["rho_b"])
+            F = F_XALPHA(densities, constants)
+        return (rho_a + rho_b) * F
+
+    def eval_fxc(self, rho, spin):
+        """
+        Second derivatives of the XC energy in the pyscf (libxc) MGGA fxc layout
+        (v2rho2, v2rhosigma, v2sigma2, v2lapl2, v2tau2,
+         v2rholapl, v2rhotau, v2lapltau, v2sigmalapl, v2sigmatau)
+        by double backward: the energy of a grid point depends only on the variables
+        of that point, so the gradient of the summed first derivative with respect
+        to a variable gives the per-point second derivatives
+        """
+        variables = self.libxc_variables(rho, spin)
+        # the single pass of the spin-symmetric rows misses the second
+        # derivatives across the spin swap
+        dedup_symmetric_rows = self.model.dedup_symmetric_rows
+        self.model.dedup_symmetric_rows = False
+        try:
+            energy = self.energy_density(variables, spin)
+        finally:
+            self.model.dedup_symmetric_rows = dedup_symmetric_rows
+        first = torch.autograd.grad(
+            energy.sum(), variables, create_graph=True, allow_unused=True
+        )
 
-        unweighted_xc = torch.sum(local_xc, dim=1)
+        # the screened points (and the points without density) get zeros
+        densities = torch.stack(
+            [variables[0], variables[1]] if spin else [variables[0] / 2, variables[0] / 2],
+            dim=1,
+        )
+        screened = ~screen_mask(densities.detach(), self.density_threshold)
 
-        vrho = (
-            torch.stack(
-                self.torch_grad(
-                    unweighted_xc, [feature_dict["rho_a"], feature_dict["rho_b"]]
+        n = len(variables)
+        hessian = {}
+        for i in range(n):
+            if first[i] is None or not first[i].requires_grad:  # linear or unused variable
+                row = [None] * (n - i)
+            else:
+                row = torch.autograd.grad(
+                    first[i].sum(), variables[i:], retain_graph=True, allow_unused=True
                 )
+            for j, h in zip(range(i, n), row):
+                h = torch.zeros_like(variables[j]) if h is None else h.detach()
+                hessian[i, j] = torch.where(screened, 0.0, h).numpy()
+
+        def block(*pairs):
+            return np.stack([hessian[pair] for pair in pairs], axis=1)
+
+        if spin == 0:
+            zeros = np.zeros_like(hessian[0, 0])
+            return (
+                hessian[0, 0],
+                hessian[0, 1],
+                hessian[1, 1],
+                zeros,
+                hessian[2, 2],
+                zeros,
+                hessian[0, 2],
+                zeros,
+                zeros,
+                hessian[1, 2],
             )
-            .detach()
-            .cpu()
-            .numpy()
+
+        zeros = np.zeros((len(hessian[0, 0]), 1))
+        return (
+            block((0, 0), (0, 1), (1, 1)),
+            block((0, 2), (0, 3), (0, 4), (1, 2), (1, 3), (1, 4)),
+            block((2, 2), (2, 3), (2, 4), (3, 3), (3, 4), (4, 4)),
+            np.tile(zeros, 3),
+            block((5, 5), (5, 6), (6, 6)),
+            np.tile(zeros, 4),
+            block((0, 5), (0, 6), (1, 5), (1, 6)),
+            np.tile(zeros, 4),
+            np.tile(zeros, 6),
+            block((2, 5), (2, 6), (3, 5), (3, 6), (4, 5), (4, 6)),
         )
 
-        vsigma = (
-            torch.stack(
-                self.torch_grad(
-                    unweighted_xc,
-                    [
-                        feature_dict["norm_grad_a"],
-                        feature_dict["norm_grad_b"],
-                        feature_dict["norm_grad"],
-                    ],
-                )
+
+class EnergyDensity(torch.nn.Module):
+    """
+    NN_FUNCTIONAL.energy_density of the stacked libxc variables for one spin case
+    """
+
+    def __init__(self, functional, spin):
+        super().__init__()
+        self.model = functional.model
+        self.name = functional.name
+        self.spin = spin
+
+    def forward(self, variables):
+        return NN_FUNCTIONAL.energy_density(self, list(variables), self.spin)
+
+
+class EnergyDensityGraph(torch.nn.Module):
+    """
+    Traced restricted and unrestricted EnergyDensity, selected by spin
+    """
+
+    def __init__(self, restricted, unrestricted):
+        super().__init__()
+        self.restricted = restricted
+        self.unrestricted = unrestricted
+
+    def forward(self, variables: torch.Tensor, spin: int) -> torch.Tensor:
+        if spin == 0:
+            return self.restricted(variables)
+        return self.unrestricted(variables)
+
+
+def graph_path(path_to_model_state_dict, exchange_tolerance=None):
+    suffix = f".table_{exchange_tolerance:g}" if exchange_tolerance else ""
+    return str(Path(path_to_model_state_dict).with_suffix(f"{suffix}.torchscript.pt"))
+
+
+def export_graph(functional, path, n_points=1000, tolerance=1e-10):
+    """
+    Traces energy_density of the functional for both spin cases into one frozen
+    TorchScript graph and saves it to path. The graph is checked against the
+    eager energy and vxc on a grid of another size before saving, the file is
+    written under a temporary name and moved into place
+    """
+    traced = []
+    for spin in (0, 1):
+        rho = functional.probe_rho(n_points)
+        example = torch.stack(functional.libxc_variables(rho[0] if spin == 0 else rho, spin))
+        traced.append(torch.jit.trace(EnergyDensity(functional, spin), example.detach()))
+    graph = torch.jit.freeze(torch.jit.script(EnergyDensityGraph(*traced).eval()))
+
+    for spin in (0, 1):
+        error = graph_error(functional, graph, spin, n_points + 537)
+        if error > tolerance:
+            raise RuntimeError(
+                f"{functional.name} graph differs from the eager model "
+                f"(spin {spin}, max relative error {error:.2e})"
             )
-            .detach()
-            .cpu()
-            .numpy()
-        )
-        vtau = (
-            torch.stack(
-                self.torch_grad(
-                    unweighted_xc, [feature_dict["tau_a"], feature_dict["tau_b"]]
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    torch.jit.save(graph, temporary_path)
+    os.replace(temporary_path, path)
+    print(f"{functional.name} graph saved to {path}")
+    return path
+
+
+def load_graph(functional, path, n_points=1000, tolerance=1e-10):
+    """
+    The graph saved at path by export_graph, exported again if it is missing
+    or no longer reproduces the eager model (changed checkpoint or model code)
+    """
+    if os.path.exists(path):
+        graph = torch.jit.load(path)
+        if all(graph_error(functional, graph, spin, n_points) <= tolerance for spin in (0, 1)):
+            return graph
+        print(f"{functional.name} graph at {path} is stale")
+    export_graph(functional, path, n_points, tolerance)
+    return torch.jit.load(path)
+
+
+def graph_error(functional, graph, spin, n_points):
+    """
+    Max relative error of the graph energy and vxc against the eager
+    energy_density of the functional on a probe grid of n_points
+    """
+    rho = functional.probe_rho(n_points)
+    rho = rho[0] if spin == 0 else rho
+    variables = functional.libxc_variables(rho, spin)
+    reference = functional.energy_density(variables, spin)
+    reference_vxc = torch.autograd.grad(reference.sum(), variables, allow_unused=True)
+
+    stacked = torch.stack(variables).detach().requires_grad_(True)
+    energy = graph(stacked, spin)
+    (vxc,) = torch.autograd.grad(energy.sum(), stacked)
+
+    errors = [relative_error(energy, reference)] + [
+        relative_error(v, r) for v, r in zip(vxc, reference_vxc) if r is not None
+    ]
+    return max(errors)
+
+
+def export_numpy_weights(name):
+    """
+    Exports the weights of the checkpoint of name for numpy_backend
+    """
+    functional = NN_FUNCTIONAL(name)
+    state_dict = {
+        key: value.detach().cpu().numpy() for key, value in functional.model.state_dict().items()
+    }
+    path = numpy_backend.export_weights(
+        state_dict, functional.path_to_model_state_dict, true_constants_PBE.cpu().numpy()
+    )
+    print(f"{name} weights saved to {path}")
+    return path
+
+
+def relative_error(value, reference):
+    return (
+        torch.max(torch.abs(value - reference)) / torch.max(torch.abs(reference))
+    ).item()
+
+
+class NN_FUNCTIONAL_FAMILY(NN_FUNCTIONAL):
+    """
+    All omega checkpoints of a functional family (NN_PBE, NN_XALPHA, NN_PBE_star_star)
+    evaluated over one grid: the members are stacked with torch.func.stack_module_state
+    and the NN runs once, vmapped over the stacked weights
+    """
+
+    def __init__(self, family, omegas=None, density_threshold=0):
+        """
+        omegas : omega_str_list entries of the members, all of them by default
+        """
+        omegas = omega_str_list if omegas is None else omegas
+        self.names = [f"{family}_{omega}" for omega in omegas]
+        models = [NN_FUNCTIONAL(name, density_threshold=0).model for name in self.names]
+        params, buffers = torch.func.stack_module_state(models)
+        self.params = {key: value.detach() for key, value in params.items()}
+        self.buffers = buffers
+        self.model = copy.deepcopy(models[0]).to("meta")
+        self.model.dedup_symmetric_rows = False  # data-dependent shapes under vmap
+        self.name = family
+        # one checkpoint per member, no TorchScript graph or numpy model
+        self.path_to_model_state_dict = None
+        self.numpy_functional = None
+        self.graph = None
+        self.chunk_size = None
+        self.density_threshold = density_threshold
+        self.screened_points = 0
+
+    def eval_xc(
+        self, xc_code, rho, spin, relativity=0, deriv=1, omega=None, verbose=None
+    ):
+        """
+        exc and vxc of all members in the NN_FUNCTIONAL.eval_xc layout
+        with a leading member dimension, fxc is not available
+        """
+        if deriv > 1:
+            raise ValueError("fxc is not available for a functional family")
+
+        mask = self.screen(rho, spin)
+        if mask is not None and not mask.all():
+            return self.eval_xc_screened(xc_code, rho, spin, mask)
+
+        # Separate leaves of every member, so that their gradients are not summed
+        feature_dict = {
+            key: leaf.detach().expand(len(self.names), -1).clone().requires_grad_()
+            for key, leaf in self.eval_xc_leaves(rho, spin).items()
+        }
+
+        def member(params, buffers, leaves):
+            def model(*args, **kwargs):
+                return torch.func.functional_call(
+                    self.model, (params, buffers), args, kwargs
                 )
-            )
-            .detach()
-            .cpu()
-            .numpy()
+
+            leaves = {key: leaf.view(1, -1) for key, leaf in leaves.items()}
+            return self.nn_constants(model, leaves, spin)
+
+        constants, functional_densities, functional_gradients = torch.func.vmap(member)(
+            self.params, self.buffers, feature_dict
         )
 
-        if spin == 0:
-            vxc_0 = (vrho[0][0, :] + vrho[1][0, :]) / 2.0
-            vxc_1 = vsigma[0][0, :] / 4.0 + vsigma[1][0, :] / 4.0 + vsigma[2][0, :]
-            vxc_3 = (vtau[0][0, :] + vtau[1][0, :]) / 2.0
-            vxc_2 = np.zeros_like(vxc_3)
+        # The closed-form functional derivatives see the members as more grid points
+        def flat(tensor):
+            return tensor.reshape(-1, *tensor.shape[2:])
 
+        exc, vrho, vsigma, grad_outputs = self.functional_derivatives(
+            flat(functional_densities),
+            flat(functional_gradients),
+            tuple(map(flat, constants)) if isinstance(constants, tuple) else flat(constants),
+        )
+        if isinstance(constants, tuple):
+            grad_outputs = tuple(g.view_as(c) for g, c in zip(grad_outputs, constants))
         else:
-            vxc_0 = np.stack([vrho[0][0, :], vrho[1][0, :]], axis=1)
-            vxc_1 = np.stack(
-                [
-                    vsigma[0][0, :] + vsigma[2][0, :],
-                    2.0 * vsigma[2][0, :],
-                    vsigma[1][0, :] + vsigma[2][0, :],
-                ],
-                axis=1,
-            )
-            vxc_3 = np.stack([vtau[0][0, :], vtau[1][0, :]], axis=1)
-            vxc_2 = np.zeros_like(vxc_3)
+            grad_outputs = grad_outputs.view_as(constants)
 
-        fxc = None  # Second derivative not implemented
-        kxc = None  # Second derivative not implemented
-        exc = vxc.detach().cpu().numpy().astype(np.float64)
-        return (
-            exc,
-            (
-                vxc_0.astype(np.float64),
-                vxc_1.astype(np.float64),
-                vxc_2.astype(np.float64),
-                vxc_3.astype(np.float64),
-            ),
-            fxc,
-            kxc,
+        leaves = list(feature_dict.values())
+        nn_grads = torch.autograd.grad(
+            constants, leaves, grad_outputs=grad_outputs, allow_unused=True
+        )
+        nn_grads = {
+            key: torch.zeros_like(leaf) if grad is None else grad
+            for key, leaf, grad in zip(feature_dict, leaves, nn_grads)
+        }
+
+        vxc = self.libxc_vxc(
+            vrho.view(*functional_densities.shape),
+            vsigma.view(*functional_gradients.shape),
+            nn_grads,
+            spin,
         )
+        exc = exc.view(len(self.names), -1).detach().cpu().numpy().astype(np.float64)
+        return exc, vxc, None, None
+
+    def eval_xc_screened(self, xc_code, rho, spin, mask, *args):
+        """
+        eval_xc of the points kept by mask, the screened points get zeros
+        """
+        self.screened_points += int(np.sum(~mask))
+        exc, vxc, _, _ = self.eval_xc(xc_code, np.asarray(rho)[..., mask], spin)
+
+        def scatter(values):
+            full = np.zeros((len(self.names), len(mask)) + np.shape(values)[2:])
+            full[:, mask] = values
+            return full
+
+        return scatter(exc), tuple(scatter(v) for v in vxc), None, None
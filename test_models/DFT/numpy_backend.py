@@ -0,0 +1,665 @@
+"""
+NumPy inference of the NN functionals. The weights of a checkpoint are exported
+once to an .npz file next to it (see export_numpy_weights.py); the forward pass,
+the backward pass into the eval_xc inputs and the closed-form derivatives of the
+PBE and Xalpha functionals are written out by hand. This module does not import
+torch, only NumpyFunctional does, for fxc and to export missing weights
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy.special import erf
+
+from .paths import checkpoint_path
+
+LAYER_NORM_EPS = 1e-5
+EPS_RHO = 1e-10
+EPS_SIGMA = 1e-30
+CUBE_ROOT = (3 * np.pi**2) ** (1 / 3)
+TAU_TF = 3 / 10 * (3 * np.pi**2) ** (2 / 3)
+
+# descriptors with the spin-up and spin-down columns swapped
+SWAP = [1, 0, 4, 3, 2, 6, 5]
+# eval_xc inputs (rho_a, rho_b, sigma_aa, sigma, sigma_bb, tau_a, tau_b)
+# of the exchange descriptors
+EXCHANGE_SCALING = np.array([2, 2, 4, 4, 4, 2, 2])
+
+# dft_functionals.PBE.PBE_VARYING and dft_functionals.SVWN3.XALPHA_PARAM
+PBE_VARYING = [0, 1, 22, 23, 24, 25]
+XALPHA_PARAM = -3 / 4 * (3 / np.pi) ** (1 / 3)
+# version of the .npz layout written by export_weights
+WEIGHTS_FORMAT = 2
+
+
+def eval_xc_inputs(rho, spin):
+    """
+    (N, 7) rho_a, rho_b, sigma_aa, sigma, sigma_bb, tau_a, tau_b
+    of the pyscf MGGA rho (rho, dx, dy, dz, tau)
+    """
+    rho = np.asarray(rho, dtype=np.float64)
+    rho_a, rho_b = (rho / 2, rho / 2) if spin == 0 else rho
+    grad = rho_a[1:4] + rho_b[1:4]
+    return np.stack(
+        [
+            rho_a[0],
+            rho_b[0],
+            np.einsum("xg,xg->g", rho_a[1:4], rho_a[1:4]),
+            np.einsum("xg,xg->g", grad, grad),
+            np.einsum("xg,xg->g", rho_b[1:4], rho_b[1:4]),
+            rho_a[4],
+            rho_b[4],
+        ],
+        axis=1,
+    )
+
+
+def descriptors(v):
+    """
+    tanh descriptors of get_density_descriptors (test_models) from the
+    eval_xc inputs v with EPS_RHO added to the densities.
+    Returns the (N, 7) descriptors and the nonzero derivatives {(i, j): dX_i/dv_j}
+    """
+    rho_a, rho_b, sigma_a, sigma, sigma_b, tau_a, tau_b = v.T
+    u = np.empty_like(v)
+    du = {}
+
+    for i, rho in ((0, rho_a), (1, rho_b)):
+        u[:, i] = rho ** (1 / 3)
+        du[i, i] = u[:, i] / (3 * rho)
+
+    rho_total = rho_a + rho_b - EPS_RHO
+    for i, s, rho, rho_columns in (
+        (2, sigma_a, rho_a, (0,)),
+        (3, sigma, rho_total, (0, 1)),
+        (4, sigma_b, rho_b, (1,)),
+    ):
+        u[:, i] = np.sqrt(s + EPS_SIGMA) / rho ** (4 / 3) / CUBE_ROOT / 2
+        du[i, i] = u[:, i] / (2 * (s + EPS_SIGMA))
+        for j in rho_columns:
+            du[i, j] = -4 / 3 * u[:, i] / rho
+
+    for i, (rho, s, tau, columns) in (
+        (5, (rho_a, sigma_a, tau_a, (0, 2, 5))),
+        (6, (rho_b, sigma_b, tau_b, (1, 4, 6))),
+    ):
+        tau_tf = TAU_TF * rho ** (5 / 3)
+        tau_reduced = tau - s / (8 * rho)
+        u[:, i] = tau_reduced / tau_tf - 1
+        du[i, columns[0]] = s / (8 * rho**2 * tau_tf) - 5 / 3 * tau_reduced / (tau_tf * rho)
+        du[i, columns[1]] = -1 / (8 * rho * tau_tf)
+        du[i, columns[2]] = 1 / tau_tf
+
+    X = np.tanh(u)
+    dtanh = 1 - X**2
+    return X, {(i, j): dtanh[:, i] * d for (i, j), d in du.items()}
+
+
+def descriptors_backward(grad, derivatives):
+    grad_v = np.zeros_like(grad)
+    for (i, j), d in derivatives.items():
+        grad_v[:, j] += grad[:, i] * d
+    return grad_v
+
+
+def layer_norm(x, weight, bias):
+    centered = x - x.mean(axis=1, keepdims=True)
+    r = 1 / np.sqrt(np.mean(centered**2, axis=1, keepdims=True) + LAYER_NORM_EPS)
+    normalized = centered * r
+    return normalized * weight + bias, (normalized, r, weight)
+
+
+def layer_norm_backward(grad, cache):
+    normalized, r, weight = cache
+    grad = grad * weight
+    return r * (
+        grad
+        - grad.mean(axis=1, keepdims=True)
+        - normalized * np.mean(grad * normalized, axis=1, keepdims=True)
+    )
+
+
+def gelu(x):
+    cdf = 0.5 * (1 + erf(x / np.sqrt(2)))
+    return x * cdf, (x, cdf)
+
+
+def gelu_backward(grad, cache):
+    x, cdf = cache
+    return grad * (cdf + x * np.exp(-(x**2) / 2) / np.sqrt(2 * np.pi))
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def shifted_elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0))) + 1
+
+
+def shifted_elu_derivative(x):
+    return np.where(x > 0, 1.0, np.exp(np.minimum(x, 0)))
+
+
+class MLP:
+    """
+    hidden_layers of NN_models: Linear, LayerNorm, GELU, ResBlocks, Linear
+    """
+
+    def __init__(self, weights, prefix):
+        self.input = weights[f"{prefix}.0.weight"].T.copy()
+        self.input_norm = weights[f"{prefix}.1.weight"], weights[f"{prefix}.1.bias"]
+        self.blocks = []
+        i = 3
+        while f"{prefix}.{i}.fc.0.weight" in weights:
+            fc = f"{prefix}.{i}.fc"
+            self.blocks.append(
+                (
+                    weights[f"{fc}.0.weight"].T.copy(),
+                    (weights[f"{fc}.1.weight"], weights[f"{fc}.1.bias"]),
+                    weights[f"{fc}.3.weight"].T.copy(),
+                    (weights[f"{fc}.4.weight"], weights[f"{fc}.4.bias"]),
+                )
+            )
+            i += 1
+        self.output = weights[f"{prefix}.{i}.weight"].T.copy(), weights[f"{prefix}.{i}.bias"]
+
+    def __call__(self, x):
+        """
+        Returns the output and the cache of backward
+        """
+        h, norm_cache = layer_norm(x @ self.input, *self.input_norm)
+        h, gelu_cache = gelu(h)
+        cache = [(norm_cache, gelu_cache)]
+        for weight_1, norm_1, weight_2, norm_2 in self.blocks:
+            out, norm_1_cache = layer_norm(h @ weight_1, *norm_1)
+            out, gelu_1_cache = gelu(out)
+            out, norm_2_cache = layer_norm(out @ weight_2, *norm_2)
+            h, gelu_2_cache = gelu(out + h)
+            cache.append((norm_1_cache, gelu_1_cache, norm_2_cache, gelu_2_cache))
+        weight, bias = self.output
+        return h @ weight + bias, cache
+
+    def backward(self, grad, cache):
+        """
+        Gradient with respect to the input of the gradient grad of the output
+        """
+        grad = grad @ self.output[0].T
+        for (weight_1, _, weight_2, _), block_cache in zip(
+            reversed(self.blocks), reversed(cache[1:])
+        ):
+            norm_1_cache, gelu_1_cache, norm_2_cache, gelu_2_cache = block_cache
+            grad_sum = gelu_backward(grad, gelu_2_cache)
+            out = layer_norm_backward(grad_sum, norm_2_cache) @ weight_2.T
+            out = gelu_backward(out, gelu_1_cache)
+            grad = layer_norm_backward(out, norm_1_cache) @ weight_1.T + grad_sum
+        norm_cache, gelu_cache = cache[0]
+        grad = layer_norm_backward(gelu_backward(grad, gelu_cache), norm_cache)
+        return grad @ self.input.T
+
+
+class NumpyPBE:
+    """
+    pcPBEMLOptimizer (constrained) and pcPBEstar (not constrained):
+    (N, 6) PBE_VARYING constants of the eval_xc inputs and their backward pass
+    """
+
+    def __init__(self, weights, constrained=True):
+        self.hidden_layers_c = MLP(weights, "hidden_layers_c")
+        self.hidden_layers_x = MLP(weights, "hidden_layers_x")
+        self.true_constants = weights["true_constants_PBE"][:, PBE_VARYING]
+        self.constrained = constrained
+        # the sigma-zero exchange input is zero for every point and both spins
+        self.x_at_constraint = self.hidden_layers_x(np.zeros((1, 2)))[0][0]
+
+    def forward(self, v, restricted=False):
+        n = len(v)
+        x_correlation, d_correlation = descriptors(v)
+        x_exchange, d_exchange = descriptors(v * EXCHANGE_SCALING)
+
+        correlation_inputs = [x_correlation]
+        if self.constrained:
+            sigma_zero = np.zeros_like(x_correlation)
+            sigma_zero[:, :2] = x_correlation[:, :2]
+            rho_inf = np.ones_like(x_correlation)
+            rho_inf[:, 2:] = x_correlation[:, 2:]
+            correlation_inputs += [sigma_zero, rho_inf]
+        if not restricted:
+            correlation_inputs += [x[:, SWAP] for x in correlation_inputs]
+        params_c, c_cache = self.hidden_layers_c(np.concatenate(correlation_inputs))
+        params_c = params_c.reshape(len(correlation_inputs), n, -1)
+        if not restricted:
+            params_c = (params_c[: len(params_c) // 2] + params_c[len(params_c) // 2 :]) / 2
+
+        exchange_inputs = [x_exchange[:, [2, 5]]]
+        if not restricted:
+            exchange_inputs.append(x_exchange[:, [4, 6]])
+        params_x, x_cache = self.hidden_layers_x(np.concatenate(exchange_inputs))
+        params_x = params_x.reshape(len(exchange_inputs), n, -1)
+        params_x_up, params_x_down = params_x[0], params_x[-1]
+
+        arguments = np.stack(
+            [
+                params_c[0][:, 0],
+                params_c[0][:, 1],
+                params_x_up[:, 1],
+                params_x_up[:, 0],
+                params_x_down[:, 1],
+                params_x_down[:, 0],
+            ],
+            axis=1,
+        )
+        if self.constrained:
+            arguments[:, 0] -= params_c[1][:, 0]
+            arguments[:, 1] -= params_c[2][:, 1]
+            arguments[:, [3, 5]] -= self.x_at_constraint[0]
+
+        sigmoid_beta = sigmoid(8 * arguments[:, 0])
+        sigmoid_kappa = sigmoid(4 * (arguments[:, [2, 4]] + 0.5))
+        constants = np.empty_like(arguments)
+        constants[:, 0] = (sigmoid_beta + 1.5) / 2
+        constants[:, [1, 3, 5]] = shifted_elu(arguments[:, [1, 3, 5]])
+        constants[:, [2, 4]] = sigmoid_kappa
+
+        cache = (
+            n,
+            restricted,
+            d_correlation,
+            d_exchange,
+            c_cache,
+            x_cache,
+            arguments,
+            sigmoid_beta,
+            sigmoid_kappa,
+        )
+        return constants * self.true_constants, cache
+
+    def backward(self, grad, cache):
+        """
+        Gradient with respect to the eval_xc inputs of the gradient grad of the constants
+        """
+        (
+            n,
+            restricted,
+            d_correlation,
+            d_exchange,
+            c_cache,
+            x_cache,
+            arguments,
+            sigmoid_beta,
+            sigmoid_kappa,
+        ) = cache
+        grad = grad * self.true_constants
+        grad_arguments = np.empty_like(grad)
+        grad_arguments[:, 0] = grad[:, 0] * 4 * sigmoid_beta * (1 - sigmoid_beta)
+        grad_arguments[:, [1, 3, 5]] = grad[:, [1, 3, 5]] * shifted_elu_derivative(
+            arguments[:, [1, 3, 5]]
+        )
+        grad_arguments[:, [2, 4]] = grad[:, [2, 4]] * 4 * sigmoid_kappa * (1 - sigmoid_kappa)
+
+        # correlation: real, sigma-zero and rho-inf inputs, then their spin swaps
+        grad_params_c = np.zeros((3 if self.constrained else 1, n, 2))
+        grad_params_c[0] = grad_arguments[:, :2]
+        if self.constrained:
+            grad_params_c[1][:, 0] = -grad_arguments[:, 0]
+            grad_params_c[2][:, 1] = -grad_arguments[:, 1]
+        if not restricted:
+            grad_params_c = np.concatenate([grad_params_c, grad_params_c]) / 2
+        grad_inputs = self.hidden_layers_c.backward(grad_params_c.reshape(-1, 2), c_cache)
+        grad_inputs = grad_inputs.reshape(len(grad_params_c), n, -1)
+        if not restricted:
+            half = len(grad_inputs) // 2
+            grad_inputs = grad_inputs[:half] + grad_inputs[half:][:, :, SWAP]
+        grad_correlation = grad_inputs[0]
+        if self.constrained:
+            grad_correlation[:, :2] += grad_inputs[1][:, :2]
+            grad_correlation[:, 2:] += grad_inputs[2][:, 2:]
+
+        # exchange: (mu, kappa) of the spin-up and spin-down inputs
+        grad_up = grad_arguments[:, [3, 2]]
+        grad_down = grad_arguments[:, [5, 4]]
+        grad_params_x = (
+            (grad_up + grad_down)[None] if restricted else np.stack([grad_up, grad_down])
+        )
+        grad_inputs = self.hidden_layers_x.backward(grad_params_x.reshape(-1, 2), x_cache)
+        grad_inputs = grad_inputs.reshape(len(grad_params_x), n, 2)
+        grad_exchange = np.zeros((n, 7))
+        grad_exchange[:, [2, 5]] = grad_inputs[0]
+        if not restricted:
+            grad_exchange[:, [4, 6]] = grad_inputs[1]
+
+        return (
+            descriptors_backward(grad_correlation, d_correlation)
+            + descriptors_backward(grad_exchange, d_exchange) * EXCHANGE_SCALING
+        )
+
+
+class NumpyXALPHA:
+    """
+    MLOptimizer: (N, 1) Xalpha constant of the eval_xc inputs and its backward pass
+    """
+
+    def __init__(self, weights):
+        self.hidden_layers = MLP(weights, "hidden_layers")
+
+    def forward(self, v, restricted=False):
+        x, d = descriptors(v)
+        inputs = [x] if restricted else [x, x[:, SWAP]]
+        h, net_cache = self.hidden_layers(np.concatenate(inputs))
+        exp = np.exp(-0.5 * h)
+        constants = 1.05 * 2 / (1 + exp)
+        constants = np.mean(constants.reshape(len(inputs), len(v), -1), axis=0)
+        return constants, (len(inputs), d, net_cache, exp)
+
+    def backward(self, grad, cache):
+        n_inputs, d, net_cache, exp = cache
+        grad_h = np.concatenate([grad] * n_inputs) / n_inputs * 1.05 * exp / (1 + exp) ** 2
+        grad_inputs = self.hidden_layers.backward(grad_h, net_cache)
+        grad_inputs = grad_inputs.reshape(n_inputs, len(grad), -1)
+        grad_x = grad_inputs[0] if n_inputs == 1 else grad_inputs[0] + grad_inputs[1][:, SWAP]
+        return descriptors_backward(grad_x, d)
+
+
+def pbe_derivatives(rho, sigmas, c):
+    """
+    dft_functionals.PBE.F_PBE_derivatives with the varying constants:
+    c : the 26 columns of c_arr, (N,) or (1,) arrays.
+    Returns F_PBE (N,), de/drho (N, 2), de/dsigma (N, 3) and de/dc[PBE_VARYING] (N, 6)
+    """
+    eps_add = 1e-7
+    eps_add_rho = 1e-10
+    eps_add_sigma = eps_add_rho ** (8 / 3)
+    eps = 1e-29
+
+    n = rho[:, 0] + rho[:, 1]
+    rs = (3 / ((n + eps_add) * (4 * np.pi))) ** (1 / 3)
+    z = (rho[:, 0] - rho[:, 1]) / (n + eps_add)
+    same_spin = (sigmas[:, 2] < eps) & (rho[:, 1] < eps)  # xs1 is taken from alpha
+    xs0 = np.sqrt(sigmas[:, 0] + eps_add_sigma) / (rho[:, 0] + eps_add_rho) ** (4 / 3)
+    xs1 = np.where(
+        same_spin, xs0, np.sqrt(sigmas[:, 2] + eps_add_sigma) / (rho[:, 1] + eps_add_rho) ** (4 / 3)
+    )
+    sigma_tot = sigmas[:, 0] + 2 * sigmas[:, 1] + sigmas[:, 2] + eps_add_sigma
+    xt = np.sqrt(sigma_tot) / (n + eps_add_rho) ** (4 / 3)
+    sqrt_rs = np.sqrt(rs)
+    opz13 = (1 + z) ** (1 / 3)
+    omz13 = (1 - z) ** (1 / 3)
+    opz43 = (1 + z) ** (4 / 3)
+    omz43 = (1 - z) ** (4 / 3)
+
+    # PW92 correlation
+    def pw_g_derivative(k):
+        g_aux = c[3 + k] * sqrt_rs + c[6 + k] * rs + c[9 + k] * rs * sqrt_rs + c[12 + k] * rs * rs
+        dg_aux = c[3 + k] / (2 * sqrt_rs) + c[6 + k] + 1.5 * c[9 + k] * sqrt_rs + 2 * c[12 + k] * rs
+        u = 1 / (2 * c[15 + k] * g_aux)
+        log = np.log1p(u)
+        g = -2 * c[15 + k] * (1 + c[18 + k] * rs) * log
+        dg = -2 * c[15 + k] * c[18 + k] * log + 2 * c[15 + k] * (
+            1 + c[18 + k] * rs
+        ) * u * dg_aux / (g_aux * (1 + u))
+        return g, dg
+
+    g0, dg0 = pw_g_derivative(0)
+    g1, dg1 = pw_g_derivative(1)
+    g2, dg2 = pw_g_derivative(2)
+    g2_fz20, dg2_fz20 = g2 / c[2], dg2 / c[2]
+    f_zeta = (opz43 + omz43 - 2) / (2 ** (4 / 3) - 2)
+    df_zeta = 4 / 3 * (opz13 - omz13) / (2 ** (4 / 3) - 2)
+    bracket = g1 - g0 + g2_fz20
+    f_pw = g0 + z**4 * f_zeta * bracket - f_zeta * g2_fz20
+    df_pw_drs = dg0 + z**4 * f_zeta * (dg1 - dg0 + dg2_fz20) - f_zeta * dg2_fz20
+    df_pw_dz = (4 * z**3 * f_zeta + z**4 * df_zeta) * bracket - df_zeta * g2_fz20
+
+    # PBE gradient correction H
+    beta, gamma = c[0], c[1]
+    mphi = ((1 + z) ** (2 / 3) + (1 - z) ** (2 / 3)) / 2
+    dmphi = ((1 + z) ** (-1 / 3) - (1 - z) ** (-1 / 3)) / 3
+    gamma_mphi3 = gamma * mphi**3
+    ratio = -f_pw / gamma_mphi3
+    below = ratio < 87
+    expm1 = np.expm1(np.where(below, ratio, 87.0))
+    A = beta / (gamma * expm1)
+    t_denominator = 4 * 2 ** (1 / 3) * mphi * sqrt_rs
+    t = xt / t_denominator
+    t2 = t**2
+    f1 = t2 + A * t2**2
+    P = A * f1 + 1
+    f2 = beta * f1 / (gamma * P)
+    f2_shifted = np.where(f2 <= -1, f2 + 10e-8, f2)
+    log = np.log1p(f2_shifted)
+    dlog = 1 / (1 + f2_shifted)
+    correlation = f_pw + gamma_mphi3 * log
+
+    # derivatives of H, accumulated backwards through f2 -> A -> ratio
+    bar_f2 = gamma_mphi3 * dlog
+    df2_common = beta / (gamma * P**2)
+    bar_A = bar_f2 * df2_common * (t2**2 - f1**2)
+    bar_t2 = bar_f2 * df2_common * (1 + 2 * A * t2)
+    bar_ratio = np.where(below, -bar_A * A * (expm1 + 1) / expm1, 0.0)
+    dEc_dfpw = 1 - bar_ratio / gamma_mphi3
+    dEc_dmphi = 3 * gamma * mphi**2 * log - 2 * t2 * bar_t2 / mphi - 3 * ratio * bar_ratio / mphi
+    dEc_drs = dEc_dfpw * df_pw_drs - t2 * bar_t2 / rs
+    dEc_dz = dEc_dfpw * df_pw_dz + dEc_dmphi * dmphi
+    dEc_dxt = bar_t2 * 2 * t / t_denominator
+    dEc_dbeta = bar_f2 * f1 / (gamma * P) + bar_A / (gamma * expm1)
+    dEc_dgamma = (
+        mphi**3 * log - bar_f2 * f2 / gamma - bar_A * A / gamma - bar_ratio * ratio / gamma
+    )
+
+    # spin-resolved PBE exchange
+    lda_factor = c[21] * 2 ** (-4 / 3) * (3 / (4 * np.pi)) ** (1 / 3) / rs
+    X2S = 1 / (2 * (6 * np.pi**2) ** (1 / 3))
+    s2_up = (X2S * xs0) ** 2
+    s2_down = (X2S * xs1) ** 2
+    ratio_up = c[22] / (c[22] + c[23] * s2_up)
+    ratio_down = c[24] / (c[24] + c[25] * s2_down)
+    fx_up = 1 + c[22] * (1 - ratio_up)
+    fx_down = 1 + c[24] * (1 - ratio_down)
+    exchange_up = lda_factor * opz43 * fx_up
+    exchange_down = lda_factor * omz43 * fx_down
+    energy = exchange_up + exchange_down + correlation
+
+    up = lda_factor * opz43
+    down = lda_factor * omz43
+    dF_drs = -(exchange_up + exchange_down) / rs + dEc_drs
+    dF_dz = 4 / 3 * lda_factor * (opz13 * fx_up - omz13 * fx_down) + dEc_dz
+    dF_dxs0 = up * c[23] * ratio_up**2 * 2 * X2S**2 * xs0
+    dF_dxs1 = down * c[25] * ratio_down**2 * 2 * X2S**2 * xs1
+
+    # chain rule to the densities and contracted gradients
+    xs1_alpha = np.where(same_spin, dF_dxs1 * xs1, 0.0)
+    xs1_beta = np.where(same_spin, 0.0, dF_dxs1 * xs1)
+    drs_dn = -rs / (3 * (n + eps_add))
+    dF_dxt_dn = -4 / 3 * dEc_dxt * xt / (n + eps_add_rho)
+    dF_dra = (
+        dF_drs * drs_dn
+        + dF_dz * (1 - z) / (n + eps_add)
+        - 4 / 3 * (dF_dxs0 * xs0 + xs1_alpha) / (rho[:, 0] + eps_add_rho)
+        + dF_dxt_dn
+    )
+    dF_drb = (
+        dF_drs * drs_dn
+        - dF_dz * (1 + z) / (n + eps_add)
+        - 4 / 3 * xs1_beta / (rho[:, 1] + eps_add_rho)
+        + dF_dxt_dn
+    )
+    dF_dsaa = (dF_dxs0 * xs0 + xs1_alpha) / (2 * (sigmas[:, 0] + eps_add_sigma)) + dEc_dxt * xt / (
+        2 * sigma_tot
+    )
+    dF_dsab = dEc_dxt * xt / sigma_tot
+    dF_dsbb = xs1_beta / (2 * (sigmas[:, 2] + eps_add_sigma)) + dEc_dxt * xt / (2 * sigma_tot)
+
+    vrho = np.stack([energy + n * dF_dra, energy + n * dF_drb], axis=1)
+    vsigma = n[:, None] * np.stack([dF_dsaa, dF_dsab, dF_dsbb], axis=1)
+    dF_dc = [
+        dEc_dbeta,
+        dEc_dgamma,
+        up * (1 - ratio_up) ** 2,
+        up * s2_up * ratio_up**2,
+        down * (1 - ratio_down) ** 2,
+        down * s2_down * ratio_down**2,
+    ]
+    vconstants = n[:, None] * np.stack([np.broadcast_to(d, n.shape) for d in dF_dc], axis=1)
+    return energy, vrho, vsigma, vconstants
+
+
+def xalpha_derivatives(rho, constant):
+    """
+    dft_functionals.SVWN3.F_XALPHA_derivatives:
+    F_XALPHA (N,), de/drho (N, 2) and de/dconstant (N, 1)
+    """
+    eps = 1e-29
+    n = rho[:, 0] + rho[:, 1]
+    cube_root = (n + eps) ** (1 / 3)
+    energy = constant[:, 0] * XALPHA_PARAM * cube_root
+    vrho_total = energy + n * energy / (3 * (n + eps))
+    return energy, np.stack([vrho_total, vrho_total], axis=1), (n * XALPHA_PARAM * cube_root)[:, None]
+
+
+def libxc_vxc(vrho, vsigma, nn_grads, spin):
+    """
+    NN_FUNCTIONAL.libxc_vxc with the (N, 7) gradients of the NN
+    with respect to the eval_xc_inputs
+    """
+    vrho_a = vrho[:, 0] + nn_grads[:, 0]
+    vrho_b = vrho[:, 1] + nn_grads[:, 1]
+    vsigma_a = vsigma[:, 0] - vsigma[:, 1] / 2 + nn_grads[:, 2]
+    vsigma_tot = vsigma[:, 1] / 2 + nn_grads[:, 3]
+    vsigma_b = vsigma[:, 2] - vsigma[:, 1] / 2 + nn_grads[:, 4]
+    vtau_a, vtau_b = nn_grads[:, 5], nn_grads[:, 6]
+
+    if spin == 0:
+        vtau = (vtau_a + vtau_b) / 2
+        return (
+            (vrho_a + vrho_b) / 2,
+            vsigma_a / 4 + vsigma_b / 4 + vsigma_tot,
+            np.zeros_like(vtau),
+            vtau,
+        )
+    vtau = np.stack([vtau_a, vtau_b], axis=1)
+    vsigma = np.stack([vsigma_a + vsigma_tot, 2 * vsigma_tot, vsigma_b + vsigma_tot], axis=1)
+    return np.stack([vrho_a, vrho_b], axis=1), vsigma, np.zeros_like(vtau), vtau
+
+
+def weights_path(path_to_model_state_dict):
+    return Path(path_to_model_state_dict).with_suffix(".npz")
+
+
+def weights_key(path_to_model_state_dict):
+    """
+    WEIGHTS_FORMAT and the sha256 of the checkpoint the weights are exported from
+    """
+    digest = hashlib.sha256(Path(path_to_model_state_dict).read_bytes()).hexdigest()
+    return f"{WEIGHTS_FORMAT}:{digest}"
+
+
+def export_weights(state_dict, path_to_model_state_dict, true_constants_PBE):
+    """
+    Saves the numpy arrays of the state dict of a checkpoint next to it for
+    load_weights. The file is written under a temporary name and moved into place
+    """
+    path = weights_path(path_to_model_state_dict)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(
+            file,
+            key=np.array(weights_key(path_to_model_state_dict)),
+            true_constants_PBE=true_constants_PBE,
+            **state_dict,
+        )
+    os.replace(temporary_path, path)
+    return path
+
+
+def load_weights(path_to_model_state_dict):
+    """
+    Weights saved by export_weights, None if they are missing or were exported
+    from another checkpoint or in another format. Without the checkpoint
+    (weights shipped alone) only the format is checked
+    """
+    path = weights_path(path_to_model_state_dict)
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        key = str(data["key"]) if "key" in data.files else ""
+        weights = {name: data[name].astype(np.float64) for name in data.files if name != "key"}
+    if os.path.exists(path_to_model_state_dict):
+        current = key == weights_key(path_to_model_state_dict)
+    else:
+        current = key.split(":")[0] == str(WEIGHTS_FORMAT)
+    return weights if current else None
+
+
+def model_from_weights(weights, name):
+    """
+    NumPy model of the functional name from the weights of load_weights
+    """
+    if "star_star" in name:
+        raise ValueError(f"{name} is not available with the numpy backend")
+    if "PBE_star" in name:
+        return NumpyPBE(weights, constrained=False)
+    if "PBE" in name:
+        return NumpyPBE(weights)
+    return NumpyXALPHA(weights)
+
+
+class NumpyFunctional:
+    """
+    pyscf eval_xc of an NN functional evaluated with NumPy only.
+    torch is imported for fxc (deriv > 1) and to export missing or stale weights
+    """
+
+    def __init__(self, name):
+        if "star_star" in name:
+            raise ValueError(f"{name} is not available with the numpy backend")
+        self.name = name
+        self.path_to_model_state_dict = checkpoint_path(name)
+        weights = load_weights(self.path_to_model_state_dict)
+        if weights is None:
+            from .functional import export_numpy_weights
+
+            export_numpy_weights(name)
+            weights = load_weights(self.path_to_model_state_dict)
+        self.model = model_from_weights(weights, name)
+        self.constants = list(weights["true_constants_PBE"].T)
+        self.fxc_functional = None
+
+    def exc_vxc(self, rho, spin):
+        """
+        exc and the pyscf MGGA vxc (vrho, vsigma, vlapl, vtau)
+        """
+        inputs = eval_xc_inputs(rho, spin)
+        nn_inputs = inputs.copy()
+        nn_inputs[:, :2] += EPS_RHO
+        constants, cache = self.model.forward(nn_inputs, restricted=spin == 0)
+
+        densities = inputs[:, :2]
+        sigma_ab = (inputs[:, 3] - inputs[:, 2] - inputs[:, 4]) / 2
+        if "PBE" in self.name:
+            c = list(self.constants)
+            for i, column in enumerate(PBE_VARYING):
+                c[column] = constants[:, i]
+            sigmas = np.stack([inputs[:, 2], sigma_ab, inputs[:, 4]], axis=1)
+            exc, vrho, vsigma, vconstants = pbe_derivatives(densities, sigmas, c)
+        else:
+            exc, vrho, vconstants = xalpha_derivatives(densities, constants)
+            vsigma = np.zeros((len(inputs), 3))
+
+        nn_grads = self.model.backward(vconstants, cache)
+        return exc, libxc_vxc(vrho, vsigma, nn_grads, spin)
+
+    def eval_fxc(self, rho, spin):
+        if self.fxc_functional is None:
+            from .functional import NN_FUNCTIONAL
+
+            self.fxc_functional = NN_FUNCTIONAL(self.name)
+        return self.fxc_functional.eval_fxc(rho, spin)
+
+    def eval_xc(
+        self, xc_code, rho, spin, relativity=0, deriv=1, omega=None, verbose=None
+    ):
+        exc, vxc = self.exc_vxc(rho, spin)
+        fxc = self.eval_fxc(rho, spin) if deriv > 1 else None
+        return exc, vxc, fxc, None
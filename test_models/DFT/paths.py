@@ -0,0 +1,50 @@
+"""
+Checkpoints of the NN functionals, importable without torch
+"""
+
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+relative_path_to_model_state_dict = {
+    "NN_PBE": "checkpoints/NN_PBE/state_dict.pth",
+    "NN_XALPHA": "checkpoints/NN_XALPHA/state_dict.pth",
+}
+
+omega_str_list = ["0", "0076", "067", "18", "33", "50", "67", "82", "93", "99"]
+
+relative_path_to_model_state_dict.update(
+    {
+        f"NN_XALPHA_{omega}": f"checkpoints/NN_XALPHA/state_dict_0.{omega}.pth"
+        for omega in omega_str_list
+    }
+)
+relative_path_to_model_state_dict.update(
+    {
+        f"NN_PBE_{omega}": f"checkpoints/NN_PBE/state_dict_0.{omega}.pth"
+        for omega in omega_str_list
+    }
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_XALPHA_100": f"checkpoints/NN_XALPHA/state_dict_1.pth"}
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_PBE_100": f"checkpoints/NN_PBE/state_dict_1.pth"}
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_PBE_star": f"checkpoints/NN_PBE/state_dict_star_0.067.pth"}
+)
+relative_path_to_model_state_dict.update(
+    {
+        f"NN_PBE_star_star_{omega}": f"checkpoints/NN_PBE/state_dict_star_star_0.{omega}.pth"
+        for omega in omega_str_list
+    }
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_PBE_star_star_100": f"checkpoints/NN_PBE/state_dict_star_star_1.pth"}
+)
+
+omega_str_list.append("100")
+
+
+def checkpoint_path(name):
+    return dir_path + "/" + relative_path_to_model_state_dict[name]
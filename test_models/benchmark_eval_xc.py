@@ -0,0 +1,112 @@
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+from pathlib import Path
+
+import numpy as np
+
+from DFT.functional import NN_FUNCTIONAL, export_graph, graph_path
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def cold_start(name, backend):
+    """
+    Seconds from a fresh interpreter to a constructed functional, the imports
+    included: NN_FUNCTIONAL for torch, numpy_backend.NumpyFunctional for numpy
+    """
+    if backend == "numpy":
+        construct = f"from DFT.numpy_backend import NumpyFunctional; NumpyFunctional({name!r}); "
+    else:
+        construct = f"from DFT.functional import NN_FUNCTIONAL; NN_FUNCTIONAL({name!r}); "
+    code = (
+        "import sys, time; start = time.perf_counter(); "
+        + construct
+        + "print(time.perf_counter() - start, 'torch' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    seconds, torch_imported = output.split()[-2:]
+    return float(seconds), torch_imported == "True"
+
+
+def benchmark_eval_xc(name, block_sizes, repeat, export=False):
+    """
+    Per-call latency of the eager NN_FUNCTIONAL.eval_xc, of the frozen
+    TorchScript graph and of the numpy backend on grid blocks of the sizes
+    pyscf passes to eval_xc
+    """
+    eager = NN_FUNCTIONAL(name, density_threshold=0)
+    numpy_functional = NN_FUNCTIONAL(name, density_threshold=0, backend="numpy")
+    for backend in ("torch", "numpy"):
+        seconds, torch_imported = cold_start(name, backend)
+        print(f"Cold start, {backend}: {seconds:.3f} s (torch imported: {torch_imported})")
+    if export:
+        export_graph(eager, graph_path(eager.path_to_model_state_dict))
+    graph = NN_FUNCTIONAL(name, density_threshold=0, graph=True)
+
+    print(
+        f"{'Spin':>4} {'Block':>8} {'eager, ms':>10} {'graph, ms':>10} {'numpy, ms':>10} "
+        f"{'max |dvxc|':>11}"
+    )
+    for spin in (0, 1):
+        for block_size in block_sizes:
+            rho = eager.probe_rho(block_size)
+            rho = rho[0] if spin == 0 else rho
+            reference = eager.eval_xc("", rho, spin)
+            max_error = max(
+                np.max(np.abs(a - b))
+                for functional in (graph, numpy_functional)
+                for a, b in zip(reference[1], functional.eval_xc("", rho, spin)[1])
+            )
+
+            eager_time = timed(lambda: eager.eval_xc("", rho, spin), repeat)
+            graph_time = timed(lambda: graph.eval_xc("", rho, spin), repeat)
+            numpy_time = timed(lambda: numpy_functional.eval_xc("", rho, spin), repeat)
+            print(
+                f"{spin:>4} {block_size:>8} {eager_time * 1e3:>10.2f} "
+                f"{graph_time * 1e3:>10.2f} {numpy_time * 1e3:>10.2f} {max_error:>11.2e}"
+            )
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+        "--Functional", type=str, default="NN_PBE_067", help="Functional to benchmark"
+    )
+    parser.add_option(
+        "--Blocks",
+        type=str,
+        default="128,1024,4096,16384",
+        help="Comma-separated numbers of grid points per eval_xc call",
+    )
+    parser.add_option(
+        "--Repeat", type=int, default=10, help="Number of timing repetitions"
+    )
+    parser.add_option(
+        "--Export",
+        action="store_true",
+        default=False,
+        help="Export the TorchScript graph again even if it exists",
+    )
+    (Opts, args) = parser.parse_args()
+
+    benchmark_eval_xc(
+        Opts.Functional,
+        [int(block) for block in Opts.Blocks.split(",")],
+        Opts.Repeat,
+        Opts.Export,
+    )
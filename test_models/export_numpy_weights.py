@@ -0,0 +1,16 @@
+from optparse import OptionParser
+
+from DFT.functional import export_numpy_weights
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+        "--Functional",
+        type=str,
+        default="NN_PBE_067,NN_PBE_star,NN_XALPHA_067",
+        help="Comma-separated functionals to export for the numpy backend",
+    )
+    (Opts, args) = parser.parse_args()
+
+    for name in Opts.Functional.split(","):
+        export_numpy_weights(name)
@@ -4,9 +4,6 @@ import dftd3.pyscf as disp
 from pyscf import dft, gto, lib
 from pyscf.scf import addons, diis
 
-from DFT.functional import NN_FUNCTIONAL
-from pcNN_mol.dft_pcnn import model as Nagai_model
-
 PROBLEMATIC_SYSTEMS = [
     "G21EA-14-EA_14",
     "G21EA-14-EA_14n",
@@ -73,13 +70,39 @@ def get_PBE0_density(mf):
     return mf, dm0
 
 
-def calculate_functional_energy(mf, functional_name, dm0=None, system_name=None):
+def calculate_functional_energy(
+    mf,
+    functional_name,
+    dm0=None,
+    system_name=None,
+    chunk_size=None,
+    memory_budget=None,
+    graph=True,
+    exchange_tolerance=None,
+    backend="torch",
+):
     print(functional_name)
 
+    # torch is imported only by the Nagai and the torch NN functionals
     if functional_name == "Nagai":
+        from pcNN_mol.dft_pcnn import model as Nagai_model
+
         mf.define_xc_(Nagai_model.eval_xc, "MGGA")
+    elif backend == "numpy":
+        from DFT.numpy_backend import NumpyFunctional
+
+        model = NumpyFunctional(functional_name)
+        mf.define_xc_(model.eval_xc, "MGGA")
     else:
-        model = NN_FUNCTIONAL(functional_name)
+        from DFT.functional import NN_FUNCTIONAL
+
+        model = NN_FUNCTIONAL(
+            functional_name,
+            chunk_size=chunk_size,
+            memory_budget=memory_budget,
+            graph=graph,
+            exchange_tolerance=exchange_tolerance,
+        )
         mf.define_xc_(model.eval_xc, "MGGA")
     mf.conv_tol = 1e-6
     mf.conv_tol_grad = 1e-3
@@ -92,7 +115,13 @@ def calculate_functional_energy(mf, functional_name, dm0=None, system_name=None)
 
     mf.callback = log_convergence
 
-    if system_name in PROBLEMATIC_SYSTEMS:
+    if system_name in PROBLEMATIC_SYSTEMS and functional_name != "Nagai":
+        # second-order SCF, NN_FUNCTIONAL.eval_xc provides the fxc kernel
+        mf = mf.newton()
+        mf.max_cycle = 50
+        energy = mf.kernel(dm0=dm0)
+
+    elif system_name in PROBLEMATIC_SYSTEMS:
 
         mf.level_shift = 1.0
         mf.damp = 0.7
@@ -163,7 +192,16 @@ def calculate_non_nn_functional_energy(mf, functional_name):
     return energy + d3_energy
 
 
-def main(system_name, functional, NFinal):
+def main(
+    system_name,
+    functional,
+    NFinal,
+    chunk_size=None,
+    memory_budget=None,
+    graph=True,
+    exchange_tolerance=None,
+    backend="torch",
+):
 
     lib.num_threads(4)
     print("\n\n", system_name, "\n\n")
@@ -177,7 +215,15 @@ def main(system_name, functional, NFinal):
     print(f"\n\n{functional} calculation \n\n")
     try:
         corrected_energy = calculate_functional_energy(
-            mf, functional, dm0=dm0, system_name=system_name
+            mf,
+            functional,
+            dm0=dm0,
+            system_name=system_name,
+            chunk_size=chunk_size,
+            memory_budget=memory_budget,
+            graph=graph,
+            exchange_tolerance=exchange_tolerance,
+            backend=backend,
         )
     except Exception as E:
         print(E)
@@ -228,6 +274,37 @@ if __name__ == "__main__":
     parser.add_option(
         "--NFinal", type=int, default=30, help="Number of systems to select"
     )
+    parser.add_option(
+        "--Chunk_size",
+        type=int,
+        default=0,
+        help="Grid points per chunk of the NN functional evaluation (0 for no chunking)",
+    )
+    parser.add_option(
+        "--Memory_budget",
+        type=float,
+        default=0,
+        help="Memory for the NN graph of one chunk in MB, sets Chunk_size if > 0",
+    )
+    parser.add_option(
+        "--Eager",
+        action="store_true",
+        default=False,
+        help="Evaluate the NN functional eagerly instead of the exported TorchScript graph",
+    )
+    parser.add_option(
+        "--Exchange_table",
+        type=float,
+        default=0,
+        help="Tolerance of the tabulated exchange subnetwork of the PBE models (0 evaluates the MLP)",
+    )
+
+    parser.add_option(
+        "--Backend",
+        type=str,
+        default="torch",
+        help="torch or numpy, numpy evaluates the NN functional without importing torch (no chunking)",
+    )
 
     (Opts, args) = parser.parse_args()
 
@@ -239,6 +316,15 @@ if __name__ == "__main__":
     if dispersion:
         calculate_dispersions()
     elif "NN" in functional or functional == "Nagai":
-        main(system_name, functional, NFinal)
+        main(
+            system_name,
+            functional,
+            NFinal,
+            chunk_size=Opts.Chunk_size,
+            memory_budget=Opts.Memory_budget * 2**20,
+            graph=not Opts.Eager and Opts.Backend == "torch",
+            exchange_tolerance=Opts.Exchange_table,
+            backend=Opts.Backend,
+        )
     else:
         test_non_nn_functional(system_name, functional, NFinal)
@@ -4,12 +4,14 @@ from DFT.functional import NN_FUNCTIONAL
 from script import get_coords_charge_spin, initialize_molecule
 
 
-def calculate_functional_energy(mf, functional_name):
+def calculate_functional_energy(mf, functional_name, newton=False):
 
     print(functional_name)
 
     model = NN_FUNCTIONAL(functional_name)
     mf.define_xc_(model.eval_xc, "MGGA")
+    if newton:
+        mf = mf.newton()
     mf.conv_tol = 1e-15
     mf.max_cycle = 50
 
@@ -18,11 +20,11 @@ def calculate_functional_energy(mf, functional_name):
     return energy
 
 
-def main(functional_name):
+def main(functional_name, newton=False):
 
     coords, charge, spin = get_coords_charge_spin("DC13-1-ISO_P36")
     _, mf = initialize_molecule(coords, charge, spin)
-    calculate_functional_energy(mf, functional_name)
+    calculate_functional_energy(mf, functional_name, newton)
 
 
 if __name__ == "__main__":
@@ -31,8 +33,14 @@ if __name__ == "__main__":
     parser.add_option(
         "--Functional", type="string", default="NN_PBE_0", help="Functional to evaluate"
     )
+    parser.add_option(
+        "--Newton",
+        action="store_true",
+        default=False,
+        help="Second-order SCF with the fxc kernel of the NN functional",
+    )
     (Opts, args) = parser.parse_args()
 
     Functional = Opts.Functional
 
-    main(functional_name=Functional)
+    main(functional_name=Functional, newton=Opts.Newton)
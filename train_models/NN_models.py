@@ -7,7 +7,7 @@ import torch
 from torch import nn
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from dft_functionals import true_constants_PBE
+from dft_functionals import true_varying_constants_PBE
 
 random.seed(42)
 
@@ -16,6 +16,32 @@ device = torch.device("cuda") if torch.cuda.is_available else torch.device("cpu"
 sigmoid = torch.nn.Sigmoid()
 elu = torch.nn.ELU()
 
+# descriptor columns with the spin-up and spin-down densities, gradients and tau swapped
+SPIN_SWAP = [1, 0, 4, 3, 2, 6, 5]
+
+
+def spin_symmetric_inputs(x):
+    """
+    Network inputs of the spin symmetrization (f(x) + f(x[:, SPIN_SWAP])) / 2
+    with a single pass for the rows equal to their swap: every row of x, with the
+    symmetric rows as (x + x[:, SPIN_SWAP]) / 2 (the same values, and the gradient
+    of the two-pass average), and the swapped asymmetric rows.
+    Returns the two inputs and the indices of the asymmetric rows
+    """
+    swapped = x[:, SPIN_SWAP]
+    symmetric = torch.all(x == swapped, dim=1, keepdim=True)
+    asymmetric = torch.nonzero(~symmetric[:, 0]).squeeze(1)
+    return torch.where(symmetric, (x + swapped) / 2, x), swapped[asymmetric], asymmetric
+
+
+def spin_symmetrized(outputs, swapped_outputs, asymmetric):
+    """
+    outputs of spin_symmetric_inputs with the asymmetric rows averaged over the swap
+    """
+    average = (outputs[asymmetric] + swapped_outputs) / 2
+    return outputs.index_copy(0, asymmetric, average)
+
+
 """
 Define an nn.Module class for a simple residual block with equal dimensions
 """
@@ -47,6 +73,10 @@ class ResBlock(nn.Module):
 
 
 class MLOptimizer(nn.Module):
+    # evaluate the network once for the rows equal to their spin swap,
+    # exact up to the first derivatives (False for the second derivatives and vmap)
+    dedup_symmetric_rows = True
+
     def __init__(self, num_layers, h_dim, nconstants, dropout, DFT=None, constants=[]):
         super().__init__()
 
@@ -144,28 +174,184 @@ class MLOptimizer(nn.Module):
 
         return X
 
-    def forward(self, x):
+    def forward_from_descriptors(self, x, restricted=False):
         """
         Returns:
             spin-symmetrized enhancement factor for LDA exhange energy
         """
 
-        x = self.get_density_descriptors(x)
+        if restricted:  # the spin-swapped descriptors are the same
+            return self.unsymm_forward(x)
+
+        if not self.dedup_symmetric_rows:
+            return (self.unsymm_forward(x) + self.unsymm_forward(x[:, SPIN_SWAP])) / 2
+
+        inputs, swapped, asymmetric = spin_symmetric_inputs(x)
+        outputs = self.unsymm_forward(torch.cat([inputs, swapped]))
+        return spin_symmetrized(
+            outputs[: x.shape[0]], outputs[x.shape[0] :], asymmetric
+        )
+
+    def forward(self, x, descriptors=None, restricted=False):
+        """
+        descriptors : optional precomputed get_descriptor_columns(x),
+        the descriptors are not recomputed from x then
+        restricted : all grid points have rho_a == rho_b, sigma_aa == sigma_bb
+        and tau_a == tau_b, the spin symmetrization is skipped then
+        """
+
+        if descriptors is None:
+            x = self.get_density_descriptors(x)
+        else:
+            x = descriptors[:, :7]
+
+        return self.forward_from_descriptors(x, restricted=restricted)
 
-        result = (
-            self.unsymm_forward(x) + self.unsymm_forward(x[:, [1, 0, 4, 3, 2, 6, 5]])
-        ) / 2
 
+# (tanh s, tanh(alpha - 1)) input square of the exchange subnetwork
+EXCHANGE_BOUNDS = ((0.0, 1.0), (-1.0, 1.0))
+
+
+def hermite_basis(t):
+    """
+    Cubic Hermite basis: values at the nodes 0 and 1, derivatives at the nodes 0 and 1
+    """
+    t2, t3 = t**2, t**3
+    return 2 * t3 - 3 * t2 + 1, -2 * t3 + 3 * t2, t3 - 2 * t2 + t, t3 - t2
+
+
+class ExchangeTable(nn.Module):
+    """
+    Bicubic Hermite interpolation of an exchange subnetwork on an n_grid x n_grid
+    table over EXCHANGE_BOUNDS. The values, first and mixed derivatives at the nodes
+    are taken from the subnetwork, the interpolant is differentiable by autograd
+    """
+
+    def __init__(self, layers, n_grid, bounds=EXCHANGE_BOUNDS):
+        super().__init__()
+        parameter = next(layers.parameters())
+        lower = torch.tensor([b[0] for b in bounds], dtype=parameter.dtype)
+        upper = torch.tensor([b[1] for b in bounds], dtype=parameter.dtype)
+        step = (upper - lower) / (n_grid - 1)
+        nodes = torch.cartesian_prod(
+            *(torch.linspace(b[0], b[1], n_grid, dtype=parameter.dtype) for b in bounds)
+        ).to(parameter.device)
+
+        with torch.enable_grad():
+            nodes.requires_grad_(True)
+            values = layers(nodes)
+            columns = []
+            for c in range(values.shape[1]):
+                (d,) = torch.autograd.grad(values[:, c].sum(), nodes, create_graph=True)
+                (dxy,) = torch.autograd.grad(d[:, 0].sum(), nodes, retain_graph=True)
+                columns.append(
+                    torch.stack(
+                        [
+                            values[:, c],
+                            d[:, 0] * step[0],
+                            d[:, 1] * step[1],
+                            dxy[:, 1] * step[0] * step[1],
+                        ],
+                        dim=1,
+                    )
+                )
+        table = torch.stack(columns, dim=2).detach().view(n_grid, n_grid, 4, -1)
+
+        self.n_grid = n_grid
+        # not in the state dict, the table is rebuilt from the checkpoint
+        self.register_buffer("table", table, persistent=False)
+        self.register_buffer("lower", lower.to(parameter.device), persistent=False)
+        self.register_buffer("step", step.to(parameter.device), persistent=False)
+
+    def forward(self, x):
+        u = (x - self.lower) / self.step
+        cell = torch.clamp(torch.floor(u.detach()), 0, self.n_grid - 2).long()
+        t = torch.clamp(u - cell, 0, 1)
+        basis_s = hermite_basis(t[:, 0:1])
+        basis_tau = hermite_basis(t[:, 1:2])
+
+        result = 0
+        for a in (0, 1):
+            for b in (0, 1):
+                corner = self.table[cell[:, 0] + a, cell[:, 1] + b]
+                result = (
+                    result
+                    + corner[:, 0] * basis_s[a] * basis_tau[b]
+                    + corner[:, 1] * basis_s[2 + a] * basis_tau[b]
+                    + corner[:, 2] * basis_s[a] * basis_tau[2 + b]
+                    + corner[:, 3] * basis_s[2 + a] * basis_tau[2 + b]
+                )
         return result
 
 
+def input_gradients(function, x):
+    """
+    (N, outputs, inputs) gradients of a row-wise function at the points x
+    """
+    with torch.enable_grad():
+        x = x.detach().requires_grad_(True)
+        y = function(x)
+        gradients = [
+            torch.autograd.grad(y[:, i].sum(), x, retain_graph=True)[0] for i in range(y.shape[1])
+        ]
+    return torch.stack(gradients, dim=1)
+
+
+def exchange_table(
+    layers, tolerance=1e-6, n_grid=33, max_grid=1025, n_check=100_000, bounds=EXCHANGE_BOUNDS
+):
+    """
+    ExchangeTable of layers on the coarsest of the grids n_grid, 2 * n_grid - 1, ...
+    whose max errors of the values and of the input gradients against layers
+    on n_check random points are both below tolerance.
+    Returns the table and its error (the larger of the two)
+    """
+    parameter = next(layers.parameters())
+    generator = torch.Generator().manual_seed(0)
+    lower = torch.tensor([b[0] for b in bounds], dtype=parameter.dtype)
+    upper = torch.tensor([b[1] for b in bounds], dtype=parameter.dtype)
+    x = lower + (upper - lower) * torch.rand(
+        n_check, len(bounds), generator=generator, dtype=parameter.dtype
+    )
+    x = x.to(parameter.device)
+    with torch.no_grad():
+        reference = layers(x)
+    reference_gradients = input_gradients(layers, x)
+
+    while True:
+        table = ExchangeTable(layers, n_grid, bounds)
+        with torch.no_grad():
+            value_error = torch.max(torch.abs(table(x) - reference)).item()
+        gradient_error = torch.max(
+            torch.abs(input_gradients(table, x) - reference_gradients)
+        ).item()
+        error = max(value_error, gradient_error)
+        if error < tolerance:
+            return table, error
+        if n_grid >= max_grid:
+            raise ValueError(
+                f"Exchange table errors (values {value_error:.2e}, gradients "
+                f"{gradient_error:.2e}) are above the tolerance {tolerance:.2e} "
+                f"with {n_grid}x{n_grid} nodes"
+            )
+        n_grid = 2 * n_grid - 1
+
+
 class pcPBEMLOptimizer(nn.Module):
+    # run every subnetwork once over the concatenated inputs of one forward,
+    # False evaluates them input by input (kept for benchmarking)
+    batch_subnetworks = True
+    # see MLOptimizer.dedup_symmetric_rows
+    dedup_symmetric_rows = True
+
     def __init__(
         self, num_layers, h_dim, nconstants_x=2, nconstants_c=2, dropout=0.2, DFT=None
     ):
         super().__init__()
 
         self.DFT = DFT
+        # ExchangeTable evaluated instead of hidden_layers_x, see tabulate_exchange
+        self.exchange_table = None
 
         modules_x = []  # NN part for exchange
         modules_c = []  # NN part for correlation
@@ -310,43 +496,117 @@ class pcPBEMLOptimizer(nn.Module):
 
         return X
 
-    def get_exchange_descriptors(self, x):
+    @classmethod
+    def get_exchange_descriptors(cls, x):
         scaling_array = torch.tensor([2, 2, 4, 4, 4, 2, 2]).to(x.device)
 
-        return self.get_density_descriptors(scaling_array * x)
+        return cls.get_density_descriptors(scaling_array * x)
 
-    def forward(self, x):
+    def forward(self, x, descriptors=None, restricted=False):
+        """
+        descriptors : optional precomputed get_descriptor_columns(x),
+        the descriptors are not recomputed from x then
+
+        Returns the (N, 6) PBE.PBE_VARYING columns of the PBE constants,
+        passed to F_PBE as varying=
+        restricted : all grid points have rho_a == rho_b, sigma_aa == sigma_bb
+        and tau_a == tau_b, only the spin-up exchange and one correlation pass
+        of the spin symmetrization are evaluated then
+        """
+
+        if descriptors is None:
+            x_exchange_desc = self.get_exchange_descriptors(x)
+            x_correlation_desc = self.get_density_descriptors(x)
+        else:
+            x_correlation_desc, x_exchange_desc = descriptors[:, :7], descriptors[:, 7:]
 
-        x_exchange_desc = self.get_exchange_descriptors(x)
-        x_correlation_desc = self.get_density_descriptors(x)
+        return self.forward_from_descriptors(
+            x_exchange_desc, x_correlation_desc, restricted=restricted
+        )
+
+    @property
+    def exchange_layers(self):
+        return self.hidden_layers_x if self.exchange_table is None else self.exchange_table
+
+    def tabulate_exchange(self, tolerance=1e-6, **kwargs):
+        """
+        Inference option: hidden_layers_x is evaluated by bicubic interpolation
+        of a table whose values and input gradients are validated against it
+        to tolerance (see exchange_table). Returns the error of the table
+        """
+        self.eval()
+        self.exchange_table, error = exchange_table(self.hidden_layers_x, tolerance, **kwargs)
+        return error
 
-        x_correlation_desc_swapped = x_correlation_desc[:, [1, 0, 4, 3, 2, 6, 5]]
-        params_c_real = (
-            self.hidden_layers_c(x_correlation_desc)
-            + self.hidden_layers_c(x_correlation_desc_swapped)
-        ) / 2
+    def batched(self, layers, inputs):
+        """
+        layers of every input, evaluated in a single pass over the concatenated inputs
+        """
+        if not self.batch_subnetworks:
+            return [layers(x) for x in inputs]
+        return layers(torch.cat(inputs)).split([x.shape[0] for x in inputs])
+
+    def symmetric_correlations(self, descriptors, restricted=False):
+        """
+        hidden_layers_c of every descriptor tensor averaged over the spin-swapped
+        descriptors, without the swap if the descriptors are spin-symmetric
+        (all of them if restricted, else row by row with dedup_symmetric_rows)
+        """
+        if restricted:
+            return list(self.batched(self.hidden_layers_c, list(descriptors)))
+        n = len(descriptors)
+        if not self.dedup_symmetric_rows:
+            inputs = list(descriptors) + [x[:, SPIN_SWAP] for x in descriptors]
+            outputs = self.batched(self.hidden_layers_c, inputs)
+            return [(outputs[i] + outputs[n + i]) / 2 for i in range(n)]
+
+        inputs, swapped, asymmetric = zip(*map(spin_symmetric_inputs, descriptors))
+        outputs = self.batched(self.hidden_layers_c, list(inputs) + list(swapped))
+        return [
+            spin_symmetrized(outputs[i], outputs[n + i], asymmetric[i]) for i in range(n)
+        ]
+
+    def spin_exchanges(self, descriptors, restricted=False):
+        """
+        (spin-up, spin-down) hidden_layers_x of every exchange descriptor tensor
+        """
+        inputs = [x[:, [2, 5]] for x in descriptors]
+        if not restricted:
+            inputs += [x[:, [4, 6]] for x in descriptors]
+        outputs = self.batched(self.exchange_layers, inputs)
+        if restricted:
+            return [(up, up) for up in outputs]
+        n = len(descriptors)
+        return [(outputs[i], outputs[n + i]) for i in range(n)]
+
+    def symmetric_correlation(self, x_correlation_desc, restricted=False):
+        return self.symmetric_correlations([x_correlation_desc], restricted)[0]
+
+    def spin_exchange(self, x_exchange_desc, restricted=False):
+        return self.spin_exchanges([x_exchange_desc], restricted)[0]
+
+    def forward_from_descriptors(self, x_exchange_desc, x_correlation_desc, restricted=False):
+
+        params_c_real, params_c_sigma_zero, params_c_rho_inf = self.symmetric_correlations(
+            [
+                x_correlation_desc,
+                self.all_sigma_zero(x_correlation_desc),
+                self.all_rho_inf(x_correlation_desc),
+            ],
+            restricted,
+        )
         beta_real, gamma_real = params_c_real[:, 0].view(-1, 1), params_c_real[
             :, 1
         ].view(-1, 1)
-
-        x_corr_sigma_zero = self.all_sigma_zero(x_correlation_desc)
-        x_corr_sigma_zero_swapped = self.all_sigma_zero(x_correlation_desc_swapped)
-        params_c_sigma_zero = (
-            self.hidden_layers_c(x_corr_sigma_zero)
-            + self.hidden_layers_c(x_corr_sigma_zero_swapped)
-        ) / 2
         beta_at_constraint = params_c_sigma_zero[:, 0].view(-1, 1)
-
-        x_corr_rho_inf = self.all_rho_inf(x_correlation_desc)
-        x_corr_rho_inf_swapped = self.all_rho_inf(x_correlation_desc_swapped)
-        params_c_rho_inf = (
-            self.hidden_layers_c(x_corr_rho_inf)
-            + self.hidden_layers_c(x_corr_rho_inf_swapped)
-        ) / 2
         gamma_at_constraint = params_c_rho_inf[:, 1].view(-1, 1)
 
-        params_x_up_real = self.hidden_layers_x(x_exchange_desc[:, [2, 5]])
-        params_x_down_real = self.hidden_layers_x(x_exchange_desc[:, [4, 6]])
+        (params_x_up_real, params_x_down_real), (
+            params_x_s_zero_up,
+            params_x_s_zero_down,
+        ) = self.spin_exchanges(
+            [x_exchange_desc, self.all_sigma_zero(x_exchange_desc)], restricted
+        )
         mu_up_real, kappa_up_real = params_x_up_real[:, 0].view(
             -1, 1
         ), params_x_up_real[:, 1].view(-1, 1)
@@ -354,9 +614,6 @@ class pcPBEMLOptimizer(nn.Module):
             -1, 1
         ), params_x_down_real[:, 1].view(-1, 1)
 
-        x_exch_s_zero = self.all_sigma_zero(x_exchange_desc)
-        params_x_s_zero_up = self.hidden_layers_x(x_exch_s_zero[:, [2, 5]])
-        params_x_s_zero_down = self.hidden_layers_x(x_exch_s_zero[:, [4, 6]])
         mu_up_at_constraint = params_x_s_zero_up[:, 0].view(-1, 1)
         mu_down_at_constraint = params_x_s_zero_down[:, 0].view(-1, 1)
 
@@ -367,44 +624,22 @@ class pcPBEMLOptimizer(nn.Module):
         kappa_up = self.kappa_activation(kappa_up_real)
         kappa_down = self.kappa_activation(kappa_down_real)
 
-        constants_batch = true_constants_PBE.repeat(x_exchange_desc.shape[0], 1).to(
-            x_exchange_desc.device
-        )
-        fill_tensor = torch.ones(
-            [x_exchange_desc.shape[0], 20], device=x_exchange_desc.device
-        )
-        final_tensor = torch.hstack(
-            [
-                beta,
-                gamma,
-                fill_tensor,
-                kappa_up,
-                mu_up,
-                kappa_down,
-                mu_down,
-            ]
-        )
-        return final_tensor * constants_batch
+        final_tensor = torch.hstack([beta, gamma, kappa_up, mu_up, kappa_down, mu_down])
+        return final_tensor * true_varying_constants_PBE.to(x_exchange_desc.device)
 
 
 class pcPBEstar(pcPBEMLOptimizer):
 
-    def forward(self, x):
+    def forward_from_descriptors(self, x_exchange_desc, x_correlation_desc, restricted=False):
 
-        x_exchange_desc = self.get_exchange_descriptors(x)
-        x_correlation_desc = self.get_density_descriptors(x)
-
-        x_correlation_desc_swapped = x_correlation_desc[:, [1, 0, 4, 3, 2, 6, 5]]
-        params_c_real = (
-            self.hidden_layers_c(x_correlation_desc)
-            + self.hidden_layers_c(x_correlation_desc_swapped)
-        ) / 2
+        params_c_real = self.symmetric_correlation(x_correlation_desc, restricted)
         beta_real, gamma_real = params_c_real[:, 0].view(-1, 1), params_c_real[
             :, 1
         ].view(-1, 1)
 
-        params_x_up_real = self.hidden_layers_x(x_exchange_desc[:, [2, 5]])
-        params_x_down_real = self.hidden_layers_x(x_exchange_desc[:, [4, 6]])
+        params_x_up_real, params_x_down_real = self.spin_exchange(
+            x_exchange_desc, restricted
+        )
         mu_up_real, kappa_up_real = params_x_up_real[:, 0].view(
             -1, 1
         ), params_x_up_real[:, 1].view(-1, 1)
@@ -419,24 +654,8 @@ class pcPBEstar(pcPBEMLOptimizer):
         kappa_up = self.kappa_activation(kappa_up_real)
         kappa_down = self.kappa_activation(kappa_down_real)
 
-        constants_batch = true_constants_PBE.repeat(x_exchange_desc.shape[0], 1).to(
-            x_exchange_desc.device
-        )
-        fill_tensor = torch.ones(
-            [x_exchange_desc.shape[0], 20], device=x_exchange_desc.device
-        )
-        final_tensor = torch.hstack(
-            [
-                beta,
-                gamma,
-                fill_tensor,
-                kappa_up,
-                mu_up,
-                kappa_down,
-                mu_down,
-            ]
-        )
-        return final_tensor * constants_batch
+        final_tensor = torch.hstack([beta, gamma, kappa_up, mu_up, kappa_down, mu_down])
+        return final_tensor * true_varying_constants_PBE.to(x_exchange_desc.device)
 
 
 class pcPBEdoublestar(pcPBEMLOptimizer):
@@ -461,65 +680,123 @@ class pcPBEdoublestar(pcPBEMLOptimizer):
         dist_sq = torch.sum((a - b) ** 2, dim=1)
         return torch.tanh(dist_sq / delta**2)
 
-    def forward(self, x):
-        f0 = 1.0
+    @staticmethod
+    def lagrange_weights(points, delta=1.0):
+        """
+        Lagrange weights prod_{j != i} l(x - x_j) / l(x_i - x_j) of the constraint
+        points x_i = points[1:] at x = points[0], points : (k + 1, N, 7).
+        Returns a (k, N) tensor
+        """
+        k = len(points) - 1
+        dist_sq = torch.sum((points[:, None] - points[None, 1:]) ** 2, dim=-1)
+        l = torch.tanh(dist_sq / delta**2)  # (k + 1, k, N), l(points[a] - x_j)
+        off_diagonal = ~torch.eye(k, dtype=torch.bool, device=points.device)[..., None]
+        numerator = torch.where(off_diagonal, l[:1], 1.0).prod(dim=1)
+        denominator = torch.where(off_diagonal, l[1:], 1.0).prod(dim=1)
+        return numerator / (denominator + 1e-9)
+
+    @classmethod
+    def lagrange_weights_reference(cls, x, constraint_points, delta=1.0):
+        """
+        lagrange_weights with a _compute_l call per pair of points
+        """
+        lagrange_weights = []
+        for i in range(len(constraint_points)):
+            numerator = 1.0
+            denominator = 1.0
+            for j in range(len(constraint_points)):
+                if i != j:
+                    numerator = numerator * cls._compute_l(
+                        x, constraint_points[j], delta
+                    )
+                    denominator = denominator * cls._compute_l(
+                        constraint_points[i], constraint_points[j], delta
+                    )
+            lagrange_weights.append(numerator / (denominator + 1e-9))
+        return torch.stack(lagrange_weights)
 
-        x_exchange_desc = self.get_exchange_descriptors(x)
-        x_correlation_desc = self.get_density_descriptors(x)
+    def forward_from_descriptors(self, x_exchange_desc, x_correlation_desc, restricted=False):
+        f0 = 1.0
 
-        x_up_input = x_exchange_desc[:, [2, 5]]
-        x_down_input = x_exchange_desc[:, [4, 6]]
         x0_full_tensor = self.all_sigma_zero(x_exchange_desc)
         x0_X_sliced = x0_full_tensor[:, [2, 5]]
 
-        f_x_up = self.hidden_layers_x(x_up_input)
-        f_x_down = self.hidden_layers_x(x_down_input)
-        f_x0 = self.hidden_layers_x(x0_X_sliced)
+        exchange_inputs = [x_exchange_desc[:, [2, 5]], x0_X_sliced]
+        if not restricted:
+            exchange_inputs.append(x_exchange_desc[:, [4, 6]])
+        f_x_up, f_x0, *f_x_down = self.batched(self.exchange_layers, exchange_inputs)
+        f_x_down = f_x_up if restricted else f_x_down[0]
 
         Theta_up = f_x_up - f_x0 + f0
         Theta_down = f_x_down - f_x0 + f0
         Fx_up = self.shifted_elu(Theta_up - 1.0).squeeze(-1)
         Fx_down = self.shifted_elu(Theta_down - 1.0).squeeze(-1)
 
-        constraint_points = [
-            self.all_sigma_zero(x_correlation_desc),
-            self.all_rho_inf(x_correlation_desc),
-            self.all_sigma_inf(x_correlation_desc),
-        ]
-        num_constraints = len(constraint_points)
+        # (k + 1, N, 7): the grid points and their k constraint points
+        points = torch.stack(
+            [
+                x_correlation_desc,
+                self.all_sigma_zero(x_correlation_desc),
+                self.all_rho_inf(x_correlation_desc),
+                self.all_sigma_inf(x_correlation_desc),
+            ]
+        )
+        f_c_points = self.hidden_layers_c(points.flatten(0, 1)).unflatten(0, points.shape[:2])
+        lagrange_weights = self.lagrange_weights(points)[..., None]
 
-        f_c = self.hidden_layers_c(x_correlation_desc)
-        f_c_at_constraints = [self.hidden_layers_c(p) for p in constraint_points]
+        thetas = f_c_points[:1] - f_c_points[1:] + f0
+        Fc_intermediate = torch.sum(thetas * lagrange_weights, dim=0) / (
+            torch.sum(lagrange_weights, dim=0) + 1e-9
+        )
 
-        lagrange_weights = []
-        for i in range(num_constraints):
-            numerator = 1.0
-            denominator = 1.0
-            for j in range(num_constraints):
-                if i != j:
-                    numerator = numerator * self._compute_l(
-                        x_correlation_desc, constraint_points[j]
-                    )
-                    denominator = denominator * self._compute_l(
-                        constraint_points[i], constraint_points[j]
-                    )
+        Fc = self.shifted_elu(Fc_intermediate - 1.0).squeeze(-1)
+
+        return Fx_up, Fx_down, Fc
+
+
+def get_descriptor_columns(x):
+    """
+    Descriptors of the grid x which can be precomputed and passed
+    to the models as forward(x, descriptors=...)
+    0-6 - correlation descriptors (get_density_descriptors)
+    7-13 - spin-scaled exchange descriptors (get_exchange_descriptors)
+    """
+    return torch.hstack(
+        [
+            pcPBEMLOptimizer.get_density_descriptors(x),
+            pcPBEMLOptimizer.get_exchange_descriptors(x),
+        ]
+    )
 
-            weight = numerator / (denominator + 1e-9)
-            lagrange_weights.append(weight)
 
-        thetas = [f_c - f_c_at_constraints[i] + f0 for i in range(num_constraints)]
+def saved_bytes_per_point(function, n_points=1024):
+    """
+    Bytes of the tensors saved for backward per grid point by function(n),
+    which evaluates n grid points. Measured with saved tensor hooks on n and 2n
+    points, so the parameters saved once per call cancel out
+    """
 
-        Fc_intermediate = torch.zeros_like(f_c)
-        for i in range(num_constraints):
-            Fc_intermediate += thetas[i] * lagrange_weights[i].view(-1, 1)
+    def saved_bytes(n):
+        saved = 0
 
-        sum_of_weights = torch.sum(torch.stack(lagrange_weights, dim=0), dim=0)
+        def pack(tensor):
+            nonlocal saved
+            saved += tensor.numel() * tensor.element_size()
+            return tensor
 
-        Fc_intermediate = Fc_intermediate / (sum_of_weights.view(-1, 1) + 1e-9)
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            function(n)
+        return saved
 
-        Fc = self.shifted_elu(Fc_intermediate - 1.0).squeeze(-1)
+    return max(saved_bytes(2 * n_points) - saved_bytes(n_points), 1) / n_points
 
-        return Fx_up, Fx_down, Fc
+
+def points_per_chunk(memory_budget, function):
+    """
+    Number of grid points whose autograd graph built by function(n)
+    fits into memory_budget bytes
+    """
+    return max(1, int(memory_budget // saved_bytes_per_point(function)))
 
 
 def test_model_constraints(model, model_name):
@@ -605,9 +882,7 @@ def test_model_constraints(model, model_name):
             all_passed = False
 
     elif isinstance(model, pcPBEMLOptimizer):
-        true_factors = true_constants_PBE.repeat(BATCH_SIZE, 1).to(
-            nn_inputs_placeholder.device
-        )
+        true_factors = true_varying_constants_PBE.to(nn_inputs_placeholder.device)
 
         print("\n[TEST 1/4] Checking `mu` constraint (Exchange UEG Limit)...")
         tau_tf_2rho_a = 3 / 10 * (3 * np.pi**2) ** (2 / 3) * (2 * rho_a) ** (5 / 3)
@@ -626,7 +901,7 @@ def test_model_constraints(model, model_name):
             )
             / true_factors
         )
-        mu_up, mu_down = output_mu[:, 23], output_mu[:, 25]
+        mu_up, mu_down = output_mu[:, 3], output_mu[:, 5]
         mu_up_passed = torch.allclose(mu_up, torch.ones_like(mu_up))
         mu_down_passed = torch.allclose(mu_down, torch.ones_like(mu_down))
         print(
@@ -700,8 +975,8 @@ def test_model_constraints(model, model_name):
         corr_symm = torch.allclose(out1[:, 0], out2[:, 0]) and torch.allclose(
             out1[:, 1], out2[:, 1]
         )
-        exch_swap = torch.allclose(out1[:, 22], out2[:, 24]) and torch.allclose(
-            out1[:, 24], out2[:, 22]
+        exch_swap = torch.allclose(out1[:, 2], out2[:, 4]) and torch.allclose(
+            out1[:, 4], out2[:, 2]
         )
         print(
             f"  > Correlation parameters are symmetric? {'PASS' if corr_symm else 'FAIL'}"
@@ -725,6 +1000,99 @@ def test_model_constraints(model, model_name):
     return all_passed
 
 
+def test_restricted_path(model, model_name):
+    """
+    Checks that forward(x, restricted=True) equals the general path
+    on spin-restricted grid points
+    """
+    print(f"--- Restricted path of {model_name} ---")
+
+    BATCH_SIZE = 64
+    model.eval()
+    device = next(model.parameters()).device
+    rho = torch.rand(BATCH_SIZE, device=device) * 5 + 0.1
+    grad = torch.rand(BATCH_SIZE, device=device)
+    tau = torch.rand(BATCH_SIZE, device=device) * 10
+    x = torch.stack([rho, rho, grad, 4 * grad, grad, tau, tau], dim=1)
+
+    with torch.no_grad():
+        general, restricted = model(x), model(x, restricted=True)
+    if isinstance(general, tuple):
+        general, restricted = torch.stack(general, dim=1), torch.stack(restricted, dim=1)
+
+    passed = torch.allclose(general, restricted)
+    print(
+        f"Restricted == general? {'PASS' if passed else 'FAIL'} "
+        f"(Max diff: {torch.max(torch.abs(general - restricted)).item():.2e})"
+    )
+    return passed
+
+
+def test_symmetric_rows(model, model_name):
+    """
+    Checks that the single pass over the spin-symmetric rows gives the values and
+    input gradients of the two-pass symmetrization on a partly symmetric grid
+    """
+    print(f"--- Spin-symmetric rows of {model_name} ---")
+
+    BATCH_SIZE = 64
+    model.eval()
+    parameter = next(model.parameters())
+    x = torch.rand(BATCH_SIZE, 7, device=parameter.device, dtype=parameter.dtype) + 0.1
+    x[: BATCH_SIZE // 2, [1, 4, 6]] = x[: BATCH_SIZE // 2, [0, 2, 5]]
+
+    results = []
+    for dedup_symmetric_rows in (False, True):
+        model.dedup_symmetric_rows = dedup_symmetric_rows
+        inputs = x.clone().requires_grad_(True)
+        output = model(inputs)
+        if isinstance(output, tuple):
+            output = torch.stack(output, dim=1)
+        (grad,) = torch.autograd.grad(output.sum(), inputs)
+        results.append((output.detach(), grad))
+    del model.dedup_symmetric_rows
+
+    diff = max(torch.max(torch.abs(a - b)).item() for a, b in zip(*results))
+    passed = diff < 1e-12
+    print(f"Single pass == two passes? {'PASS' if passed else 'FAIL'} (Max diff: {diff:.2e})")
+    return passed
+
+
+def test_exchange_table(model, model_name, tolerance=1e-6):
+    """
+    Checks that the model with the tabulated exchange subnetwork
+    reproduces the MLP and its input gradients within tolerance
+    """
+    print(f"--- Exchange table of {model_name} ---")
+
+    BATCH_SIZE = 64
+    model.eval()
+    device = next(model.parameters()).device
+    x = torch.rand(BATCH_SIZE, 7, device=device) * torch.tensor(
+        [5, 5, 1, 1, 1, 10, 10], device=device
+    )
+
+    def stacked(x):
+        output = model(x)
+        return torch.stack(output, dim=1) if isinstance(output, tuple) else output
+
+    mlp, mlp_gradients = stacked(x).detach(), input_gradients(stacked, x)
+    error = model.tabulate_exchange(tolerance)
+    table, table_gradients = stacked(x).detach(), input_gradients(stacked, x)
+    model.exchange_table = None
+
+    diff = max(
+        torch.max(torch.abs(mlp - table)).item(),
+        torch.max(torch.abs(mlp_gradients - table_gradients)).item(),
+    )
+    passed = diff < 100 * tolerance
+    print(
+        f"Table == MLP? {'PASS' if passed else 'FAIL'} "
+        f"(table error: {error:.2e}, max diff: {diff:.2e})"
+    )
+    return passed
+
+
 if __name__ == "__main__":
     pbe_optimizer_model = pcPBEMLOptimizer(num_layers=4, h_dim=16)
     test_model_constraints(pbe_optimizer_model, "pcPBEMLOptimizer")
@@ -732,3 +1100,18 @@ if __name__ == "__main__":
     print("\n" + "=" * 60 + "\n")
     pbe_doublestar_model = pcPBEdoublestar(num_layers=4, h_dim=16)
     test_model_constraints(pbe_doublestar_model, "pcPBEdoublestar")
+
+    print("\n" + "=" * 60 + "\n")
+    test_restricted_path(MLOptimizer(4, 16, 1, 0.0, "XALPHA"), "MLOptimizer")
+    test_restricted_path(pbe_optimizer_model, "pcPBEMLOptimizer")
+    test_restricted_path(pcPBEstar(num_layers=4, h_dim=16), "pcPBEstar")
+    test_restricted_path(pbe_doublestar_model, "pcPBEdoublestar")
+
+    print("\n" + "=" * 60 + "\n")
+    test_symmetric_rows(MLOptimizer(4, 16, 1, 0.0, "XALPHA").double(), "MLOptimizer")
+    test_symmetric_rows(pcPBEMLOptimizer(num_layers=4, h_dim=16).double(), "pcPBEMLOptimizer")
+    test_symmetric_rows(pcPBEstar(num_layers=4, h_dim=16).double(), "pcPBEstar")
+
+    print("\n" + "=" * 60 + "\n")
+    test_exchange_table(pbe_optimizer_model, "pcPBEMLOptimizer")
+    test_exchange_table(pbe_doublestar_model, "pcPBEdoublestar")
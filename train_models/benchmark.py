@@ -0,0 +1,176 @@
+import time
+from optparse import OptionParser
+
+import h5py
+import numpy as np
+import torch
+
+from dataset import (
+    get_compounds_coefs_energy,
+    get_h5_names,
+    load_grid_store,
+    load_reaction_table,
+)
+from NN_models import pcPBEdoublestar, pcPBEMLOptimizer, pcPBEstar
+from utils import stack_reactions
+
+
+def legacy_reaction_grid(reaction, names, path):
+    """
+    Reference implementation of the per-reaction ingest before the grid store:
+    X grows with np.vstack and the density mask is re-applied to the whole
+    accumulated array after every component
+    """
+    eps = 1e-27
+    X = np.array([])
+    backsplit_ind = []
+    for component_filename in get_h5_names(names[reaction["Molecule_ids"].numpy()]):
+        with h5py.File(f"{path}/{component_filename}", "r") as f:
+            X_raw = np.array(f["grid"][:])
+            if len(X) == 0:
+                X = X_raw[:, 3:-1]
+            else:
+                X = np.vstack((X, X_raw[:, 3:-1]))
+            X = X[np.logical_or((X[:, 1] > eps), (X[:, 2] > eps))]
+            backsplit_ind.append(len(X))
+    X = np.copy(X[:, 1:])
+    X[:, 3] = X[:, 2] + X[:, 4] + 2 * X[:, 3]
+    return torch.Tensor(X), torch.Tensor(np.array(backsplit_ind))
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def benchmark_reaction_grids(path, databases, repeat=3):
+    """
+    Compares the legacy vstack ingest with the grid store ingest + gather
+    on the largest reactions of the given databases
+    """
+    table = load_reaction_table(path)
+    data = get_compounds_coefs_energy(table)
+    reactions = [data[i] for i in data if data[i]["Database"] in databases]
+    reactions = sorted(reactions, key=lambda reaction: -len(reaction["Molecule_ids"]))
+
+    print(f"{'Database':>8} {'N_comp':>6} {'N_points':>9} {'legacy, s':>10} {'store, s':>10}")
+    for reaction in reactions:
+
+        def store_path():
+            grid_store = load_grid_store(
+                table["Names"], path, reaction["Molecule_ids"].numpy()
+            )
+            return stack_reactions([reaction], grid_store)
+
+        legacy_time, (legacy_grid, legacy_backsplit) = timed(
+            lambda: legacy_reaction_grid(reaction, table["Names"], path), repeat
+        )
+        store_time, gathered = timed(store_path, repeat)
+
+        assert torch.equal(legacy_grid, gathered["Grid"])
+        assert torch.equal(legacy_backsplit, gathered["backsplit_ind"])
+
+        print(
+            f"{reaction['Database']:>8} {len(reaction['Molecule_ids']):>6} "
+            f"{len(legacy_grid):>9} {legacy_time:>10.4f} {store_time:>10.4f}"
+        )
+
+
+def benchmark_forward(n_points, repeat, device, restricted=False):
+    """
+    Training step time (forward + backward) of the PBE models with the subnetworks
+    evaluated once over the concatenated constraint-point inputs and input by input
+    """
+    generator = torch.Generator().manual_seed(42)
+    x = torch.rand(n_points, 7, generator=generator).to(device)
+    print(f"{'Model':>16} {'per input, ms':>14} {'batched, ms':>12} {'max |diff|':>11}")
+    for model_class in (pcPBEMLOptimizer, pcPBEstar, pcPBEdoublestar):
+        model = model_class(num_layers=8, h_dim=32, dropout=0.0, DFT="PBE").to(device)
+
+        def step():
+            predictions = model(x, restricted=restricted)
+            if isinstance(predictions, tuple):
+                predictions = torch.stack(predictions, dim=1)
+            predictions.sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            return predictions.detach()
+
+        timings, outputs = [], []
+        for batch_subnetworks in (False, True):
+            model.batch_subnetworks = batch_subnetworks
+            outputs.append(step())  # warm-up
+            timings.append(timed(step, repeat)[0])
+        print(
+            f"{model_class.__name__:>16} {timings[0] * 1e3:>14.2f} {timings[1] * 1e3:>12.2f} "
+            f"{torch.max(torch.abs(outputs[0] - outputs[1])).item():>11.2e}"
+        )
+
+
+def benchmark_lagrange_weights(n_points, repeat, device, constraint_counts=(3, 6, 12)):
+    """
+    Forward + backward time of the pcPBEdoublestar Lagrange weights computed
+    pair by pair and over the stacked (k + 1, N, 7) points for k constraint points
+    """
+    generator = torch.Generator().manual_seed(42)
+    print(f"{'Constraints':>11} {'pairwise, ms':>13} {'stacked, ms':>12} {'max |diff|':>11}")
+    for k in constraint_counts:
+        points = torch.rand(k + 1, n_points, 7, generator=generator).to(device)
+        points.requires_grad_(True)
+        kernels = (
+            lambda: pcPBEdoublestar.lagrange_weights_reference(points[0], list(points[1:])),
+            lambda: pcPBEdoublestar.lagrange_weights(points),
+        )
+
+        timings, outputs = [], []
+        for kernel in kernels:
+
+            def step():
+                weights = kernel()
+                weights.sum().backward()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                return weights.detach()
+
+            outputs.append(step())  # warm-up
+            timings.append(timed(step, repeat)[0])
+        print(
+            f"{k:>11} {timings[0] * 1e3:>13.2f} {timings[1] * 1e3:>12.2f} "
+            f"{torch.max(torch.abs(outputs[0] - outputs[1])).item():>11.2e}"
+        )
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+        "--Path", type=str, default="data", help="Path to the h5 files and csv data"
+    )
+    parser.add_option(
+        "--Databases",
+        type=str,
+        default="pTC13,NCCE31",
+        help="Comma-separated databases to benchmark",
+    )
+    parser.add_option(
+        "--Repeat", type=int, default=3, help="Number of timing repetitions"
+    )
+    parser.add_option(
+        "--Forward_points",
+        type=int,
+        default=0,
+        help="Benchmark the PBE model training step on this many random points instead",
+    )
+    parser.add_option("--Device", type=str, default="cpu", help="cpu or cuda")
+    (Opts, args) = parser.parse_args()
+
+    if Opts.Forward_points:
+        benchmark_forward(Opts.Forward_points, Opts.Repeat, torch.device(Opts.Device))
+        benchmark_lagrange_weights(
+            Opts.Forward_points, Opts.Repeat, torch.device(Opts.Device)
+        )
+    else:
+        benchmark_reaction_grids(Opts.Path, Opts.Databases.split(","), Opts.Repeat)
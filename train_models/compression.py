@@ -0,0 +1,113 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Add parent directory to path to import from dft_functionals at project root
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from dft_functionals import PBE, true_constants_PBE
+
+from dataset import GRID_COLUMNS, OPTIONAL_COLUMNS
+
+HARTREE2KCAL = 627.5095
+
+
+def pbe_contributions(densities, gradients):
+    """
+    Returns the PBE XC energy density of every grid point per unit weight,
+    (rho_a + rho_b) * e_xc, so that E_xc = sum(weights * contributions)
+    """
+    densities = torch.from_numpy(np.asarray(densities, dtype=np.float64))
+    gradients = torch.from_numpy(np.asarray(gradients, dtype=np.float64))
+    with torch.no_grad():
+        local_energies = PBE.F_PBE(
+            densities, gradients, true_constants_PBE.double(), "cpu"
+        )
+    return (local_energies * (densities[:, 0] + densities[:, 1])).numpy()
+
+
+def compress_molecule(weights, densities, gradients, tolerance):
+    """
+    Prunes the grid points of one molecule with the smallest |w * rho * e_xc|.
+    The weights of the kept points are rescaled to conserve the electron count,
+    and points are pruned as long as the resulting PBE XC energy error,
+    rescaling included, stays below tolerance (Hartree).
+
+    Returns the indices of the kept points, their new weights
+    and the resulting PBE XC energy error (Hartree)
+    """
+    contributions = pbe_contributions(densities, gradients)
+    exc_full = np.sum(weights * contributions)
+    electrons = weights * (densities[:, 0] + densities[:, 1])
+
+    # errors[n] : error after pruning the first n points of order and rescaling
+    order = np.argsort(np.abs(weights * contributions))
+    kept_exc = exc_full - np.concatenate([[0.0], np.cumsum((weights * contributions)[order])])
+    kept_electrons = np.sum(electrons) - np.concatenate([[0.0], np.cumsum(electrons[order])])
+    scale = np.divide(
+        np.sum(electrons),
+        kept_electrons,
+        out=np.ones_like(kept_electrons),
+        where=kept_electrons > 0,
+    )
+    errors = scale * kept_exc - exc_full
+    errors[-1] = np.inf  # at least one point is kept
+    errors[0] = 0.0
+    # the longest prefix within tolerance, the rescaled errors are not monotone
+    n_pruned = max(int(np.argmax(np.abs(errors) > tolerance)) - 1, 0)
+    kept = np.sort(order[n_pruned:])
+
+    kept_weights = weights[kept] * scale[n_pruned]
+    error = np.sum(kept_weights * contributions[kept]) - exc_full
+    return kept, kept_weights, error
+
+
+def compress_grid_store(grid_store, tolerance):
+    """
+    Offline compression of a finalized grid store (see dataset.make_grid_store).
+    tolerance : per-molecule budget for the pruned PBE XC energy in kcal/mol
+
+    Returns a new grid store with the same molecule ids
+    and the PBE XC energy error of every molecule in kcal/mol
+    """
+    offsets = grid_store["Molecule_offsets"]
+    columns = {label: [] for label in GRID_COLUMNS}
+    new_offsets = [0]
+    errors = np.zeros(len(offsets) - 1)
+
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        kept, kept_weights, error = compress_molecule(
+            np.asarray(grid_store["Weights"][start:stop]),
+            np.asarray(grid_store["Densities"][start:stop]),
+            np.asarray(grid_store["Gradients"][start:stop]),
+            tolerance / HARTREE2KCAL,
+        )
+        columns["Weights"].append(kept_weights)
+        for label in GRID_COLUMNS[1:]:
+            columns[label].append(np.asarray(grid_store[label][start:stop])[kept])
+        new_offsets.append(new_offsets[-1] + len(kept))
+        errors[i] = error * HARTREE2KCAL
+
+    compressed = {
+        k: v
+        for k, v in grid_store.items()
+        if k not in columns and k not in OPTIONAL_COLUMNS  # recomputed after compression
+    }
+    for label in GRID_COLUMNS:
+        compressed[label] = np.concatenate(columns[label]).astype(np.float64)
+    compressed["Molecule_offsets"] = np.array(new_offsets, dtype=np.int64)
+
+    return compressed, errors
+
+
+def report_compression(grid_store, compressed, errors):
+    n_before = grid_store["Molecule_offsets"][-1]
+    n_after = compressed["Molecule_offsets"][-1]
+    print(
+        f"Grid points: {n_before} -> {n_after} ({n_before / max(n_after, 1):.2f}x smaller)"
+    )
+    print(
+        f"PBE XC energy error per molecule, kcal/mol: "
+        f"max {np.max(np.abs(errors)):.4f}, mean {np.mean(np.abs(errors)):.4f}"
+    )
@@ -1,243 +1,418 @@
-import copy
 import csv
+import hashlib
+import os
+from multiprocessing import Pool, shared_memory
 
 import h5py
 import numpy as np
 import torch
 
-from utils import stack_reactions
+from NN_models import get_descriptor_columns
+from utils import fill_grid, stack_reactions
 
+GRID_COLUMNS = ("Weights", "Densities", "Gradients", "Taus")
+OPTIONAL_COLUMNS = ("Descriptors",)
 
-def ref(x, y, path):
+
+REFERENCE_ROWS = {  # 1-based row ranges of the databases in Reference_data.csv
+    "MGAE109": ((8, 116),),
+    "IP13": ((155, 167),),
+    "EA13": ((180, 192),),
+    "PA8": ((195, 202),),
+    "DBH76": ((251, 288), (291, 328)),
+    "NCCE31": ((331, 361),),
+    "ABDE4": ((206, 209),),
+    "AE17": ((375, 391),),
+    "pTC13": ((232, 234), (237, 241), (244, 248)),
+}
+HARTREE_DATABASES = ("AE17",)  # reference energies given in Hartree
+TABLE_CSV_FILES = ("Reference_data.csv", "total_dataframe_sorted_final.csv")
+TABLE_FORMAT = 1  # version of load_reaction_table, increase when the parsing changes
+
+
+def table_key():
     """
-    returns reference energies for points of a reaction grid from Reference_data.csv
+    Key of the cached reaction table: TABLE_FORMAT, REFERENCE_ROWS and HARTREE_DATABASES
     """
+    key = repr((TABLE_FORMAT, REFERENCE_ROWS, HARTREE_DATABASES))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def csv_path(path, filename):
     if path == None:
-        pathfile = "../MN_dataset/Reference_data.csv"
-    else:
-        pathfile = f"{path}/Reference_data.csv"
+        return f"../MN_dataset/{filename}"
+    return f"{path}/{filename}"
 
+
+def load_reference_energies(path):
+    """
+    Reads Reference_data.csv once.
+    Returns the row -> energy vector (kcal/mol, indexed by the 1-based row number,
+    NaN outside of the database ranges) and {db_name: rows} with the rows of
+    every database reaction in the order of REFERENCE_ROWS
+    """
     hartree2kcal = 627.5095
-    with open(pathfile, newline="", encoding="cp1251") as csvfile:
+    with open(csv_path(path, TABLE_CSV_FILES[0]), newline="", encoding="cp1251") as csvfile:
+        rows = list(csv.reader(csvfile, delimiter=","))
+
+    row_energies = np.full(len(rows) + 1, np.nan)
+    database_rows = dict()
+    for database, ranges in REFERENCE_ROWS.items():
+        k = hartree2kcal if database in HARTREE_DATABASES else 1
+        for x, y in ranges:
+            row_energies[x : y + 1] = [float(row[2]) * k for row in rows[x - 1 : y]]
+        database_rows[database] = np.concatenate(
+            [np.arange(x, y + 1) for x, y in ranges]
+        )
+    return row_energies, database_rows
+
+
+def load_reaction_table(path, cache=None):
+    """
+    Parses Reference_data.csv and total_dataframe_sorted_final.csv once into typed arrays:
+    Names : component names, the component id is the position in Names
+    Databases : database of every reaction
+    Reaction_offsets : CSR offsets of every reaction into Component_ids and Coefficients
+    Component_ids, Coefficients : components of all reactions and their coefficients
+    Energies : reference reaction energies in kcal/mol
+    Reactions are ordered by database as in REFERENCE_ROWS.
+
+    With cache set, the table is kept in {cache}/reaction_table.npz and only
+    parsed again when one of the csv files is newer or table_key has changed
+    """
+    if cache is not None:
+        cache_file = f"{cache}/reaction_table.npz"
+        if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= max(
+            os.path.getmtime(csv_path(path, filename)) for filename in TABLE_CSV_FILES
+        ):
+            with np.load(cache_file) as table:
+                if "Key" in table.files and str(table["Key"]) == table_key():
+                    return {k: table[k] for k in table.files if k != "Key"}
+
+    row_energies, database_rows = load_reference_energies(path)
+
+    with open(csv_path(path, TABLE_CSV_FILES[1]), newline="", encoding="cp1251") as csvfile:
         ref_file = csv.reader(csvfile, delimiter=",")
-        k = 1
-        if y == 391:
-            k = hartree2kcal
-        ref = []
-        for n, i in enumerate(ref_file):
-            if x <= n + 1 <= y:
-                ref.append((i[0], float(i[2]) * k))
-
-        return ref
-
-
-def load_ref_energies(path):
-    """Returns {db_name: [equation, energy]}"""
-    ref_e = {  # Get the reference energies
-        "MGAE109": ref(8, 116, path),
-        "IP13": ref(155, 167, path),
-        "EA13": ref(180, 192, path),
-        "PA8": ref(195, 202, path),
-        "DBH76": ref(251, 288, path) + ref(291, 328, path),
-        "NCCE31": ref(331, 361, path),
-        "ABDE4": ref(206, 209, path),
-        "AE17": ref(375, 391, path),
-        "pTC13": ref(232, 234, path) + ref(237, 241, path) + ref(244, 248, path),
+        names = np.array(next(ref_file)[2:])
+        reactions = dict()
+        for line in ref_file:
+            values = np.array(line[2:])
+            component_ids = np.nonzero(values.astype(np.float64))[0]
+            reactions.setdefault(line[1], []).append(
+                (int(line[0]), component_ids, values[component_ids].astype(np.float32))
+            )
+
+    databases, energies, component_ids, coefficients = [], [], [], []
+    for database, rows in database_rows.items():
+        for reaction_id, ids, coefs in reactions[database]:
+            databases.append(database)
+            energies.append(row_energies[rows[reaction_id]])
+            component_ids.append(ids)
+            coefficients.append(coefs)
+
+    table = {
+        "Names": names,
+        "Databases": np.array(databases),
+        "Reaction_offsets": np.cumsum([0] + [len(ids) for ids in component_ids]),
+        "Component_ids": np.concatenate(component_ids).astype(np.int64),
+        "Coefficients": np.concatenate(coefficients),
+        "Energies": np.array(energies, dtype=np.float64),
     }
-    return ref_e
+    if cache is not None:
+        np.savez(cache_file, Key=np.array(table_key()), **table)
+    return table
 
 
-def load_component_names(path):
-    """
-    Returns {db_name: {id: {'Components': [...], 'Coefficients: [...]'
-                                }
-                            }
-                        }
-     which is a dictionary with Components and Coefficients data about all reactions
-    """
-    if path == None:
-        pathfile = "../MN_dataset/total_dataframe_sorted_final.csv"
-    else:
-        pathfile = f"{path}/total_dataframe_sorted_final.csv"
-
-    with open(pathfile, newline="", encoding="cp1251") as csvfile:
-        ref_file = csv.reader(csvfile, delimiter=",")
-        ref = dict()
-        current_database = None
-
-        for n, line in enumerate(ref_file):
-            line = np.array(line)
-            if n == 0:
-                components = np.array(line)
-            else:
-                reaction_id = int(line[0])
-                reaction_database = line[1]
-                reaction_component_num = np.nonzero(list(map(float, line[2:])))[0] + 2
-                if reaction_database in ref:
-                    ref[reaction_database][reaction_id] = {
-                        "Components": components[reaction_component_num],
-                        "Coefficients": line[reaction_component_num],
-                    }
-                else:
-                    ref[reaction_database] = {
-                        reaction_id: {
-                            "Components": components[reaction_component_num],
-                            "Coefficients": line[reaction_component_num],
-                        }
-                    }
-        return ref
-
-
-def get_compounds_coefs_energy(reactions, energies):
+def get_compounds_coefs_energy(table):
     """Returns {id:
-                    {'Components': [...], 'Coefficients: [...]', 'Energy: float', Database: str
+                    {'Database': str, 'Molecule_ids': [...], 'Coefficients': [...], 'Energy': float
                                 }
                             }
-    which is a dictionary from load_component_names with Energy information added
+    from the reaction table of load_reaction_table.
+    Molecule_ids are the component ids of the reaction, which also index the grid store
     """
     data_final = dict()
-    i = 0
-    databases = energies.keys()
-    for database in databases:
-        data = reactions[database]
-        for reaction in data:
-            data_final[i] = {
-                "Database": database,
-                "Components": reactions[database][reaction][
-                    "Components"
-                ],  # .astype(object),
-                "Coefficients": torch.Tensor(
-                    reactions[database][reaction]["Coefficients"].astype(np.float32)
-                ),
-                "Energy": torch.Tensor(np.array(energies[database][reaction][1])),
-            }
-            i += 1
+    offsets = table["Reaction_offsets"]
+    for i in range(len(table["Databases"])):
+        start, stop = offsets[i], offsets[i + 1]
+        data_final[i] = {
+            "Database": str(table["Databases"][i]),
+            "Molecule_ids": torch.from_numpy(table["Component_ids"][start:stop]),
+            "Coefficients": torch.from_numpy(table["Coefficients"][start:stop]),
+            "Energy": torch.tensor(table["Energies"][i], dtype=torch.float32),
+        }
 
     return data_final
 
 
-def get_h5_names(reaction):
-    """reaction must be from the function get_compounds_coefs_energy"""
-    database_match = {
-        "MGAE109": "mgae109",
-        "IP13": "ip13",
-        "EA13": "ea13",
-        "PA8": "pa8",
-        "DBH76": "ntbh38",
-        "NCCE31": "ncce31",
-        "ABDE4": "abde4",
-        "AE17": "ae17",
-        "pTC13": "ptc13",
-    }
-    names = []
-    for elem in reaction["Components"]:
-        database = database_match[reaction["Database"]]
-        names.append(f"{elem}.h5")
-    return names
+def get_h5_names(components):
+    """Returns the h5 file names of the given component names"""
+    return [f"{component}.h5" for component in components]
+
+
+def make_dispersion_vector(dispersions, names):
+    """
+    Turns the {component: dispersion corrections} dict into a tensor
+    indexed by the component id
+    """
+    return torch.tensor(
+        [np.sum(dispersions.get(component, 0)) for component in names],
+        dtype=torch.float64,
+    )
 
 
-def add_reaction_info_from_h5(reaction, path):
+def load_molecule_from_h5(component_filename, path):
     """
-    reaction must be from get_compounds_coefs_energy
-    returns merged descriptos array X, integration weights,
-    a and b densities and indexes for backsplitting
+    Reads a single molecule grid from its h5 file.
     Values are filtered based on density vanishing
     (rho[0] !~ 0 & rho[1] !~ 0)
 
-    Adds the following information to the reaction dict using h5 files from the dataset:
-    Grid : np.array with grid descriptors
-    Weights : list with integration weights of grid points
-    Densities : np.array with alpha and beta densities data for grid points
-    HF_energies : list of Total HF energy (T+V) which needs to be added to E_xc
-    backsplit_ind: list of indexes where we concatenate molecules' grids
+    Returns the filtered grid columns
+    (weight, rho_a, rho_b, sigma_aa, sigma_ab, sigma_bb, tau_a, tau_b)
+    and the total HF energy (T+V) of the molecule which needs to be added to E_xc
     """
     eps = 1e-27
-    X = np.array([])
-    backsplit_ind = []
-    HF_energies = np.array([])
-    for component_filename in get_h5_names(reaction):
-        with h5py.File(f"{path}/{component_filename}", "r") as f:
-            HF_energies = np.append(HF_energies, f["ener"][:][0])
-            X_raw = np.array(f["grid"][:])
-            if len(X) == 0:
-                X = X_raw[:, 3:-1]
-            else:
-                X = np.vstack((X, X_raw[:, 3:-1]))
-            X = X[
-                np.logical_or((X[:, 1] > eps), (X[:, 2] > eps))
-            ]  # energy of both alpha and beta density equal zero will be zero
-            backsplit_ind.append(len(X))  # add indexes of molecules start/end
-    weights = X[:, 0]  # get the integral weights
-    densities = X[:, 1:3]  # get the densities
-    sigmas = X[:, 3:6]  # get the contracted gradients
-
-    X = X[:, 1:]  # get the grid descriptors
-
-    # sigma_a_b to norm_grad=sigma_a + sigma_b + 2*sigma_a_b to get positive descriptor for log-transformation
-    X = np.copy(X)
-    X[:, 3] = X[:, 2] + X[:, 4] + 2 * X[:, 3]
-
-    # Now X is rho_a, rho_b, sigma_aa, norm_sigma, sigma_bb, taua, taub
-
-    backsplit_ind = np.array(backsplit_ind)
-
-    labels = [
-        "Grid",
-        "Weights",
-        "Densities",
-        "Gradients",
-        "HF_energies",
-        "backsplit_ind",
+    with h5py.File(f"{path}/{component_filename}", "r") as f:
+        HF_energy = f["ener"][:][0]
+        grid = f["grid"]
+        X = grid[:, 3 : grid.shape[1] - 1]  # read only the used columns
+    X = X[
+        np.logical_or((X[:, 1] > eps), (X[:, 2] > eps))
+    ]  # energy of both alpha and beta density equal zero will be zero
+    return X, HF_energy
+
+
+def make_grid_store(names):
+    """
+    Returns an empty molecule-keyed grid store:
+    Names : component names, molecule_id is the component id of the reaction table
+    Weights, Densities, Gradients, Taus : grid columns of all molecules
+    HF_energies : per-molecule total HF energies
+    Molecule_offsets : start/end of every molecule in the grid columns
+
+    The columns are filled by add_molecule_to_store and turned into
+    contiguous float64 arrays by finalize_grid_store
+    """
+    grid_store = {label: [] for label in GRID_COLUMNS}
+    grid_store["Names"] = names
+    grid_store["HF_energies"] = []
+    grid_store["Molecule_offsets"] = [0]
+    return grid_store
+
+
+def add_molecule_to_store(X, HF_energy, grid_store):
+    """
+    X must be from load_molecule_from_h5
+    Appends the molecule grid data to grid_store and returns its molecule_id
+    """
+    values = [
+        X[:, 0],  # the integral weights
+        X[:, 1:3],  # the densities
+        X[:, 3:6],  # the contracted gradients
+        X[:, 6:8],  # the kinetic energy densities
     ]
-    values = [X, weights, densities, sigmas, HF_energies, backsplit_ind]
-    for label, value in zip(labels, values):
-        reaction[label] = torch.Tensor(value)
 
-    return reaction
+    molecule_id = len(grid_store["HF_energies"])
+    for label, value in zip(GRID_COLUMNS, values):
+        grid_store[label].append(value)
+    grid_store["HF_energies"].append(HF_energy)
+    grid_store["Molecule_offsets"].append(grid_store["Molecule_offsets"][-1] + len(X))
+
+    return molecule_id
+
+
+def finalize_grid_store(grid_store):
+    """
+    Turns the per-molecule lists of grid_store into one contiguous
+    float64 array per column and an int64 offset table
+    """
+    for label in GRID_COLUMNS:
+        grid_store[label] = np.concatenate(grid_store[label]).astype(np.float64)
+    grid_store["HF_energies"] = np.array(grid_store["HF_energies"], dtype=np.float64)
+    grid_store["Molecule_offsets"] = np.array(
+        grid_store["Molecule_offsets"], dtype=np.int64
+    )
+    return grid_store
+
+
+def load_molecule_to_shared_memory(args):
+    """
+    Pool worker for parallel ingest: loads a molecule with load_molecule_from_h5
+    and returns its filtered grid through a shared memory block
+    """
+    component_filename, path = args
+    X, HF_energy = load_molecule_from_h5(component_filename, path)
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+    shm.close()
+    return shm.name, X.shape, X.dtype.str, HF_energy
+
+
+def load_molecules_parallel(filenames, path, workers):
+    """
+    Reads and filters the molecules in a process pool,
+    yields (X, HF_energy) in the order of filenames
+    """
+    with Pool(workers) as pool:
+        results = pool.imap(
+            load_molecule_to_shared_memory,
+            [(component_filename, path) for component_filename in filenames],
+        )
+        for name, shape, dtype, HF_energy in results:
+            shm = shared_memory.SharedMemory(name=name)
+            X = np.array(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            shm.close()
+            shm.unlink()
+            yield X, HF_energy
+
+
+def load_grid_store(names, path, molecule_ids=None, workers=1):
+    """
+    Reads the grids of the given component ids (all components by default)
+    into a finalized grid store. Every molecule is read and filtered only once,
+    components which are not requested get an empty grid,
+    so the molecule_id of the store is always the component id.
+    workers : number of processes reading the h5 files
+    """
+    requested = np.zeros(len(names), dtype=bool)
+    requested[slice(None) if molecule_ids is None else molecule_ids] = True
+    filenames = get_h5_names(names[requested])
+
+    if workers > 1:
+        molecules = load_molecules_parallel(filenames, path, workers)
+    else:
+        molecules = (load_molecule_from_h5(filename, path) for filename in filenames)
+
+    grid_store = make_grid_store(names)
+    for is_requested in requested:
+        X, HF_energy = next(molecules) if is_requested else (np.empty((0, 8)), 0.0)
+        add_molecule_to_store(X, HF_energy, grid_store)
 
+    return finalize_grid_store(grid_store)
 
-def make_reactions_dict(path=None):
+
+def add_descriptor_columns(grid_store, chunk_size=2**20):
+    """
+    Precomputes the NN descriptors of all grid points of a finalized grid store
+    (see NN_models.get_descriptor_columns). They are computed from the same float32
+    NN inputs as in the batches, so the models give identical results with them.
+    """
+    n_points = int(grid_store["Molecule_offsets"][-1])
+    descriptors = None
+    for start in range(0, n_points, chunk_size):
+        stop = min(start + chunk_size, n_points)
+        grid = np.empty((stop - start, 7), dtype=np.float32)
+        fill_grid(
+            grid,
+            grid_store["Densities"][start:stop],
+            grid_store["Gradients"][start:stop],
+            grid_store["Taus"][start:stop],
+        )
+        with torch.no_grad():
+            chunk = get_descriptor_columns(torch.from_numpy(grid)).numpy()
+        if descriptors is None:
+            descriptors = np.empty((n_points, chunk.shape[1]), dtype=np.float64)
+        descriptors[start:stop] = chunk
+    grid_store["Descriptors"] = descriptors
+    return grid_store
+
+
+def make_reactions_dict(path=None, workers=1, cache=None):
     """
     Path : absolute or relative path to the molecules grid / reaction data
+    workers : number of processes reading the h5 files
+    cache : directory for the parsed reaction table (see load_reaction_table)
     Returns a dict like {reaction_id: {*reaction info}} with all info available listed below:
-    ['Database', 'Components', 'Coefficients', 'Energy', 'Grid', 'Weights', 'Densities', 'HF_energies', 'backsplit_ind']
+    ['Database', 'Molecule_ids', 'Coefficients', 'Energy']
+    and the grid store shared by all reactions (see make_grid_store)
     """
-    data = get_compounds_coefs_energy(
-        load_component_names(path), load_ref_energies(path)
+    table = load_reaction_table(path, cache)
+    data = get_compounds_coefs_energy(table)
+    grid_store = load_grid_store(
+        table["Names"], path, np.unique(table["Component_ids"]), workers
     )
-    for i in data.keys():
-        data[i] = add_reaction_info_from_h5(data[i], path)
 
-    return data
+    return data, grid_store
 
 
-def collate_fn(data):
+class GridBudgetBatchSampler(torch.utils.data.Sampler):
     """
-    Custom collate function for torch train and test dataloader
+    Packs reactions into batches with at most max_points grid points in total
+    (a reaction larger than the budget forms a batch on its own).
+    Reactions of every database are spread over the epoch in proportion to the
+    database size, so every batch stays stratified by database.
+    Batches are repacked (and shuffled) at the start of every epoch.
     """
-    data = copy.deepcopy(data)
-    reactions = []
-    energies = []
-    for reaction, energy in data:
-        energies.append(energy)
-        reaction.pop("Energy", None)
-        reactions.append(reaction)
 
-    torch_tensor_energy = torch.tensor(energies)
-    reactions_stacked = stack_reactions(reactions)
+    def __init__(self, data, grid_store, max_points, shuffle=True, generator=None):
+        self.max_points = max_points
+        self.shuffle = shuffle
+        self.generator = generator
+
+        offsets = grid_store["Molecule_offsets"]
+        self.sizes = dict()
+        self.databases = dict()
+        for i in data:
+            molecule_ids = data[i]["Molecule_ids"].numpy()
+            self.sizes[i] = int(np.sum(offsets[molecule_ids + 1] - offsets[molecule_ids]))
+            self.databases.setdefault(data[i]["Database"], []).append(i)
+
+        self.batches = self.pack()
+
+    def pack(self):
+        merged = []
+        for k, database in enumerate(sorted(self.databases)):
+            indices = self.databases[database]
+            if self.shuffle:
+                order = torch.randperm(len(indices), generator=self.generator).tolist()
+                indices = [indices[j] for j in order]
+            # the reactions of a database are evenly spaced over the epoch
+            merged += [
+                ((position + 0.5) / len(indices), k, i) for position, i in enumerate(indices)
+            ]
+        merged.sort()
+
+        batches = []
+        batch, batch_points = [], 0
+        for _, _, i in merged:
+            if batch and batch_points + self.sizes[i] > self.max_points:
+                batches.append(batch)
+                batch, batch_points = [], 0
+            batch.append(i)
+            batch_points += self.sizes[i]
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=self.generator).tolist()
+            batches = [batches[j] for j in order]
+        return batches
+
+    def __iter__(self):
+        self.batches = self.pack()
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_fn(data, grid_store):
+    """
+    Custom collate function for torch train and test dataloader.
+    The batch is built directly from grid_store without modifying the dataset dicts.
+    Use functools.partial(collate_fn, grid_store=grid_store) in the dataloader.
+    """
+    reactions = [reaction for reaction, _ in data]
+    torch_tensor_energy = torch.tensor([energy for _, energy in data])
+    reactions_stacked = stack_reactions(reactions, grid_store)
 
-    del energies, reactions, data
     return reactions_stacked, torch_tensor_energy
 
 
-def collate_fn_predopt(data):
+def collate_fn_predopt(data, grid_store):
     """
     Custom collate function for torch predopt dataloader
     """
-    data = copy.deepcopy(data)
-    reactions = []
-    for reaction, constant in data:
-        reactions.append(reaction)
-    reactions_stacked = stack_reactions(reactions)
-    del reactions, data
-    return reactions_stacked, constant
+    reactions = [reaction for reaction, _ in data]
+    reactions_stacked = stack_reactions(reactions, grid_store)
+    return reactions_stacked, data[-1][1]
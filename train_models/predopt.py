@@ -9,7 +9,7 @@ from tqdm.notebook import tqdm
 
 # Add parent directory to path to import from dft_functionals at project root
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from dft_functionals import true_constants_PBE, true_constants_SVWN3
+from dft_functionals import true_constants_SVWN3, true_varying_constants_PBE
 
 true_constants_SVWN = true_constants_SVWN3
 
@@ -20,14 +20,14 @@ class DatasetPredopt(torch.utils.data.Dataset):
         self.dft = dft
 
     def __getitem__(self, i):
-        self.data[i].pop("Database", None)
+        reaction = {k: v for k, v in self.data[i].items() if k != "Database"}
         if self.dft == "PBE":
-            y_single = true_constants_PBE
+            y_single = true_varying_constants_PBE
         elif self.dft == "SVWN3":
             y_single = true_constants_SVWN
         elif self.dft == "XALPHA":
             y_single = torch.Tensor([1.05])
-        return self.data[i], y_single
+        return reaction, y_single
 
     def __len__(self):
         return len(self.data.keys())
@@ -57,17 +57,22 @@ def predopt(
         progress_bar = tqdm(train_loader)
 
         for batch_idx, (X_batch, y_batch) in enumerate(progress_bar):
+            descriptors = X_batch.get("Descriptors")
+            if descriptors is not None:
+                descriptors = descriptors.to(device, non_blocking=True)
             X_batch = X_batch["Grid"].to(device, non_blocking=True)
             if not double_star and not xalpha:
                 y_batch = torch.tile(y_batch, [X_batch.shape[0], 1]).to(
                     device, non_blocking=True
-                )[:, [0, 1, 22, 23, 24, 25]]
-                predictions = model(X_batch)[:, [0, 1, 22, 23, 24, 25]]
+                )
+                predictions = model(X_batch, descriptors=descriptors)
             elif xalpha:
-                predictions = model(X_batch)
+                predictions = model(X_batch, descriptors=descriptors)
                 y_batch = 1.05 * torch.ones(X_batch.shape[0], 1, device=device)
             else:
-                predictions = torch.stack(model(X_batch), dim=1).to(device)
+                predictions = torch.stack(
+                    model(X_batch, descriptors=descriptors), dim=1
+                ).to(device)
                 y_batch = torch.ones(X_batch.shape[0], 3, device=device)
 
             loss = criterion(predictions, y_batch)
@@ -4,6 +4,7 @@ import os
 import pickle
 import shutil
 import subprocess
+from functools import partial
 from optparse import OptionParser
 
 import matplotlib.pyplot as plt
@@ -13,13 +14,26 @@ from torch import nn
 from torch.optim.lr_scheduler import CosineAnnealingLR, LinearLR, SequentialLR
 from tqdm.notebook import tqdm
 
-from dataset import collate_fn, collate_fn_predopt
+from dataset import (
+    GridBudgetBatchSampler,
+    collate_fn,
+    collate_fn_predopt,
+    make_dispersion_vector,
+)
 from NN_models import MLOptimizer, pcPBEdoublestar, pcPBEMLOptimizer, pcPBEstar
-from predopt import DatasetPredopt, predopt, true_constants_PBE
+from predopt import DatasetPredopt, predopt, true_varying_constants_PBE
 from prepare_data import load_chk
-from reaction_energy_calculation import calculate_reaction_energy, get_local_energies
+from reaction_energy_calculation import (
+    calculate_reaction_energy,
+    calculate_reaction_energy_chunked,
+    get_local_energies,
+    masked,
+    reaction_points_per_chunk,
+)
 from utils import configure_optimizers, seed_worker, set_random_seed
 
+from dft_functionals.screening import DENSITY_THRESHOLD, screen_mask
+
 set_random_seed(41)
 g = torch.Generator()
 g.manual_seed(41)
@@ -98,6 +112,43 @@ class Dataset(torch.utils.data.Dataset):
         return len(self.data.keys())
 
 
+def batching_options(data, grid_store, batch_size, grid_budget, shuffle):
+    """
+    DataLoader options for batching by a fixed number of reactions or,
+    if grid_budget is set, by a total number of grid points per batch
+    """
+    if grid_budget:
+        return {
+            "batch_sampler": GridBudgetBatchSampler(
+                data, grid_store, grid_budget, shuffle=shuffle, generator=g
+            )
+        }
+    return {"batch_size": batch_size, "shuffle": shuffle}
+
+
+def batch_descriptors(X_batch, lambda_grad):
+    """
+    Precomputed descriptors of the batch if the dataset has them.
+    The gradient penalty needs the descriptors to be computed from the grid.
+    """
+    if lambda_grad > 0 or "Descriptors" not in X_batch:
+        return None
+    return X_batch["Descriptors"].to(device)
+
+
+def batch_mask(X_batch, density_threshold):
+    """
+    screen_mask of the batch grid, None if the screening is disabled
+    """
+    if density_threshold <= 0:
+        return None
+    return screen_mask(X_batch["Densities"].to(device), density_threshold)
+
+
+def screened_points(mask):
+    return 0 if mask is None else int(mask.numel() - mask.sum())
+
+
 class EarlyStopper:
     def __init__(self, patience=1, min_delta=0):
         self.patience = patience
@@ -244,48 +295,33 @@ def exc_loss(
     pred_constants,
     predicted_local_energies,
     dft="PBE",
-    true_constants=true_constants_PBE,
+    true_constants=true_varying_constants_PBE,
     val=False,
+    mask=None,
 ):
     """
     Function that calculates local energy loss compared to PBE functional
     """
 
-    criterion = nn.MSELoss()
-
     HARTREE2KCAL = 627.5095
 
-    backsplit_ind = reaction["backsplit_ind"].to(
-        torch.int32
-    )  # Turn backsplit indices into slices.
-    indices = list(
-        zip(
-            torch.hstack((torch.tensor(0).to(torch.int32), backsplit_ind)),
-            backsplit_ind,
-        )
-    )
-    n_molecules = len(indices)
-
-    loss = torch.zeros(1, requires_grad=True).to(device)
-
-    predicted_local_energies = [
-        predicted_local_energies[start:stop] for start, stop in indices
-    ]  # Split them into systems
+    molecule_segments = reaction["Molecule_segments"].to(device)
+    n_molecules = len(reaction["HF_energies"])
 
     true_local_energies = get_local_energies(
-        reaction, true_constants.to(device), device, rung="GGA", dft="PBE"
+        reaction, true_constants.to(device), device, rung="GGA", dft="PBE", mask=mask
     )[
         "Local_energies"
     ]  # Calculate local PBE energies.
 
-    true_local_energies = [
-        true_local_energies[start:stop] for start, stop in indices
-    ]  # Split them into systems.
+    # Per-molecule RMSE between predicted and PBE local energies
+    squared_errors = (predicted_local_energies - true_local_energies) ** 2
+    n_points = torch.diff(reaction["backsplit_ind"], prepend=torch.zeros(1)).to(device)
+    molecule_mse = torch.zeros(
+        n_molecules, dtype=squared_errors.dtype, device=device
+    ).index_add_(0, molecule_segments, squared_errors) / n_points
 
-    for i in range(n_molecules):
-        loss += torch.sqrt(
-            criterion(predicted_local_energies[i], true_local_energies[i]) + 1e-20
-        ) / np.sqrt(len(predicted_local_energies[i]))
+    loss = torch.sum(torch.sqrt(molecule_mse + 1e-20) / torch.sqrt(n_points))
 
     del (true_local_energies, predicted_local_energies)
     return loss * HARTREE2KCAL / n_molecules
@@ -305,7 +341,17 @@ def train(
     omega=0.067,
     lambda_grad=0,
     smoothing_window=10,
+    chunk_size=0,
+    density_threshold=0,
 ):
+    """
+    chunk_size : if > 0, the model and the functional are evaluated over chunks of
+    chunk_size grid points with checkpointing (see get_local_energies_chunked)
+    density_threshold : grid points with a smaller total density are skipped by
+    the model and the functional and get zero local energy, 0 disables the screening
+    """
+    if chunk_size and lambda_grad > 0:
+        raise ValueError("The gradient penalty is not available with chunked evaluation")
     torch.set_printoptions(precision=2)
     train_loss_mae = []
     train_loss_mse = []
@@ -350,14 +396,18 @@ def train(
 
         for batch_idx, (X_batch, y_batch) in enumerate(progress_bar_train):
             X_batch_grid, y_batch = X_batch["Grid"].to(device), y_batch.to(device)
-            X_batch_grid.requires_grad_(True)
+            X_batch_grid.requires_grad_(lambda_grad > 0)
             current_bases, bases = extend_bases(X_batch=X_batch, bases=bases)
-            predictions = model(X_batch_grid)
+            mask = batch_mask(X_batch, density_threshold)
+            predictions = None if chunk_size else model(
+                masked(X_batch_grid, mask),
+                descriptors=masked(batch_descriptors(X_batch, lambda_grad), mask),
+            )
 
             if lambda_grad > 0:  # Only compute if penalty is active
 
                 if dft == "PBE":
-                    true_constants, indices = true_constants_PBE, [0, 1, 22, 23, 24, 25]
+                    true_constants, indices = true_varying_constants_PBE, [0, 1, 2, 3, 4, 5]
                 else:
                     true_constants, indices = 1.05, [
                         0,
@@ -381,16 +431,29 @@ def train(
                 gradient_penalty = torch.tensor(0.0).to(device)
                 train_grad_penalties_per_epoch.append(0.0)
 
-            if "STARSTAR" in name:
+            if chunk_size:
+                reaction_energy, local_energies = calculate_reaction_energy_chunked(
+                    X_batch,
+                    model,
+                    device,
+                    rung=rung,
+                    dft=dft,
+                    chunk_size=chunk_size,
+                    dispersions=dispersions,
+                    descriptors=batch_descriptors(X_batch, lambda_grad),
+                    mask=mask,
+                )
+
+            elif "STARSTAR" in name:
                 reaction_energy, local_energies = calculate_reaction_energy(
                     X_batch,
-                    torch.ones(X_batch_grid.shape[0], 26).to(device)
-                    * true_constants_PBE,
+                    true_varying_constants_PBE,
                     device,
                     rung=rung,
                     dft=dft,
                     dispersions=dispersions,
                     enhancement=torch.stack(predictions, dim=1),
+                    mask=mask,
                 )
 
             else:
@@ -401,9 +464,10 @@ def train(
                     rung=rung,
                     dft=dft,
                     dispersions=dispersions,
+                    mask=mask,
                 )
 
-            local_loss = exc_loss(X_batch, predictions, local_energies, dft=dft)
+            local_loss = exc_loss(X_batch, predictions, local_energies, dft=dft, mask=mask)
 
             batch_fchem_loss = batch_fchem(current_bases, reaction_energy, y_batch)
 
@@ -440,6 +504,7 @@ def train(
                 Exc=f"{local_loss.item():.3f}",
                 GradP=f"{gradient_penalty.item():.4f}",
                 MAE=f"{MAE:.3f}",
+                Screened=screened_points(mask),
             )
 
             if ((batch_idx + 1) % accum_iter == 0) or (
@@ -503,19 +568,36 @@ def train(
                 X_batch_grid, y_batch = X_batch["Grid"].to(device), y_batch.to(device)
 
                 current_bases, bases = extend_bases(X_batch=X_batch, bases=bases)
+                mask = batch_mask(X_batch, density_threshold)
+
+                predictions = None if chunk_size else model(
+                    masked(X_batch_grid, mask),
+                    descriptors=masked(batch_descriptors(X_batch, lambda_grad), mask),
+                )
 
-                predictions = model(X_batch_grid)
+                if chunk_size:
+                    reaction_energy, local_energies = calculate_reaction_energy_chunked(
+                        X_batch,
+                        model,
+                        device,
+                        rung=rung,
+                        dft=dft,
+                        chunk_size=chunk_size,
+                        dispersions=dispersions,
+                        descriptors=batch_descriptors(X_batch, lambda_grad),
+                        mask=mask,
+                    )
 
-                if "STARSTAR" in name:
+                elif "STARSTAR" in name:
                     reaction_energy, local_energies = calculate_reaction_energy(
                         X_batch,
-                        torch.ones(X_batch_grid.shape[0], 26).to(device)
-                        * true_constants_PBE,
+                        true_varying_constants_PBE,
                         device,
                         rung=rung,
                         dft=dft,
                         dispersions=dispersions,
                         enhancement=torch.stack(predictions, dim=1),
+                        mask=mask,
                     )
 
                 else:
@@ -526,6 +608,7 @@ def train(
                         rung=rung,
                         dft=dft,
                         dispersions=dispersions,
+                        mask=mask,
                     )
 
                 pred_energies, ref_energies, errors, total_database_errors = (
@@ -540,7 +623,7 @@ def train(
                     )
                 )
 
-                local_loss = exc_loss(X_batch, predictions, local_energies, dft=dft)
+                local_loss = exc_loss(X_batch, predictions, local_energies, dft=dft, mask=mask)
 
                 MAE = mae(reaction_energy, y_batch).item()
 
@@ -556,7 +639,9 @@ def train(
                 test_exc_losses_per_epoch.append(local_loss.item())
                 val_full_loss_per_epoch.append(loss.item())
 
-                progress_bar_test.set_postfix(RMSE=batch_fchem_loss, MAE=MAE)
+                progress_bar_test.set_postfix(
+                    RMSE=batch_fchem_loss, MAE=MAE, Screened=screened_points(mask)
+                )
                 del (
                     X_batch,
                     X_batch_grid,
@@ -659,7 +744,7 @@ def train(
 
 if __name__ == "__main__":
 
-    data, data_train, data_test = load_chk(path="checkpoints")
+    data, data_train, data_test, grid_store = load_chk(path="checkpoints")
 
     parser = OptionParser()
     parser.add_option(
@@ -674,6 +759,12 @@ if __name__ == "__main__":
     parser.add_option(
         "--Batch_size", type=int, default=3, help="Number of reactions in a batch"
     )
+    parser.add_option(
+        "--Grid_budget",
+        type=int,
+        default=0,
+        help="Maximum number of grid points in a batch (0 batches by Batch_size)",
+    )
     parser.add_option(
         "--Dropout", type=float, default=0.6, help="Dropout rate during training"
     )
@@ -692,6 +783,24 @@ if __name__ == "__main__":
     parser.add_option(
         "--Patience", type=int, default=50, help="Patience for early stopping"
     )
+    parser.add_option(
+        "--Chunk_size",
+        type=int,
+        default=0,
+        help="Grid points per chunk of the NN + functional evaluation (0 evaluates the whole batch)",
+    )
+    parser.add_option(
+        "--Memory_budget",
+        type=float,
+        default=0,
+        help="Memory for the graph of one chunk in MB, sets Chunk_size if > 0",
+    )
+    parser.add_option(
+        "--Density_threshold",
+        type=float,
+        default=0,
+        help=f"Grid points with a smaller total density are skipped, e.g. {DENSITY_THRESHOLD:g} (0 disables the screening)",
+    )
 
     (Opts, args) = parser.parse_args()
 
@@ -700,6 +809,7 @@ if __name__ == "__main__":
         n_predopt,
         n_train,
         batch_size,
+        grid_budget,
         dropout,
         omega,
         lr_train,
@@ -710,6 +820,7 @@ if __name__ == "__main__":
         Opts.N_preopt,
         Opts.N_train,
         Opts.Batch_size,
+        Opts.Grid_budget,
         Opts.Dropout,
         Opts.Omega,
         Opts.LR_train,
@@ -718,13 +829,14 @@ if __name__ == "__main__":
     )
 
     print(
-        "name, n_predopt, n_train, batch_size, dropout, omega, lr_train, lr_predopt, patience"
+        "name, n_predopt, n_train, batch_size, grid_budget, dropout, omega, lr_train, lr_predopt, patience"
     )
     print(
         name,
         n_predopt,
         n_train,
         batch_size,
+        grid_budget,
         dropout,
         omega,
         lr_train,
@@ -777,39 +889,36 @@ if __name__ == "__main__":
 
     # Load dispersion corrections.
     with open("./dispersions/dispersions.pickle", "rb") as handle:
-        dispersions = pickle.load(handle)
+        dispersions = make_dispersion_vector(pickle.load(handle), grid_store["Names"])
 
     # Load train, test and pre-optimization dataloaders.
     train_set = Dataset(data=data_train)
     train_dataloader = torch.utils.data.DataLoader(
         train_set,
-        batch_size=batch_size,
+        **batching_options(data_train, grid_store, batch_size, grid_budget, True),
         num_workers=2,
         pin_memory=True,
-        shuffle=True,
         generator=g,
-        collate_fn=collate_fn,
+        collate_fn=partial(collate_fn, grid_store=grid_store),
         worker_init_fn=seed_worker,
     )
     test_set = Dataset(data=data_test)
     test_dataloader = torch.utils.data.DataLoader(
         test_set,
-        batch_size=batch_size,
+        **batching_options(data_test, grid_store, batch_size, grid_budget, False),
         num_workers=2,
         pin_memory=True,
-        shuffle=False,
-        collate_fn=collate_fn,
+        collate_fn=partial(collate_fn, grid_store=grid_store),
         generator=g,
         worker_init_fn=seed_worker,
     )
     train_predopt_set = DatasetPredopt(data=data, dft=dft)
     train_predopt_dataloader = torch.utils.data.DataLoader(
         train_predopt_set,
-        batch_size=batch_size,
+        **batching_options(data, grid_store, batch_size, grid_budget, False),
         num_workers=2,
         pin_memory=True,
-        shuffle=False,
-        collate_fn=collate_fn_predopt,
+        collate_fn=partial(collate_fn_predopt, grid_store=grid_store),
         generator=g,
         worker_init_fn=seed_worker,
     )
@@ -841,7 +950,15 @@ if __name__ == "__main__":
         xalpha=xalpha,
     )
 
-    true_constants_PBE = true_constants_PBE.to(device)
+    true_varying_constants_PBE = true_varying_constants_PBE.to(device)
+
+    chunk_size = Opts.Chunk_size
+    if Opts.Memory_budget > 0:
+        chunk_size = reaction_points_per_chunk(
+            model, Opts.Memory_budget * 2**20, device, rung, dft
+        )
+    if chunk_size:
+        print("Grid points per chunk:", chunk_size)
     optimizer = configure_optimizers(model=model, learning_rate=lr_train)
 
     warmup_epochs = 5
@@ -877,4 +994,6 @@ if __name__ == "__main__":
         accum_iter=ACCUM_ITER,
         omega=omega,
         verbose=VERBOSE,
+        chunk_size=chunk_size,
+        density_threshold=Opts.Density_threshold,
     )
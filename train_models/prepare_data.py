@@ -1,11 +1,21 @@
 import copy
 import pickle
 import random
+from optparse import OptionParser
 
+import numpy as np
 import torch
 from sklearn.model_selection import StratifiedKFold
 
-from dataset import make_reactions_dict
+from compression import compress_grid_store, report_compression
+from dataset import (
+    GRID_COLUMNS,
+    OPTIONAL_COLUMNS,
+    add_descriptor_columns,
+    make_reactions_dict,
+)
+
+CHK_SUBSETS = ("data", "data_train", "data_test")
 
 
 def rename_keys(data):
@@ -18,9 +28,10 @@ def rename_keys(data):
     return data_new
 
 
-def train_split(data, test_size, shuffle=False, random_state=42):
+def train_split(data, names, test_size, shuffle=False, random_state=42):
     random.seed(random_state)
     # Returns train and test reaction dictionaries.
+    # names map the reaction Molecule_ids to the component names.
     X = []
     y = []
     for key in data:
@@ -36,7 +47,7 @@ def train_split(data, test_size, shuffle=False, random_state=42):
     for i in train_index:
 
         database = data[i]["Database"]
-        components = data[i]["Components"]
+        components = names[data[i]["Molecule_ids"].numpy()]
 
         if (
             (
@@ -64,7 +75,7 @@ def train_split(data, test_size, shuffle=False, random_state=42):
                 in components  # This reaction is in diet-GMTKN55, so do not train on it
             )
         ):
-            print(data[i]["Components"])
+            print(components)
             test[i] = data[i]
         else:
             train[i] = data[i]
@@ -72,7 +83,7 @@ def train_split(data, test_size, shuffle=False, random_state=42):
     for i in test_index:
 
         database = data[i]["Database"]
-        components = data[i]["Components"]
+        components = names[data[i]["Molecule_ids"].numpy()]
 
         if database == "AE17" and components[0] in [
             "H_ae17",
@@ -93,43 +104,121 @@ def train_split(data, test_size, shuffle=False, random_state=42):
     return rename_keys(train), rename_keys(test)
 
 
-def prepare(path="data", test_size=0.2, random_state=42):
+def prepare(path="data", test_size=0.2, random_state=42, workers=1, cache=None):
     # Make a single dictionary from the whole dataset.
-    data = make_reactions_dict(path=path)
+    data, grid_store = make_reactions_dict(path=path, workers=workers, cache=cache)
 
-    # Train-test split.
+    # Train-test split. Reactions only reference the grids in grid_store.
     data_train, data_test = train_split(
-        copy.deepcopy(data), test_size, shuffle=True, random_state=random_state
+        copy.deepcopy(data),
+        grid_store["Names"],
+        test_size,
+        shuffle=True,
+        random_state=random_state,
     )
 
-    for data_t in (data_train, data_test):
-        for i in range(len(data_t)):
-            data_t[i]["Grid"] = torch.Tensor(data_t[i]["Grid"])
-
-    return data, data_train, data_test
-
-
-def save_chk(data, data_train, data_test, path="checkpoints"):
-    # Save all processed data into pickle.
-    with open(f"{path}/data.pickle", "wb") as f:
-        pickle.dump(data, f)
-    with open(f"{path}/data_train.pickle", "wb") as f:
-        pickle.dump(data_train, f)
-    with open(f"{path}/data_test.pickle", "wb") as f:
-        pickle.dump(data_test, f)
+    return data, data_train, data_test, grid_store
+
+
+def save_chk(data, data_train, data_test, grid_store, path="checkpoints"):
+    """
+    Saves all processed data in the columnar format:
+    <column>.f64 : one contiguous float64 array per grid column of grid_store
+        (and per optional column like Descriptors if present)
+    molecule_offsets.npy, hf_energies.npy : per-molecule offset table and HF energies
+    <subset>_reaction_offsets.npy, <subset>_reaction_molecules.npy : per-reaction
+        offset table into the molecule ids of the reaction components
+    reactions.pickle : reaction info without grids, component names and column shapes
+    """
+    meta = {"Names": grid_store["Names"], "Shapes": dict(), "Reactions": dict()}
+
+    optional = tuple(label for label in OPTIONAL_COLUMNS if label in grid_store)
+    for label in GRID_COLUMNS + optional:
+        column = np.ascontiguousarray(grid_store[label], dtype=np.float64)
+        column.tofile(f"{path}/{label.lower()}.f64")
+        meta["Shapes"][label] = column.shape
+    np.save(f"{path}/molecule_offsets.npy", grid_store["Molecule_offsets"])
+    np.save(f"{path}/hf_energies.npy", grid_store["HF_energies"])
+
+    for subset, reactions in zip(CHK_SUBSETS, (data, data_train, data_test)):
+        molecule_ids = [reactions[i]["Molecule_ids"].numpy() for i in reactions]
+        np.save(
+            f"{path}/{subset}_reaction_offsets.npy",
+            np.cumsum([0] + [len(ids) for ids in molecule_ids]),
+        )
+        np.save(
+            f"{path}/{subset}_reaction_molecules.npy",
+            np.concatenate(molecule_ids).astype(np.int64),
+        )
+        meta["Reactions"][subset] = {
+            i: {k: v for k, v in reactions[i].items() if k != "Molecule_ids"}
+            for i in reactions
+        }
+
+    with open(f"{path}/reactions.pickle", "wb") as f:
+        pickle.dump(meta, f)
 
 
 def load_chk(path="checkpoints"):
-    # Load processed data from pickle.
-    with open(f"{path}/data.pickle", "rb") as f:
-        data = pickle.load(f)
-    with open(f"{path}/data_train.pickle", "rb") as f:
-        data_train = pickle.load(f)
-    with open(f"{path}/data_test.pickle", "rb") as f:
-        data_test = pickle.load(f)
-    return data, data_train, data_test
+    """
+    Loads processed data saved by save_chk.
+    Grid columns are memory-mapped, so loading is almost instant and
+    pages are shared between dataloader workers and concurrent jobs.
+    """
+    with open(f"{path}/reactions.pickle", "rb") as f:
+        meta = pickle.load(f)
+
+    grid_store = {"Names": meta["Names"]}
+    for label in meta["Shapes"]:
+        grid_store[label] = np.memmap(
+            f"{path}/{label.lower()}.f64",
+            dtype=np.float64,
+            mode="r",
+            shape=tuple(meta["Shapes"][label]),
+        )
+    grid_store["Molecule_offsets"] = np.load(f"{path}/molecule_offsets.npy")
+    grid_store["HF_energies"] = np.load(f"{path}/hf_energies.npy")
+
+    subsets = []
+    for subset in CHK_SUBSETS:
+        offsets = np.load(f"{path}/{subset}_reaction_offsets.npy")
+        molecules = torch.from_numpy(np.load(f"{path}/{subset}_reaction_molecules.npy"))
+        reactions = meta["Reactions"][subset]
+        for n, i in enumerate(reactions):
+            reactions[i]["Molecule_ids"] = molecules[offsets[n] : offsets[n + 1]]
+        subsets.append(reactions)
+
+    data, data_train, data_test = subsets
+    return data, data_train, data_test, grid_store
 
 
 if __name__ == "__main__":
-    data, data_train, data_test = prepare(path="data", test_size=0.2)
-    save_chk(data, data_train, data_test, path="checkpoints")
+    parser = OptionParser()
+    parser.add_option(
+        "--Workers", type=int, default=1, help="Number of processes reading h5 files"
+    )
+    parser.add_option(
+        "--Compression_tol",
+        type=float,
+        default=0,
+        help="Per-molecule budget of the pruned PBE XC energy in kcal/mol (0 keeps the full grids)",
+    )
+    parser.add_option(
+        "--Descriptors",
+        action="store_true",
+        default=False,
+        help="Precompute the NN descriptors of all grid points",
+    )
+    (Opts, args) = parser.parse_args()
+
+    data, data_train, data_test, grid_store = prepare(
+        path="data", test_size=0.2, workers=Opts.Workers, cache="checkpoints"
+    )
+    if Opts.Compression_tol > 0:
+        compressed, errors = compress_grid_store(grid_store, Opts.Compression_tol)
+        report_compression(grid_store, compressed, errors)
+        np.save("checkpoints/compression_errors.npy", errors)
+        grid_store = compressed
+    if Opts.Descriptors:
+        grid_store = add_descriptor_columns(grid_store)
+    save_chk(data, data_train, data_test, grid_store, path="checkpoints")
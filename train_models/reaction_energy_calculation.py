@@ -1,31 +1,72 @@
 import sys
+from functools import partial
 from pathlib import Path
 
-import numpy as np
 import torch
+from torch.utils.checkpoint import checkpoint
 
 # Import from shared dft_functionals at project root
 root_path = Path(__file__).parent.parent
 sys.path.insert(0, str(root_path))
 from DFT import PBE, SVWN3
+from dft_functionals import true_constants_PBE, true_varying_constants_PBE
+from dft_functionals.screening import scatter_screened
+from NN_models import points_per_chunk
 
 F_PBE = PBE.F_PBE
 F_XALPHA = SVWN3.F_XALPHA
 f_svwn3 = SVWN3.f_svwn3
 
 
-def get_local_energies(reaction, constants, device, rung="GGA", dft="PBE", enhancement=None):
-    calc_reaction_data = {}
-    densities = reaction["Densities"].to(device)
+def compute_local_energies(
+    densities, gradients, constants, device, rung="GGA", dft="PBE", enhancement=None
+):
+    """
+    constants : for PBE the (N, 6) or (1, 6) PBE.PBE_VARYING columns predicted by
+    the NN models, the fixed columns are broadcast from true_constants_PBE
+    """
     if rung == "LDA":
         if dft == "SVWN3":
-            local_energies = f_svwn3(densities, constants)
+            return f_svwn3(densities, constants)
         if dft == "XALPHA":
-            local_energies = F_XALPHA(densities, constants)
+            return F_XALPHA(densities, constants)
     elif rung == "GGA":
-        gradients = (reaction["Gradients"]).to(device)
         if dft == "PBE":
-            local_energies = F_PBE(densities, gradients, constants, device, enhancement=enhancement)
+            return F_PBE(
+                densities,
+                gradients,
+                true_constants_PBE.to(device),
+                device,
+                enhancement=enhancement,
+                varying=constants,
+            )
+
+
+def masked(tensor, mask):
+    return tensor if tensor is None or mask is None else tensor[mask]
+
+
+def get_local_energies(
+    reaction, constants, device, rung="GGA", dft="PBE", enhancement=None, mask=None
+):
+    """
+    mask : optional screen_mask of the grid, the constants and the enhancement
+    are then given for the masked points only and the screened points get zero energy
+    """
+    calc_reaction_data = {}
+    densities = reaction["Densities"].to(device)
+    gradients = reaction["Gradients"].to(device) if rung == "GGA" else None
+    local_energies = compute_local_energies(
+        masked(densities, mask),
+        masked(gradients, mask),
+        constants,
+        device,
+        rung,
+        dft,
+        enhancement=enhancement,
+    )
+    if mask is not None:
+        local_energies = scatter_screened(local_energies, mask)
 
     calc_reaction_data["Local_energies"] = local_energies
     calc_reaction_data["Densities"] = densities
@@ -34,71 +75,167 @@ def get_local_energies(reaction, constants, device, rung="GGA", dft="PBE", enhan
     return calc_reaction_data
 
 
-def backsplit(reaction, calc_reaction_data):
-    backsplit_ind = reaction["backsplit_ind"].type(torch.int)
-    splitted_data = dict()
-    stop = 0
-
-    for i, component in enumerate(np.frombuffer(reaction["Components"], dtype="<U20")):
-        splitted_data[component] = dict()
-        start = stop
-        stop = backsplit_ind[i]
-        for elem in ("Local_energies", "Weights", "Densities"):
-            splitted_data[component][elem] = calc_reaction_data[elem][start:stop]
-    del backsplit_ind, start, stop
-    return splitted_data
-
-
-def integration(reaction, splitted_calc_reaction_data, dispersions=dict()):
-    molecule_energies = dict()
-    for i, component in enumerate(np.frombuffer(reaction["Components"], dtype="<U20")):
-        molecule_energies[component + str(i)] = (
-            torch.sum(
-                splitted_calc_reaction_data[component]["Local_energies"]
-                * (
-                    splitted_calc_reaction_data[component]["Densities"][:, 0]
-                    + splitted_calc_reaction_data[component]["Densities"][:, 1]
-                )
-                * (splitted_calc_reaction_data[component]["Weights"])
+def chunk_local_energies(model, grid, descriptors, densities, gradients, device, rung, dft):
+    """
+    NN + functional local energies of one chunk of grid points
+    """
+    predictions = model(grid, descriptors=descriptors)
+    if isinstance(predictions, tuple):  # enhancement factors of pcPBEdoublestar
+        constants = true_varying_constants_PBE.to(device)
+        enhancement = torch.stack(predictions, dim=1)
+    else:
+        constants, enhancement = predictions, None
+    return compute_local_energies(
+        densities, gradients, constants, device, rung, dft, enhancement=enhancement
+    )
+
+
+def get_local_energies_chunked(
+    reaction, model, device, rung, dft, chunk_size, descriptors=None, mask=None
+):
+    """
+    get_local_energies with the model evaluated inside, chunk_size grid points at a time.
+    Every chunk runs under torch.utils.checkpoint: only its local energies are kept
+    for backward and its NN + functional graph is recomputed when the gradients
+    reach it, so the peak memory is bounded by a single chunk
+    mask : optional screen_mask, only the masked points are chunked and evaluated
+    """
+    densities = reaction["Densities"].to(device)
+    grid = masked(reaction["Grid"].to(device), mask)
+    descriptors = masked(descriptors, mask)
+    gradients = reaction["Gradients"].to(device) if rung == "GGA" else None
+    gradients = masked(gradients, mask)
+    evaluated_densities = masked(densities, mask)
+    run_chunk = partial(chunk_local_energies, model, device=device, rung=rung, dft=dft)
+
+    local_energies = []
+    for start in range(0, len(grid), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        local_energies.append(
+            checkpoint(
+                run_chunk,
+                grid[chunk],
+                None if descriptors is None else descriptors[chunk],
+                evaluated_densities[chunk],
+                None if gradients is None else gradients[chunk],
+                use_reentrant=False,
             )
-            + reaction["HF_energies"][i]
         )
-        if dispersions:
-            molecule_energies[component + str(i)] += torch.Tensor(
-                dispersions.get(component, 0)
-            )
-    del splitted_calc_reaction_data
+
+    local_energies = torch.cat(local_energies)
+    if mask is not None:
+        local_energies = scatter_screened(local_energies, mask)
+    return {
+        "Local_energies": local_energies,
+        "Densities": densities,
+        "Weights": reaction["Weights"].to(device),
+    }
+
+
+def reaction_points_per_chunk(model, memory_budget, device, rung, dft):
+    """
+    Number of grid points per chunk whose NN + functional graph
+    fits into memory_budget bytes, measured on random grid points
+    """
+
+    def probe(n_points):
+        grid = torch.rand(n_points, 7, device=device) + 0.1
+        return chunk_local_energies(
+            model, grid, None, grid[:, :2], grid[:, 2:5], device, rung, dft
+        )
+
+    return points_per_chunk(memory_budget, probe)
+
+
+def integration(reaction, calc_reaction_data, dispersions=None):
+    """
+    Returns a tensor with the energies of all molecules in the batch.
+    Local energies are summed per molecule with index_add_ over Molecule_segments.
+    dispersions : tensor of dispersion corrections indexed by the molecule id
+    (see dataset.make_dispersion_vector)
+    """
+    local_energies = calc_reaction_data["Local_energies"]
+    device = local_energies.device
+    molecule_segments = reaction["Molecule_segments"].to(device)
+
+    scaled_local_energies = (
+        local_energies
+        * (
+            calc_reaction_data["Densities"][:, 0]
+            + calc_reaction_data["Densities"][:, 1]
+        )
+        * calc_reaction_data["Weights"]
+    )
+    molecule_energies = torch.zeros(
+        len(reaction["HF_energies"]), dtype=scaled_local_energies.dtype, device=device
+    ).index_add_(0, molecule_segments, scaled_local_energies)
+    molecule_energies = molecule_energies + reaction["HF_energies"].to(device)
+
+    if dispersions is not None:
+        molecule_energies = molecule_energies + dispersions.to(
+            device=device, dtype=molecule_energies.dtype
+        )[reaction["Molecule_ids"].to(device)]
     return molecule_energies
 
 
 def get_energy_reaction(reaction, molecule_energies):
-    slices = reaction.get("reaction_indices", [0, len(reaction["Components"])])
+    """
+    Returns reaction energies in kcal/mol, molecule energies are weighted
+    by the coefficients and summed per reaction over Reaction_segments
+    """
     hartree2kcal = 627.5095
-    reaction_energy_kcal = []
-    for i in range(len(slices) - 1):
-        s = 0
-        for coef, ener in list(
-            zip(reaction["Coefficients"], molecule_energies.values())
-        )[slices[i] : slices[i + 1]]:
-            s += coef * ener
-        reaction_energy_kcal.append(s * hartree2kcal)
-    del ener, coef, s, slices
+    device = molecule_energies.device
+    reaction_segments = reaction["Reaction_segments"].to(device)
+    weighted_energies = (
+        torch.as_tensor(reaction["Coefficients"], device=device) * molecule_energies
+    )
+    reaction_energy = torch.zeros(
+        len(reaction["reaction_indices"]) - 1,
+        dtype=weighted_energies.dtype,
+        device=device,
+    ).index_add_(0, reaction_segments, weighted_energies)
 
-    return torch.stack(reaction_energy_kcal)
+    return reaction_energy * hartree2kcal
 
 
 def calculate_reaction_energy(
-    reaction, constants, device, rung, dft, dispersions=dict(), enhancement=None
+    reaction, constants, device, rung, dft, dispersions=None, enhancement=None, mask=None
+):
+    local_energies = get_local_energies(
+        reaction, constants, device, rung, dft, enhancement=enhancement, mask=mask
+    )
+    return integrate_reaction_energy(reaction, local_energies, dispersions)
+
+
+def calculate_reaction_energy_chunked(
+    reaction,
+    model,
+    device,
+    rung,
+    dft,
+    chunk_size,
+    dispersions=None,
+    descriptors=None,
+    mask=None,
 ):
-    local_energies = get_local_energies(reaction, constants, device, rung, dft, enhancement=enhancement)
+    """
+    calculate_reaction_energy with the model evaluated in chunks
+    (see get_local_energies_chunked)
+    """
+    local_energies = get_local_energies_chunked(
+        reaction, model, device, rung, dft, chunk_size, descriptors=descriptors, mask=mask
+    )
+    return integrate_reaction_energy(reaction, local_energies, dispersions)
+
+
+def integrate_reaction_energy(reaction, local_energies, dispersions=None):
     if local_energies["Local_energies"].isnan().any():
         print(local_energies["Local_energies"].isnan().sum())
         torch.save(local_energies["Local_energies"], "local_energies.pt")
         raise Exception()
-    splitted_calc_reaction_data = backsplit(reaction, local_energies)
-    molecule_energies = integration(reaction, splitted_calc_reaction_data, dispersions)
+    molecule_energies = integration(reaction, local_energies, dispersions)
     reaction_energy_kcal = get_energy_reaction(reaction, molecule_energies)
-    del molecule_energies, splitted_calc_reaction_data
+    del molecule_energies
     return reaction_energy_kcal, local_energies["Local_energies"]
 
 
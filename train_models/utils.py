@@ -1,9 +1,6 @@
 import inspect
 import os
 import random
-from collections import defaultdict
-from itertools import chain
-from operator import methodcaller
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -61,34 +58,118 @@ def set_random_seed(seed):
     random.seed(seed)
 
 
-def stack_reactions(reactions):
-    reaction_indices = [0]
+def empty_batch_tensor(shape, dtype=None):
+    """
+    torch.empty which is allocated in shared memory inside a dataloader worker,
+    so the batch is handed to the main process without another copy
+    """
+    tensor = torch.empty(shape, dtype=dtype)
+    if torch.utils.data.get_worker_info() is not None:
+        tensor.share_memory_()
+    return tensor
+
+
+def fill_grid(grid, densities, sigmas, taus):
+    """
+    Fills the NN input columns of the grid points
+    """
+    # Grid is rho_a, rho_b, sigma_aa, norm_sigma, sigma_bb, taua, taub
+    # with norm_grad=sigma_a + sigma_b + 2*sigma_a_b to get positive descriptor
+    grid[:, 0:2] = densities
+    grid[:, 2] = sigmas[:, 0]
+    grid[:, 3] = sigmas[:, 0] + sigmas[:, 2] + 2 * sigmas[:, 1]
+    grid[:, 4] = sigmas[:, 2]
+    grid[:, 5:7] = taus
+
+
+def stack_reactions(reactions, grid_store, skip=("Energy",)):
+    """
+    Builds a batch dict from reactions of make_reactions_dict without modifying them.
+    Total sizes are computed from the grid store offsets first, then every grid
+    field is allocated once and filled in a single pass over the batch molecules.
+
+    Grid fields: Grid, Weights, Densities, Gradients, HF_energies, backsplit_ind
+    Descriptors : precomputed NN descriptors, if the grid store has them
+    Molecule_segments : batch molecule index of every grid point
+    Reaction_segments : batch reaction index of every molecule
+    reaction_indices : start/end of every reaction in the batch molecules
+    """
+    molecule_ids = np.concatenate([r["Molecule_ids"].numpy() for r in reactions])
+    n_components = [len(r["Molecule_ids"]) for r in reactions]
+    reaction_indices = np.cumsum([0] + n_components).tolist()
+
+    starts = grid_store["Molecule_offsets"][molecule_ids]
+    stops = grid_store["Molecule_offsets"][molecule_ids + 1]
+    backsplit_ind = np.cumsum(stops - starts)
+    n_points = int(backsplit_ind[-1]) if len(backsplit_ind) else 0
+
+    grid = empty_batch_tensor((n_points, 7))
+    weights = empty_batch_tensor((n_points,))
+    densities = empty_batch_tensor((n_points, 2))
+    gradients = empty_batch_tensor((n_points, 3))
+    molecule_segments = empty_batch_tensor((n_points,), dtype=torch.long)
+    descriptors, descriptors_np = None, None
+    if "Descriptors" in grid_store:
+        descriptors = empty_batch_tensor((n_points, grid_store["Descriptors"].shape[1]))
+        descriptors_np = descriptors.numpy()
+
+    grid_np, weights_np, densities_np, gradients_np, segments_np = (
+        grid.numpy(),
+        weights.numpy(),
+        densities.numpy(),
+        gradients.numpy(),
+        molecule_segments.numpy(),
+    )
+
     stop = 0
-    reaction = defaultdict(list)
-    dict_items = map(methodcaller("items"), reactions)
-    for k, v in chain.from_iterable(dict_items):
-        if k == "Components":
-            reaction_indices.append(stop + len(v))
-            stop += len(v)
-        if k in ("Components", "Coefficients", "Database"):
-            reaction[k] = (
-                np.hstack([np.array(reaction[k]), v]) if len(reaction[k]) else v
-            )
-        elif k in ("Grid", "Densities", "Gradients"):
-            reaction[k] = torch.vstack([reaction[k], v]) if len(reaction[k]) else v
-        elif k == "backsplit_ind":
-            reaction[k] = (
-                torch.hstack([reaction[k], v + reaction[k][-1]])
-                if len(reaction[k])
-                else v
-            )
+    for i, (molecule_start, molecule_stop, end) in enumerate(
+        zip(starts, stops, backsplit_ind)
+    ):
+        start, stop = stop, end
+        sigmas = grid_store["Gradients"][molecule_start:molecule_stop]
+        densities_np[start:stop] = grid_store["Densities"][molecule_start:molecule_stop]
+        gradients_np[start:stop] = sigmas
+        weights_np[start:stop] = grid_store["Weights"][molecule_start:molecule_stop]
+        segments_np[start:stop] = i
+
+        fill_grid(
+            grid_np[start:stop],
+            densities_np[start:stop],
+            sigmas,
+            grid_store["Taus"][molecule_start:molecule_stop],
+        )
+        if descriptors is not None:
+            descriptors_np[start:stop] = grid_store["Descriptors"][
+                molecule_start:molecule_stop
+            ]
+
+    reaction = {
+        "Grid": grid,
+        "Weights": weights,
+        "Densities": densities,
+        "Gradients": gradients,
+        "HF_energies": torch.Tensor(grid_store["HF_energies"][molecule_ids]),
+        "backsplit_ind": torch.Tensor(backsplit_ind),
+        "Molecule_ids": torch.from_numpy(molecule_ids),
+        "Molecule_segments": molecule_segments,
+        "Reaction_segments": torch.repeat_interleave(
+            torch.arange(len(reactions)), torch.tensor(n_components)
+        ),
+        "reaction_indices": reaction_indices,
+    }
+    if descriptors is not None:
+        reaction["Descriptors"] = descriptors
+
+    for k in reactions[0]:
+        if k in skip or k in reaction:
+            continue
+        values = [r[k] for r in reactions]
+        if k == "Database":
+            reaction[k] = np.hstack(values) if len(values) > 1 else values[0]
         else:
-            if type(reaction[k]) != torch.Tensor:
-                reaction[k] = torch.Tensor(reaction[k])
-            reaction[k] = torch.hstack([reaction[k], v]) if reaction[k].dim != 0 else v
-    reaction["reaction_indices"] = reaction_indices
-    del dict_items
-    return dict(reaction)
+            reaction[k] = torch.cat([torch.atleast_1d(v) for v in values])
+
+    return reaction
 
 
 def configure_optimizers(model, learning_rate):